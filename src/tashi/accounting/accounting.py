@@ -22,7 +22,7 @@ import sys
 import logging.config
 
 from tashi.rpycservices import rpycservices
-from rpyc.utils.server import ThreadedServer
+from tashi.rpycservices.poolserver import createServer
 #from rpyc.utils.authenticators import TlsliteVdbAuthenticator
 
 #from tashi.rpycservices.rpyctypes import *
@@ -59,9 +59,8 @@ class Accounting(object):
 		else:
 			# XXXstroucki: ThreadedServer is liable to have
 			# exceptions within if an endpoint is lost.
-			t = ThreadedServer(service=rpycservices.ManagerService, hostname='0.0.0.0', port=int(self.config.get('AccountingService', 'port')), auto_register=False)
+			t = createServer(rpycservices.ManagerService, self.config, 'AccountingService')
 
-		t.logger.setLevel(logging.ERROR)
 		t.service.service = service
 		t.service._type = 'AccountingService'
 
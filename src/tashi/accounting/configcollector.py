@@ -23,7 +23,8 @@ import time
 
 from tashi.rpycservices import rpyctypes as types
 
-from tashi import createClient
+from tashi import createClient, StateMirror
+from tashi.events import createEventSubscriber
 
 """
 Configuration collector for vQuery-style configuration changes
@@ -33,6 +34,8 @@ class RPCTypeEncoder(json.JSONEncoder):
 	"""Encode RPyC types as deltas for configuration change collection"""
 	###XXX: this is something of a hack; probably shouldn't really use __dict__ ?
 	def default(self, o):
+		if hasattr(o, "toDict"):
+			return o.toDict()
 		return o.__dict__
 
 	def get_uid(self, o):
@@ -142,8 +145,11 @@ class ConfigCollector(object):
 		self.pollSleep = self.config.getint(ConfigCollector.CFGNAME, "pollSleep")
 
 		self.cm = createClient(config)
+		self.instanceMirror = StateMirror("Instances")
+		self.hostMirror = StateMirror("Hosts")
 
 		self.smap = StateMap(RPCTypeEncoder())
+		self.events = createEventSubscriber(config)
 
 		threading.Thread(target=self.__start).start()
 
@@ -155,8 +161,8 @@ class ConfigCollector(object):
 				deltas = []
 				
 				#update map with all objects in system state
-				deltas.extend(self.smap.recv_list(self.cm.getInstances()))
-				deltas.extend(self.smap.recv_list(self.cm.getHosts()))
+				deltas.extend(self.smap.recv_list(self.instanceMirror.refresh(self.cm).values()))
+				deltas.extend(self.smap.recv_list(self.hostMirror.refresh(self.cm).values()))
 				#TODO: add other types
 
 				deltas.extend(self.smap.end_recv())
@@ -167,4 +173,7 @@ class ConfigCollector(object):
 				self.log.warning("ConfigCollector iteration failed: %s" % (sys.exc_info()[0]))
 
 			# wait to do the next iteration
-			time.sleep(self.pollSleep)
+			if self.events is not None:
+				self.events.wait(self.pollSleep)
+			else:
+				time.sleep(self.pollSleep)
@@ -0,0 +1,245 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import collections
+import logging
+import os
+import threading
+import time
+
+class AccountingShipper(object):
+	"""Sends accounting lines to the accounting server from a background
+	   thread, so that recording a line never waits on the network.
+
+	   Lines are queued in memory, up to queueSize of them, and sent in
+	   batches of batchSize, or every flushInterval seconds if fewer are
+	   waiting. Batches that cannot be sent are appended to spillFile,
+	   and later lines follow them there so the order is kept. The
+	   file is sent again every retryInterval seconds until it has all
+	   gone through. Lines are dropped, and counted, when the memory
+	   queue is full or the file would grow beyond maxSpillBytes."""
+
+	def __init__(self, client, queueSize=10000, batchSize=100, flushInterval=5.0, spillFile=None, maxSpillBytes=64*1024*1024, retryInterval=30.0):
+		self.log = logging.getLogger(__name__)
+		self.client = client
+		self.queueSize = queueSize
+		self.batchSize = batchSize
+		self.flushInterval = flushInterval
+		self.spillFile = spillFile
+		self.maxSpillBytes = maxSpillBytes
+		self.retryInterval = retryInterval
+		self.queue = collections.deque()
+		self.cv = threading.Condition()
+		self.stopping = False
+		self.nextRetry = 0
+		self.shipped = 0
+		self.dropped = 0
+		self.failures = 0
+		self.spilled = 0
+		self.lastError = None
+		self.lastShipped = None
+		if self.spillFile is not None and os.path.exists(self.spillFile):
+			# left over from before a restart
+			self.spilled = self.__countSpilled()
+		self.thread = threading.Thread(name="accountingShipper", target=self.__run)
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def record(self, line):
+		"""Queues a line to be sent"""
+		self.cv.acquire()
+		try:
+			if len(self.queue) >= self.queueSize:
+				self.__drop(1, "queue is full")
+				return
+			self.queue.append(line)
+			if len(self.queue) >= self.batchSize:
+				self.cv.notify()
+		finally:
+			self.cv.release()
+
+	def stop(self, timeout=None):
+		"""Stops the shipper, waiting up to timeout seconds for the
+		   queued lines to be sent or spilled"""
+		self.cv.acquire()
+		self.stopping = True
+		self.cv.notify()
+		self.cv.release()
+		self.thread.join(timeout)
+
+	def stats(self):
+		self.cv.acquire()
+		try:
+			return {'queued': len(self.queue), 'queueSize': self.queueSize, 'shipped': self.shipped, 'dropped': self.dropped, 'spilled': self.spilled, 'failures': self.failures, 'lastError': self.lastError, 'lastShipped': self.lastShipped}
+		finally:
+			self.cv.release()
+
+	def __drop(self, count, reason):
+		# expects self.cv to be held
+		if self.dropped == 0 or (self.dropped // 1000) != ((self.dropped + count) // 1000):
+			self.log.warning("Dropping accounting data, %s (%d lines dropped so far)" % (reason, self.dropped + count))
+		self.dropped += count
+
+	def __run(self):
+		while True:
+			self.cv.acquire()
+			try:
+				deadline = time.time() + self.flushInterval
+				while len(self.queue) < self.batchSize and not self.stopping:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						break
+					self.cv.wait(remaining)
+				batch = []
+				while len(self.queue) > 0 and len(batch) < self.batchSize:
+					batch.append(self.queue.popleft())
+				stopping = self.stopping
+				more = len(self.queue) > 0
+			finally:
+				self.cv.release()
+
+			try:
+				self.__flush(batch)
+			except Exception:
+				self.log.exception("Accounting shipper failed")
+			if stopping and not more:
+				return
+
+	def __send(self, lines):
+		try:
+			self.client.record(lines)
+		except Exception, e:
+			self.cv.acquire()
+			self.failures += 1
+			self.lastError = str(e)
+			self.cv.release()
+			if self.nextRetry == 0:
+				self.log.warning("Could not send accounting data: %s" % (e))
+			self.nextRetry = time.time() + self.retryInterval
+			return False
+		self.cv.acquire()
+		self.shipped += len(lines)
+		self.lastShipped = time.time()
+		self.cv.release()
+		if self.nextRetry != 0:
+			self.log.info("Sending accounting data again")
+		self.nextRetry = 0
+		return True
+
+	def __flush(self, batch):
+		if self.spilled > 0:
+			# keep the order, older lines are on disk
+			self.__spill(batch)
+			if time.time() >= self.nextRetry:
+				self.__replay()
+			return
+		if len(batch) == 0:
+			return
+		if not self.__send(batch):
+			self.__spill(batch)
+
+	def __spill(self, lines):
+		if len(lines) == 0:
+			return
+		if self.spillFile is None:
+			self.cv.acquire()
+			self.__drop(len(lines), "accounting server unreachable")
+			self.cv.release()
+			return
+		data = "".join([line.encode("string_escape") + "\n" for line in lines])
+		try:
+			size = 0
+			if os.path.exists(self.spillFile):
+				size = os.path.getsize(self.spillFile)
+			if size + len(data) > self.maxSpillBytes:
+				self.cv.acquire()
+				self.__drop(len(lines), "%s is full" % (self.spillFile))
+				self.cv.release()
+				return
+			f = open(self.spillFile, "a")
+			try:
+				f.write(data)
+			finally:
+				f.close()
+		except IOError, e:
+			self.cv.acquire()
+			self.__drop(len(lines), "cannot write %s: %s" % (self.spillFile, e))
+			self.cv.release()
+			return
+		self.cv.acquire()
+		self.spilled += len(lines)
+		self.cv.release()
+
+	def __countSpilled(self):
+		f = open(self.spillFile, "r")
+		try:
+			count = 0
+			for __line in f:
+				count += 1
+			return count
+		finally:
+			f.close()
+
+	def __replay(self):
+		try:
+			f = open(self.spillFile, "r")
+		except IOError:
+			self.log.warning("%s has gone away" % (self.spillFile))
+			self.cv.acquire()
+			self.spilled = 0
+			self.cv.release()
+			return
+		try:
+			lines = [line[:-1].decode("string_escape") for line in f]
+		finally:
+			f.close()
+
+		sent = 0
+		while sent < len(lines):
+			batch = lines[sent:sent + self.batchSize]
+			if not self.__send(batch):
+				break
+			sent += len(batch)
+
+		if sent == len(lines):
+			os.unlink(self.spillFile)
+		elif sent > 0:
+			# keep what was not sent
+			tempfile = "%s.new" % (self.spillFile)
+			f = open(tempfile, "w")
+			try:
+				f.write("".join([line.encode("string_escape") + "\n" for line in lines[sent:]]))
+			finally:
+				f.close()
+			os.rename(tempfile, self.spillFile)
+		self.cv.acquire()
+		self.spilled = len(lines) - sent
+		self.cv.release()
+
+def createAccountingShipper(client, config, section):
+	"""Returns an AccountingShipper for client, with the accounting*
+	   settings of the given config section"""
+	spillFile = config.get(section, 'accountingSpillFile', None)
+	if spillFile is not None and spillFile.strip() == "":
+		spillFile = None
+	return AccountingShipper(client,
+		queueSize=config.getint(section, 'accountingQueueSize', 10000),
+		batchSize=config.getint(section, 'accountingBatchSize', 100),
+		flushInterval=float(config.get(section, 'accountingFlushInterval', 5.0)),
+		spillFile=spillFile,
+		maxSpillBytes=config.getint(section, 'accountingMaxSpillBytes', 64*1024*1024),
+		retryInterval=float(config.get(section, 'accountingRetryInterval', 30.0)))
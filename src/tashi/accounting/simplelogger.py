@@ -19,7 +19,7 @@ import logging
 import threading
 import time
 
-from tashi import createClient
+from tashi import createClient, StateMirror
 
 class SimpleLogger(object):
 	"""Simple logger of all VMs the clustermanager knows of"""
@@ -42,12 +42,13 @@ class SimpleLogger(object):
 			self.pollSleep = 600
 
 		self.cm = createClient(config)
+		self.instanceMirror = StateMirror("Instances")
 		threading.Thread(target=self.__start).start()
 
 	def __start(self):
 		while True:
 			try:
-				instances = self.cm.getInstances()
+				instances = self.instanceMirror.refresh(self.cm).values()
 				for instance in instances:
 					self.log.info('Accounting: id %s host %s vmId %s user %s cores %s memory %s' % (instance.id, instance.hostId, instance.vmId, instance.userId, instance.cores, instance.memory))
 			except:
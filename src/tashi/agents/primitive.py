@@ -23,8 +23,9 @@ import sys
 
 from tashi.rpycservices.rpyctypes import Errors, HostState, InstanceState, TashiException
 
-from tashi.util import createClient, instantiateImplementation, boolean
+from tashi.util import createClient, instantiateImplementation, boolean, StateMirror
 from tashi.utils.config import Config
+from tashi.events import createEventSubscriber
 import tashi
 
 class Primitive(object):
@@ -48,9 +49,14 @@ class Primitive(object):
 		self.hosts = {}
 		self.load = {}
 		self.instances = {}
+		# copies of the CM's state, updated with what changed
+		self.hostMirror = StateMirror("Hosts")
+		self.instanceMirror = StateMirror("Instances")
 		self.muffle = {}
 		self.lastScheduledHost = 0
 		self.clearHints = {}
+		# wake up early for changes that may let a VM be scheduled
+		self.events = createEventSubscriber(config, {'types': ['instanceAdded', 'instanceState', 'instanceRemoved', 'hostAdded', 'hostUp', 'hostDown']})
 					
 					
 	def __getState(self):
@@ -61,7 +67,12 @@ class Primitive(object):
 		load = {}
 		ctr = 0
 
-		for h in self.cm.getHosts():
+		# fetch changes to both lists in one round trip
+		(_hosts, _instances) = self.cm.batch([self.hostMirror.request(), self.instanceMirror.request()])
+		_hosts = self.hostMirror.update(_hosts).values()
+		_instances = self.instanceMirror.update(_instances).values()
+
+		for h in _hosts:
 			#XXXstroucki get all hosts here?
 			#if (self.__isReady(h)):
 			hosts[ctr] = h
@@ -69,7 +80,6 @@ class Primitive(object):
 			load[h.id] = []
 			
 		load[None] = []
-		_instances = self.cm.getInstances()
 		instances = {}
 		for i in _instances:
 			instances[i.id] = i
@@ -231,6 +241,10 @@ class Primitive(object):
 					if e.errno == Errors.HostStateError:
 						self.clearHints["targetHost"] = self.clearHints.get("targetHost", [])
 						self.clearHints["targetHost"].append(targetHost)
+					elif e.errno == Errors.InsufficientCapacity:
+						# our idea of the host's load is out of date,
+						# try again on the next pass
+						self.log.info("Instance %s did not fit on host %s: %s" % (inst.name, minMaxHost.name, e.msg))
 
 			else:
 				# did not find a host
@@ -250,8 +264,8 @@ class Primitive(object):
 		# XXXstroucki: scheduling races have been observed, where
 		# a vm is scheduled on a host that had not updated its
 		# capacity with the clustermanager, leading to overloaded
-		# hosts. I think the place to insure against this happening
-		# is in the nodemanager. This scheduler will keep an
+		# hosts. The clustermanager now refuses activations that
+		# would overcommit a host. This scheduler will keep an
 		# internal state of cluster loading, but that is best
 		# effort and will be refreshed from CM once the buffer
 		# of vms to be scheduled is exhausted.
@@ -296,7 +310,10 @@ class Primitive(object):
 
 
 			# wait to do the next iteration
-			time.sleep(self.scheduleDelay)
+			if (self.events is not None):
+				self.events.wait(self.scheduleDelay)
+			else:
+				time.sleep(self.scheduleDelay)
 
 def main():
 	config = Config(["Agent"])
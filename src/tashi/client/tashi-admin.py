@@ -185,6 +185,67 @@ def getReservation(args):
 	print rv
 	return 0
 
+def evacuateHost(args):
+	global scriptname
+	parser = optparse.OptionParser()
+	parser.set_usage("%s evacuateHost [options]" % scriptname)
+	parser.add_option("--host", help="Move all VMs off this host (mandatory)", action="store", type="string", dest="hostname")
+	parser.add_option("--to", help="Only move VMs to these hosts, separated by commas", action="store", type="string", dest="destinations")
+	parser.add_option("--retries", help="Try a failed migration this many more times", action="store", type="int", dest="retries")
+	parser.add_option("--parallel", help="Run at most this many migrations at once", action="store", type="int", dest="parallel")
+	parser.add_option("--no-suspend", help="Do not suspend and resume VMs that fail to migrate", action="store_true", dest="nosuspend", default=False)
+	(options, arguments) = parser.parse_args(args)
+	if options.hostname is None:
+		print "A mandatory option is missing\n"
+		parser.print_help()
+		sys.exit(-1)
+
+	hostId = checkHid(options.hostname)
+	policy = {}
+	if options.destinations is not None:
+		policy['destinations'] = [checkHid(h) for h in options.destinations.split(",")]
+	if options.retries is not None:
+		policy['retries'] = options.retries
+	if options.parallel is not None:
+		policy['maxPerSource'] = options.parallel
+	if options.nosuspend:
+		policy['fallback'] = None
+	rv = remoteCommand("evacuateHost", hostId, policy)
+	print rv
+	return 0
+
+def cancelEvacuation(args):
+	global scriptname
+	parser = optparse.OptionParser()
+	parser.set_usage("%s cancelEvacuation [options]" % scriptname)
+	parser.add_option("--host", help="Stop evacuating this host (mandatory)", action="store", type="string", dest="hostname")
+	(options, arguments) = parser.parse_args(args)
+	if options.hostname is None:
+		print "A mandatory option is missing\n"
+		parser.print_help()
+		sys.exit(-1)
+
+	hostId = checkHid(options.hostname)
+	rv = remoteCommand("cancelEvacuation", hostId)
+	print rv
+	return 0
+
+def getEvacuations(args):
+	global scriptname
+	parser = optparse.OptionParser()
+	parser.set_usage("%s getEvacuations [options]" % scriptname)
+	parser.add_option("--verbose", help="Show every VM", action="store_true", dest="verbose", default=False)
+	(options, arguments) = parser.parse_args(args)
+
+	rv = remoteCommand("getEvacuations")
+	for (hostId, progress) in rv.iteritems():
+		counts = ", ".join(["%d %s" % (count, state) for (state, count) in progress['counts'].iteritems()])
+		print "Host %s: %s (%s)" % (hostId, progress['state'], counts)
+		if options.verbose:
+			for (instanceId, entry) in progress['instances'].iteritems():
+				print "\t%s %s %s %s" % (entry['name'], entry['state'], entry['destination'] or "", entry['error'] or "")
+	return 0
+
 def help(args):
 	global scriptname
 	print "Available commands:"
@@ -217,6 +278,9 @@ cmdsdesc = (
 ('addReservation', 'Add a user to a host reservation'),
 ('delReservation', 'Remove a user from a host reservation'),
 ('getReservation', 'Retrieve host reservations'),
+("evacuateHost", "Move all VMs off a host"),
+("cancelEvacuation", "Stop moving VMs off a host"),
+("getEvacuations", "Show the progress of host evacuations"),
 ("help", "Get list of available commands"),
 )
 
@@ -228,6 +292,9 @@ cmds = {
 'addReservation': addReservation,
 'delReservation': delReservation,
 'getReservation': getReservation,
+'evacuateHost': evacuateHost,
+'cancelEvacuation': cancelEvacuation,
+'getEvacuations': getEvacuations,
 'help': help,
 }
 
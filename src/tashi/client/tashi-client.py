@@ -17,6 +17,7 @@
 # specific language governing permissions and limitations
 # under the License.    
 
+import copy
 import os.path
 import random
 import sys
@@ -190,6 +191,44 @@ def getVmLayout():
 			hosts[i.hostId].usedCores += i.cores
 	return hosts.values()
 
+class StatsRow(object):
+	def __init__(self, **kwargs):
+		self.__dict__.update(kwargs)
+
+def latencyPercentile(stats, buckets, fraction):
+	# upper bound of the histogram bucket holding the percentile
+	wanted = stats['calls'] * fraction
+	seen = 0
+	for i in range(0, len(buckets)):
+		seen += stats['histogram'][i]
+		if (seen >= wanted):
+			return "%.0f" % (buckets[i] * 1000.0)
+	return ">%.0f" % (buckets[-1] * 1000.0)
+
+def getRpcStats():
+	stats = client.getRpcStats()
+	buckets = stats['latencyBuckets']
+	rows = []
+	for (name, s) in stats['methods'].iteritems():
+		if (s['calls'] == 0):
+			rows.append(StatsRow(method=name, calls=0, errors=0, rejected=s.get('rejected', 0)))
+			continue
+		rows.append(StatsRow(method=name, calls=s['calls'], errors=s['errors'], rejected=s.get('rejected', 0), avgMs="%.1f" % (s['time'] * 1000.0 / s['calls']), p50Ms=latencyPercentile(s, buckets, 0.5), p99Ms=latencyPercentile(s, buckets, 0.99), maxMs="%.1f" % (s['maxTime'] * 1000.0), checkMs="%.1f" % (s['permissionTime'] * 1000.0 / s['calls']), inBytes=s['requestBytes'] / s['calls'], outBytes=s['responseBytes'] / s['calls']))
+	for (caller, s) in stats['callers'].iteritems():
+		row = StatsRow(method="caller %s" % (caller), calls=s['calls'], errors=s['errors'], rejected=s.get('rejected', 0))
+		if (s['calls'] > 0):
+			row.avgMs = "%.1f" % (s['time'] * 1000.0 / s['calls'])
+		rows.append(row)
+	return rows
+
+def getHostCapacity():
+	capacity = client.getHostCapacity()
+	rows = []
+	for (hostId, c) in capacity.iteritems():
+		rows.append(StatsRow(id=hostId, **c))
+	rows.sort(key=lambda row: row.id)
+	return rows
+
 def getSlots(cores, memory):
 	hosts = getVmLayout()
 	count = 0
@@ -224,8 +263,21 @@ def createMany(instance, count):
 		for nic in instance.nics:
 			nic.mac = randomMac()
 		instance.name = basename + (("-%" + str(l) + "." + str(l) + "d") % (i))
-		instances.append(client.createVm(instance))
-	return instances
+		instances.append(copy.deepcopy(instance))
+	try:
+		results = client.createVms(instances)
+	except AttributeError:
+		# older cluster manager
+		return [client.createVm(i) for i in instances]
+	created = []
+	for (i, rv) in zip(instances, results):
+		if isinstance(rv, TashiException):
+			print "Failed to create %s: %s" % (i.name, rv.msg)
+		elif isinstance(rv, Exception):
+			print "Failed to create %s: %s" % (i.name, rv)
+		else:
+			created.append(rv)
+	return created
 
 def shutdownMany(basename):
 	return __shutdownOrDestroyMany("shutdown", basename)
@@ -233,26 +285,59 @@ def shutdownMany(basename):
 def destroyMany(basename):
 	return __shutdownOrDestroyMany("destroy", basename)
 
+def __fnmatchEscape(name):
+	# match [, * and ? literally
+	return "".join([(c in "[*?") and "[%s]" % (c) or c for c in name])
+
 def __shutdownOrDestroyMany(method, basename):
+	if method == "shutdown":
+		rpc = "shutdownVm"
+	elif method == "destroy":
+		rpc = "destroyVm"
+	else:
+		raise ValueError("Unknown method")
+
+	# the cluster manager selects the VMs and works on them in parallel
+	selector = {'name': __fnmatchEscape(basename) + "-[0-9]*"}
+	userId = getUser()
+	# XXXstroucki uid 0 to have superuser access, as in checkIid
+	if (userId != 0):
+		selector['userId'] = userId
+	try:
+		results = getattr(client, rpc + "s")(selector)
+	except AttributeError:
+		# older cluster manager
+		results = None
+	if results is not None:
+		if (len(results) == 0):
+			raise TashiException({'msg':"%s is an unused basename" % basename})
+		for (__instanceId, name, rv) in results:
+			if isinstance(rv, TashiException):
+				print "Failed to %s %s: %s" % (method, name, rv.msg)
+			elif isinstance(rv, Exception):
+				print "Failed to %s %s: %s" % (method, name, rv)
+		return None
+
 	instances = client.getInstances()
-	count = 0
+	calls = []
+	names = []
 	for i in instances:
 		if (i.name.startswith(basename + "-") and i.name[len(basename) + 1].isdigit()):
 			# checking permissions here
 			checkIid(i.name)
+			calls.append((rpc, (i.id,)))
+			names.append(i.name)
 
-			if method == "shutdown":
-				client.shutdownVm(i.id)
-
-			elif method == "destroy":
-				client.destroyVm(i.id)
-
-			else:
-				raise ValueError("Unknown method")
-
-			count = count + 1
-	if (count == 0):
+	if (len(calls) == 0):
 		raise TashiException({'msg':"%s is an unused basename" % basename})
+
+	# send all requests in one round trip
+	results = client.batch(calls)
+	for (name, rv) in zip(names, results):
+		if isinstance(rv, TashiException):
+			print "Failed to %s %s: %s" % (method, name, rv.msg)
+		elif isinstance(rv, Exception):
+			print "Failed to %s %s: %s" % (method, name, rv)
 	return None
 
 def getMyInstances():
@@ -276,6 +361,8 @@ extraViews = {
 'shutdownMany': (shutdownMany, None),
 'destroyMany': (destroyMany, None),
 'getVmLayout': (getVmLayout, ['id', 'name', 'state', 'instances', 'usedMemory', 'memory', 'usedCores', 'cores']),
+'getHostCapacity': (getHostCapacity, ['id', 'name', 'instances', 'usedMemory', 'memory', 'usedCores', 'cores', 'disks']),
+'getRpcStats': (getRpcStats, ['method', 'calls', 'errors', 'rejected', 'avgMs', 'p50Ms', 'p99Ms', 'maxMs', 'checkMs', 'inBytes', 'outBytes']),
 'getInstances': (None, ['id', 'hostId', 'name', 'user', 'state', 'disk', 'memory', 'cores']),
 'getMyInstances': (getMyInstances, ['id', 'hostId', 'name', 'user', 'state', 'disk', 'memory', 'cores'])
 }
@@ -304,6 +391,8 @@ argLists = {
 'getInstances': [],
 'getMyInstances': [],
 'getVmLayout': [],
+'getHostCapacity': [],
+'getRpcStats': [],
 'vmmSpecificCall': [('instance', checkIid, lambda: requiredArg('instance'), True), ('arg', str, lambda: requiredArg('arg'), True)],
 }
 
@@ -347,6 +436,8 @@ description = {
 'getInstances': 'Gets a list of all VMs in the cluster',
 'getMyInstances': 'Utility function that only lists VMs owned by the current user',
 'getVmLayout': 'Utility function that displays what VMs are placed on what hosts',
+'getHostCapacity': 'Shows the memory and cores the cluster manager has committed on each host',
+'getRpcStats': 'Shows call counts, latency in milliseconds and average payload sizes per RPC and per caller of the cluster manager',
 'vmmSpecificCall': 'Direct access to VM manager specific functionality',
 'getImages' : 'Gets a list of available VM images',
 'copyImage' : 'Copies a VM image',
@@ -374,6 +465,8 @@ examples = {
 'getInstances': [''],
 'getMyInstances': [''],
 'getVmLayout': [''],
+'getHostCapacity': [''],
+'getRpcStats': [''],
 'getImages': [''],
 'copyImage': ['--src src.qcow2 --dst dst.qcow2'],
 'cloneImage': ['--src src.qcow2 --dst dst-clone.qcow2'],
@@ -443,10 +536,19 @@ def transformState(obj):
 		except:
 			obj.state = 'Unknown'
 
+def attributes(obj):
+	"""Returns the attributes of an RPC object as a dict, or None for simple types"""
+	if (hasattr(obj, "toDict")):
+		# fields are in slots, anything added here is in __dict__
+		d = obj.toDict()
+		d.update(obj.__dict__)
+		return d
+	return getattr(obj, "__dict__", None)
+
 def genKeys(_list):
 	keys = {}
 	for row in _list:
-		for item in row.__dict__.keys():
+		for item in attributes(row).keys():
 			keys[item] = item
 	if ('id' in keys):
 		del keys['id']
@@ -483,9 +585,10 @@ def makeTable(_list, keys=None):
 	for k in keys:
 		maxWidth[k] = len(k)
 	for row in _list:
+		rowAttributes = attributes(row)
 		for k in keys:
-			if (k in row.__dict__):
-				maxWidth[k] = max(maxWidth[k], len(str(row.__dict__[k])))
+			if (k in rowAttributes):
+				maxWidth[k] = max(maxWidth[k], len(str(rowAttributes[k])))
 	if (keys == []):
 		return
 	totalWidth = reduce(lambda x, y: x + y + 1, maxWidth.values(), 0)
@@ -507,8 +610,8 @@ def makeTable(_list, keys=None):
 		line += ("-" * (maxWidth[k] + 1))
 	print line
 	def sortFunction(a, b):
-		av = a.__dict__[keys[0]]
-		bv = b.__dict__[keys[0]]
+		av = getattr(a, keys[0])
+		bv = getattr(b, keys[0])
 		if (av < bv):
 			return -1
 		elif (av > bv):
@@ -518,18 +621,19 @@ def makeTable(_list, keys=None):
 	_list.sort(cmp=sortFunction)
 	for row in _list:
 		line = ""
+		rowAttributes = attributes(row)
 		for k in keys:
-			row.__dict__[k] = row.__dict__.get(k, "")
-			if (len(str(row.__dict__[k])) > maxWidth[k]):
-				line += (" %-" + str(maxWidth[k] - 3) + "." + str(maxWidth[k] - 3) + "s...") % (str(row.__dict__[k]))
+			setattr(row, k, rowAttributes.get(k, ""))
+			if (len(str(getattr(row, k))) > maxWidth[k]):
+				line += (" %-" + str(maxWidth[k] - 3) + "." + str(maxWidth[k] - 3) + "s...") % (str(getattr(row, k)))
 			else:
-				line += (" %-" + str(maxWidth[k]) + "." + str(maxWidth[k]) + "s") % (str(row.__dict__[k]))
+				line += (" %-" + str(maxWidth[k]) + "." + str(maxWidth[k]) + "s") % (str(getattr(row, k)))
 		print line
 		
 def simpleType(obj):
 	"""Determines whether an object is a simple type -- used as a helper function to pprint"""
 	if (type(obj) is not types.ListType):
-		if (not getattr(obj, "__dict__", None)):
+		if (not attributes(obj)):
 			return True
 	return False
 
@@ -550,12 +654,12 @@ def pprint(obj, depth=0, key=None):
 			for o in obj:
 				pprint(o, depth + 1)
 			print (" " * (depth * INDENT)) + "]"
-	elif (getattr(obj, "__dict__", None)):
-		if (reduce(lambda x, y: x and simpleType(y), obj.__dict__.itervalues(), True)):
+	elif (attributes(obj)):
+		if (reduce(lambda x, y: x and simpleType(y), attributes(obj).itervalues(), True)):
 			print (" " * (depth * INDENT)) + keyString + str(obj)
 		else:
 			print (" " * (depth * INDENT)) + keyString + "{"
-			for (k, v) in obj.__dict__.iteritems():
+			for (k, v) in attributes(obj).iteritems():
 				pprint(v, depth + 1, k)
 			print (" " * (depth * INDENT)) + "}"
 	else:
@@ -0,0 +1,170 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+from tashi.rpycservices.rpyctypes import Errors, InstanceState, TashiException
+
+class CapacityLedger(object):
+	"""Keeps the memory, cores and disks committed to instances on each
+	   host. An instance counts against the host in its hostId, as the
+	   scheduler counts it, from the time it is admitted until it leaves
+	   the host or exits. The ledger follows the data layer as a change
+	   listener, so it is adjusted with every instance change rather
+	   than recomputed from all instances."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		# instanceId -> (hostId, memory, cores, disks)
+		self.commitments = {}
+		# instanceId -> (hostId, memory, cores, disks) for instances
+		# on their way to another host
+		self.reservations = {}
+		# hostId -> [memory, cores, disks, instances]
+		self.used = {}
+
+	def __demand(self, instance):
+		if instance.hostId is None or instance.state == InstanceState.Exited:
+			return None
+		return (instance.hostId, instance.memory, instance.cores, len(instance.disks or []))
+
+	def __add(self, entry, sign):
+		# expects self.lock to be held
+		used = self.used.setdefault(entry[0], [0, 0, 0, 0])
+		used[0] += sign * entry[1]
+		used[1] += sign * entry[2]
+		used[2] += sign * entry[3]
+		used[3] += sign
+		if used[3] == 0:
+			del self.used[entry[0]]
+
+	def __commit(self, instanceId, commitment):
+		# expects self.lock to be held
+		old = self.commitments.pop(instanceId, None)
+		if old is not None:
+			self.__add(old, -1)
+		if commitment is not None:
+			self.commitments[instanceId] = commitment
+			self.__add(commitment, 1)
+			reservation = self.reservations.get(instanceId, None)
+			if reservation is not None and reservation[0] == commitment[0]:
+				# it has arrived
+				self.__unreserve(instanceId)
+
+	def __unreserve(self, instanceId):
+		# expects self.lock to be held
+		reservation = self.reservations.pop(instanceId, None)
+		if reservation is not None:
+			self.__add(reservation, -1)
+
+	def update(self, generation, kind, change, old, new):
+		"""Change listener for the data layer"""
+		if kind != 'instances':
+			return
+		self.lock.acquire()
+		try:
+			if change == 'removed':
+				self.__commit(old.id, None)
+				self.__unreserve(old.id)
+			else:
+				self.__commit(new.id, self.__demand(new))
+		finally:
+			self.lock.release()
+
+	def rebuild(self, instances):
+		self.lock.acquire()
+		try:
+			self.commitments = {}
+			self.used = {}
+			for instance in instances:
+				self.__commit(instance.id, self.__demand(instance))
+			for (instanceId, reservation) in self.reservations.items():
+				if instanceId in self.commitments:
+					self.__add(reservation, 1)
+				else:
+					del self.reservations[instanceId]
+		finally:
+			self.lock.release()
+
+	def __check(self, instance, host):
+		# expects self.lock to be held
+		(memory, cores, __disks, __count) = self.used.get(host.id, (0, 0, 0, 0))
+		for old in (self.commitments.get(instance.id, None), self.reservations.get(instance.id, None)):
+			if old is not None and old[0] == host.id:
+				# already counted here
+				memory -= old[1]
+				cores -= old[2]
+		freeMemory = host.memory - memory
+		freeCores = host.cores - cores
+		if instance.memory > freeMemory or instance.cores > freeCores:
+			raise TashiException(d={'errno':Errors.InsufficientCapacity,'msg':"Host %s has %d MB and %d cores free, %s needs %d MB and %d cores" % (host.name, freeMemory, freeCores, instance.name, instance.memory, instance.cores)})
+
+	def check(self, instance, host):
+		"""Raises TashiException with Errors.InsufficientCapacity if
+		   instance does not fit on host"""
+		self.lock.acquire()
+		try:
+			self.__check(instance, host)
+		finally:
+			self.lock.release()
+
+	def admit(self, instance, host):
+		"""Like check, but if the instance fits its resources are
+		   committed to host straight away, so that concurrent
+		   admissions see them. Call with the instance acquired, and
+		   release it with hostId set to host.id, or to None if the
+		   admission is given up."""
+		self.lock.acquire()
+		try:
+			self.__check(instance, host)
+			self.__commit(instance.id, (host.id, instance.memory, instance.cores, len(instance.disks or [])))
+		finally:
+			self.lock.release()
+
+	def reserve(self, instance, host):
+		"""Like check, but if the instance fits its resources are set
+		   aside on host, in addition to those it uses where it is, until
+		   it arrives there or unreserve is called"""
+		self.lock.acquire()
+		try:
+			self.__check(instance, host)
+			self.__unreserve(instance.id)
+			reservation = (host.id, instance.memory, instance.cores, len(instance.disks or []))
+			self.reservations[instance.id] = reservation
+			self.__add(reservation, 1)
+		finally:
+			self.lock.release()
+
+	def unreserve(self, instanceId):
+		self.lock.acquire()
+		try:
+			self.__unreserve(instanceId)
+		finally:
+			self.lock.release()
+
+	def getCapacity(self, hosts):
+		"""Returns a dict by host id of the capacity and committed
+		   resources of the given hosts"""
+		capacity = {}
+		self.lock.acquire()
+		try:
+			for host in hosts:
+				(memory, cores, disks, count) = self.used.get(host.id, (0, 0, 0, 0))
+				capacity[host.id] = {'name': host.name, 'memory': host.memory, 'cores': host.cores, 'usedMemory': memory, 'usedCores': cores, 'freeMemory': host.memory - memory, 'freeCores': host.cores - cores, 'disks': disks, 'instances': count}
+		finally:
+			self.lock.release()
+		return capacity
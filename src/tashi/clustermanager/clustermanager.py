@@ -18,6 +18,7 @@
 # under the License.    
 
 import os
+import signal
 import sys
 import logging.config
 
@@ -26,7 +27,7 @@ from tashi.utils.config import Config
 import tashi
 
 from tashi.rpycservices import rpycservices
-from rpyc.utils.server import ThreadedServer
+from tashi.rpycservices.poolserver import createServer
 from rpyc.utils.authenticators import TlsliteVdbAuthenticator
 
 log = None
@@ -47,19 +48,23 @@ def startClusterManager(config):
 		users[config.get('AllowedUsers', 'nodeManagerUser')] = config.get('AllowedUsers', 'nodeManagerPassword')
 		users[config.get('AllowedUsers', 'agentUser')] = config.get('AllowedUsers', 'agentPassword')
 		authenticator = TlsliteVdbAuthenticator.from_dict(users)
-
-		# XXXstroucki ThreadedServer is liable to have exceptions
-		# occur within if an endpoint is lost.
-		t = ThreadedServer(service=rpycservices.ManagerService, hostname='0.0.0.0', port=int(config.get('ClusterManagerService', 'port')), auto_register=False, authenticator=authenticator)
 	else:
-		t = ThreadedServer(service=rpycservices.ManagerService, hostname='0.0.0.0', port=int(config.get('ClusterManagerService', 'port')), auto_register=False)
-	t.logger.setLevel(logging.ERROR)
+		authenticator = None
+
+	# XXXstroucki ThreadedServer is liable to have exceptions
+	# occur within if an endpoint is lost.
+	t = createServer(rpycservices.ManagerService, config, 'ClusterManagerService', authenticator=authenticator)
 	t.service.service = service
 	t.service._type = 'ClusterManagerService'
 
 	debugConsole(globals())
 
-	t.start()
+	# unwind through the cleanup below on SIGTERM as on SIGINT
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		t.start()
+	finally:
+		service.stop()
 	# shouldn't exit by itself
 	return
 
@@ -15,6 +15,8 @@
 # specific language governing permissions and limitations
 # under the License.	
 
+import fnmatch
+import heapq
 import logging
 import threading
 import time
@@ -22,6 +24,13 @@ import time
 from tashi.rpycservices.rpyctypes import Errors, InstanceState, Instance, HostState, TashiException
 from tashi import boolean, ConnectionManager, vmStates, hostStates, version, scrubString
 from tashi.dfs.diskimage import QemuImage
+from tashi.events import EventServer
+from tashi.clustermanager.capacity import CapacityLedger
+from tashi.clustermanager.evacuation import Evacuation, MigrationSlots
+from tashi.accounting.shipper import createAccountingShipper
+from tashi.rpycservices.rpycservices import rpcStats
+from tashi.parallel import ThreadPool
+from tashi.utils.timeout import TimeoutException
 
 class ClusterManagerService(object):
 	"""RPC service for the ClusterManager"""
@@ -36,14 +45,31 @@ class ClusterManagerService(object):
 		else:
 			self.username = None
 			self.password = None
-		self.proxy = ConnectionManager(self.username, self.password, int(self.config.get('ClusterManager', 'nodeManagerPort')), authAndEncrypt=self.authAndEncrypt)
+		maxConnectionsPerHost = self.config.getint('ClusterManagerService', 'maxConnectionsPerHost', 4)
+		connectionIdleTimeout = float(self.config.get('ClusterManagerService', 'connectionIdleTimeout', 60.0))
+		# ConnectionManager takes milliseconds
+		nodeManagerTimeout = float(self.config.get('ClusterManagerService', 'nodeManagerTimeout', 10.0)) * 1000.0
+		self.proxy = ConnectionManager(self.username, self.password, int(self.config.get('ClusterManager', 'nodeManagerPort')), timeout=nodeManagerTimeout, authAndEncrypt=self.authAndEncrypt, maxConnections=maxConnectionsPerHost, idleTimeout=connectionIdleTimeout)
 		self.dfs = dfs
 		self.convertExceptions = boolean(config.get('ClusterManagerService', 'convertExceptions'))
 		self.log = logging.getLogger(__name__)
 		self.log.setLevel(logging.ERROR)
 		self.hostLastContactTime = {}
+		# (time, hostId) for each host in hostLastContactTime. An
+		# entry is moved on when it comes up and the host has been
+		# heard from since, see __expiredHosts
+		self.hostExpiry = []
+		self.hostExpiryArmed = set()
+		self.hostExpiryLock = threading.Lock()
 		#self.hostLastUpdateTime = {}
 		self.instanceLastContactTime = {}
+		# hostId -> (time, {instanceId: digest}) from the last
+		# registerNodeManagerDigest
+		self.hostDigests = {}
+		# instanceId -> generation last reported by the NM, and
+		# the one reported when the CM last fetched the VM
+		self.reportedGenerations = {}
+		self.syncedGenerations = {}
 		self.expireHostTime = float(self.config.get('ClusterManagerService', 'expireHostTime'))
 		self.allowDecayed = float(self.config.get('ClusterManagerService', 'allowDecayed'))
 		self.allowMismatchedVersions = boolean(self.config.get('ClusterManagerService', 'allowMismatchedVersions'))
@@ -54,6 +80,22 @@ class ClusterManagerService(object):
 
 		self.allowDuplicateNames = boolean(self.config.get('ClusterManagerService', 'allowDuplicateNames'))
 
+		# hosts are reconciled in parallel, each within a deadline
+		self.reconcilePool = ThreadPool(size=self.config.getint('ClusterManagerService', 'reconcileWorkers', 16))
+		self.reconcileHostTimeout = float(self.config.get('ClusterManagerService', 'reconcileHostTimeout', 20.0))
+		self.lastReconcile = None
+		# hosts not heard from are asked if they are alive,
+		# several at a time, with a short timeout
+		liveCheckTimeout = float(self.config.get('ClusterManagerService', 'liveCheckTimeout', 2.0))
+		self.liveCheckProxy = ConnectionManager(self.username, self.password, int(self.config.get('ClusterManager', 'nodeManagerPort')), timeout=liveCheckTimeout * 1000.0, authAndEncrypt=self.authAndEncrypt, maxConnections=1, idleTimeout=connectionIdleTimeout)
+		self.liveCheckTimeout = liveCheckTimeout
+		# the node manager sending a VM answers when it has gone
+		migrationTimeout = float(self.config.get('ClusterManagerService', 'migrationTimeout', 600.0))
+		self.migrationProxy = ConnectionManager(self.username, self.password, int(self.config.get('ClusterManager', 'nodeManagerPort')), timeout=migrationTimeout * 1000.0, authAndEncrypt=self.authAndEncrypt, maxConnections=maxConnectionsPerHost, idleTimeout=connectionIdleTimeout)
+		# VMs selected by the *Vms RPCs are acted on by at most
+		# bulkWorkers threads
+		self.bulkPool = ThreadPool(size=self.config.getint('ClusterManagerService', 'bulkWorkers', 32))
+
 		self.accountingHost = None
 		self.accountingPort = None
 		try:
@@ -62,24 +104,53 @@ class ClusterManagerService(object):
 		except:
 			pass
 
+		# memory and cores committed on each host, checked
+		# before a VM is placed there
+		self.checkCapacity = boolean(self.config.get('ClusterManagerService', 'checkCapacity', True))
+		self.capacity = CapacityLedger()
+		self.data.addChangeListener(self.capacity.update)
+		self.capacity.rebuild(self.data.getInstances().itervalues())
+
+		# hostId -> Evacuation, kept after they finish for
+		# getEvacuations
+		self.evacuations = {}
+		self.evacuationsLock = threading.Lock()
+		self.migrationSlots = MigrationSlots(max(1, self.config.getint('ClusterManagerService', 'evacuateMaxPerDestination', 2)))
+
 		self.__initAccounting()
 		self.__initCluster()
 
+		# push changes to agents instead of having them poll
+		self.events = None
+		eventPort = self.config.getint('ClusterManagerService', 'eventPort', 0)
+		if eventPort > 0:
+			eventHost = self.config.get('ClusterManagerService', 'eventHost', 'localhost')
+			eventQueueSize = self.config.getint('ClusterManagerService', 'eventQueueSize', 1000)
+			eventMaxSubscribers = self.config.getint('ClusterManagerService', 'eventMaxSubscribers', 100)
+			self.events = EventServer(eventHost, eventPort, self.data.getGeneration, maxQueue=eventQueueSize, maxSubscribers=eventMaxSubscribers)
+			self.data.addChangeListener(self.events.publish)
+
 		threading.Thread(name="monitorCluster", target=self.__monitorCluster).start()
 
 		self.qemuImage = QemuImage(self.config)
 
 	def __initAccounting(self):
-		self.accountBuffer = []
-		self.accountLines = 0
-		self.accountingClient = None
+		self.accounting = None
 		try:
 			if (self.accountingHost is not None) and \
 					(self.accountingPort is not None):
-				self.accountingClient = ConnectionManager(self.username, self.password, self.accountingPort)[self.accountingHost]
+				accountingClient = ConnectionManager(self.username, self.password, self.accountingPort)[self.accountingHost]
+				self.accounting = createAccountingShipper(accountingClient, self.config, 'ClusterManagerService')
+				rpcStats.addGauge('accounting', self.accounting.stats)
 		except:
 			self.log.exception("Could not init accounting")
 
+	def stop(self):
+		"""Sends, or spills, the accounting lines still queued. Called
+		   when the server exits."""
+		if (self.accounting is not None):
+			self.accounting.stop(10.0)
+
 	def __initCluster(self):
 		# initialize state of VMs if restarting
 		for instance in self.data.getInstances().itervalues():
@@ -104,17 +175,7 @@ class ClusterManagerService(object):
 
 
 
-	def __ACCOUNTFLUSH(self):
-		try:
-			if (self.accountingClient is not None):
-				self.accountingClient.record(self.accountBuffer)
-			self.accountLines = 0
-			self.accountBuffer = []
-		except:
-			self.log.exception("Failed to flush accounting data")
-
-
-	def __ACCOUNT(self, text, instance=None, host=None):
+	def __ACCOUNT(self, text, instance=None, host=None, instances=None):
 		now = self.__now()
 		instanceText = None
 		hostText = None
@@ -125,6 +186,12 @@ class ClusterManagerService(object):
 			except:
 				self.log.exception("Invalid instance data")
 
+		if instances is not None:
+			try:
+				instanceText = ','.join(['Instance(%s)' % (i) for i in instances])
+			except:
+				self.log.exception("Invalid instance data")
+
 		if host is not None:
 			try:
 				hostText = "Host(%s)" % (host)
@@ -135,12 +202,9 @@ class ClusterManagerService(object):
 
 		line = "%s|%s|%s" % (now, text, secondary)
 
-		self.accountBuffer.append(line)
-		self.accountLines += 1
-
-		# XXXstroucki think about autoflush by time
-		if (self.accountLines > 0):
-			self.__ACCOUNTFLUSH()
+		# sent in the background, in batches
+		if (self.accounting is not None):
+			self.accounting.record(line)
 
 
 
@@ -161,6 +225,7 @@ class ClusterManagerService(object):
 		self.log.warning('Host %s is down' % (host.name))
 		host.up = False
 		host.decayed = False
+		self.hostDigests.pop(host.id, None)
 
 		self.__orphanInstances(host)
 
@@ -171,7 +236,7 @@ class ClusterManagerService(object):
 
 	def __orphanInstances(self, host):
 		# expects lock to be held on host
-		instances = [instance.id for instance in self.data.getInstances().itervalues() if instance.hostId == host.id]
+		instances = self.data.getInstancesByHost(host.id).keys()
 
 		for instanceId in instances:
 			instance = self.data.acquireInstance(instanceId)
@@ -181,27 +246,102 @@ class ClusterManagerService(object):
 
 			self.data.releaseInstance(instance)
 
+	def __touchHost(self, hostId):
+		# note that the host has been heard from
+		now = self.__now()
+		self.hostLastContactTime[hostId] = now
+		self.hostExpiryLock.acquire()
+		try:
+			if hostId not in self.hostExpiryArmed:
+				self.hostExpiryArmed.add(hostId)
+				heapq.heappush(self.hostExpiry, (now + self.expireHostTime, hostId))
+		finally:
+			self.hostExpiryLock.release()
+
+	def __expiredHosts(self):
+		# returns the hosts not heard from within expireHostTime
+		now = self.__now()
+		expired = []
+		self.hostExpiryLock.acquire()
+		try:
+			while len(self.hostExpiry) > 0 and self.hostExpiry[0][0] <= now:
+				(__expiry, hostId) = heapq.heappop(self.hostExpiry)
+				lastContact = self.hostLastContactTime.get(hostId, None)
+				if lastContact is None:
+					# already down
+					self.hostExpiryArmed.discard(hostId)
+					continue
+				expiry = lastContact + self.expireHostTime
+				if expiry > now:
+					heapq.heappush(self.hostExpiry, (expiry, hostId))
+				else:
+					self.hostExpiryArmed.discard(hostId)
+					expired.append(hostId)
+		finally:
+			self.hostExpiryLock.release()
+		return expired
+
+	def __nextHostExpiry(self):
+		self.hostExpiryLock.acquire()
+		try:
+			if len(self.hostExpiry) == 0:
+				return None
+			return self.hostExpiry[0][0]
+		finally:
+			self.hostExpiryLock.release()
+
 	def __checkHosts(self):
 		# Check if hosts have been heard from recently
 		# Otherwise, see if it is alive
 
-		for hostId in self.hostLastContactTime.keys():
-			if (self.hostLastContactTime[hostId] < (self.__now() - self.expireHostTime)):
-				host = self.data.acquireHost(hostId)
-				string = None
-				try:
-					string = self.proxy[host.name].liveCheck()
-				except:
-					pass
+		expired = self.__expiredHosts()
+		if len(expired) == 0:
+			return
 
-				if string != "alive":
-					self.__downHost(host)
-					del self.hostLastContactTime[hostId]
-				else:
-					self.__upHost(host)
-					self.hostLastContactTime[hostId] = self.__now()
+		cv = threading.Condition()
+		done = []
+		def probe(hostId):
+			try:
+				self.__liveCheck(hostId)
+			except:
+				self.log.exception('Failed to check on host %s' % (hostId))
+			cv.acquire()
+			done.append(hostId)
+			cv.notify()
+			cv.release()
+
+		for hostId in expired:
+			self.reconcilePool.submit(probe, hostId)
+		cv.acquire()
+		try:
+			while len(done) < len(expired):
+				cv.wait(1.0)
+		finally:
+			cv.release()
 
-				self.data.releaseHost(host)
+	def __liveCheck(self, hostId):
+		try:
+			hostName = self.data.getHost(hostId).name
+		except:
+			return
+
+		string = None
+		try:
+			string = self.liveCheckProxy[hostName].liveCheck()
+		except:
+			pass
+
+		host = self.data.acquireHost(hostId)
+		try:
+			if string == "alive":
+				self.__upHost(host)
+				self.__touchHost(hostId)
+			elif self.hostLastContactTime.get(hostId, 0) < (self.__now() - self.expireHostTime):
+				# not heard from while we were asking either
+				self.__downHost(host)
+				self.hostLastContactTime.pop(hostId, None)
+		finally:
+			self.data.releaseHost(host)
 
 	def __checkInstances(self):
 		# Reconcile instances with nodes
@@ -217,64 +357,14 @@ class ClusterManagerService(object):
 		if myInstancesError == True:
 			return
 
-		# iterate through all hosts I believe are up
-		for hostId in self.hostLastContactTime.keys():
-			#self.log.warning("iterate %d" % hostId)
-			host = self.data.acquireHost(hostId)
-			# XXXstroucki: timing has changed with the message
-			# buffering in the NM, so this wasn't being run any-
-			# more because the time check was passing.
-			# I should think a bit more about this, but
-			# the "if True" is probably appropriate.
-			#if (self.hostLastContactTime[hostId] < (self.__now() - self.allowDecayed)):
-			if True:
-				host.decayed = True
-
-				self.log.debug('Fetching state from host %s because it is decayed' % (host.name))
-				
-				myInstancesThisHost = [i for i in myInstances.values() if i.hostId == host.id]
-
-				# get a list of VMs running on host
-				try:
-					hostProxy = self.proxy[host.name]
-					remoteInstances = [self.__getVmInfo(host.name, vmId) for vmId in hostProxy.listVms()]
-				except:
-					self.log.warning('Failure getting instances from host %s' % (host.name))
-					self.data.releaseHost(host)
-					continue
+		# forget generations of instances that are gone
+		for instanceId in self.reportedGenerations.keys():
+			if instanceId not in myInstances:
+				self.reportedGenerations.pop(instanceId, None)
+				self.syncedGenerations.pop(instanceId, None)
 
-				# register instances I don't know about
-				for instance in remoteInstances:
-					if (instance.id not in myInstances):
-						if instance.state == InstanceState.Exited:
-							self.log.warning("%s telling me about exited instance %s, ignoring." % (host.name, instance.id))
-							continue
-						instance.hostId = host.id
-						instance = self.data.registerInstance(instance)
-						self.data.releaseInstance(instance)
-				remoteInstanceIds = [i.id for i in remoteInstances]
-				# remove instances that shouldn't be running
-				for instance in myInstancesThisHost:
-					if (instance.id not in remoteInstanceIds):
-						# XXXstroucki before 20110902 excepted here with host lock
-						try:
-							instance = self.data.acquireInstance(instance.id)
-						except:
-							continue
-
-						# XXXstroucki destroy?
-						try:
-							del self.instanceLastContactTime[instance.id]
-						except:
-							pass
-						self.data.removeInstance(instance)
-
-				self.hostLastContactTime[hostId] = self.__now()
-				host.decayed = False
+		self.__reconcileHosts(myInstances)
 
-			self.data.releaseHost(host)
-			#self.log.warning("iterate %d done" % hostId)
-		
 		# iterate through all VMs I believe are active
 		for instanceId in self.instanceLastContactTime.keys():
 
@@ -309,12 +399,15 @@ class ClusterManagerService(object):
 				host = self.data.getHost(instance.hostId)
 
 				# get updated state on VM
+				generation = self.reportedGenerations.get(instanceId, None)
 				try:
 					newInstance = self.__getVmInfo(host.name, instance.vmId)
 				except:
 					self.log.warning('Failure getting data for instance %s from host %s' % (instance.name, host.name))
 					self.data.releaseInstance(instance)
 					continue
+				# heartbeats with this generation need not be followed up
+				self.syncedGenerations[instanceId] = generation
 
 				# update the information we have on the vm
 				#before = instance.state
@@ -326,6 +419,168 @@ class ClusterManagerService(object):
 					self.data.removeInstance(instance)
 
 
+	def __reconcileHosts(self, myInstances):
+		# ask all hosts I believe are up for the VMs they run,
+		# several at a time, so a slow host only holds up its
+		# own worker
+		start = self.__now()
+		hostIds = self.hostLastContactTime.keys()
+
+		cv = threading.Condition()
+		# hostId -> (succeeded, seconds taken)
+		results = {}
+		def reconcile(hostId):
+			hostStart = self.__now()
+			ok = False
+			try:
+				ok = self.__reconcileHost(hostId, myInstances, self.data.getInstancesByHost(hostId).values(), hostStart + self.reconcileHostTimeout)
+			except:
+				self.log.exception('Failed to reconcile host %s' % (hostId))
+			cv.acquire()
+			results[hostId] = (ok, self.__now() - hostStart)
+			cv.notify()
+			cv.release()
+
+		for hostId in hostIds:
+			self.reconcilePool.submit(reconcile, hostId)
+		cv.acquire()
+		try:
+			while len(results) < len(hostIds):
+				cv.wait(1.0)
+		finally:
+			cv.release()
+
+		took = self.__now() - start
+		failed = [hostId for (hostId, (ok, __seconds)) in results.iteritems() if not ok]
+		slowest = None
+		if len(results) > 0:
+			slowest = max(results.iteritems(), key=lambda item: item[1][1])
+		self.lastReconcile = {'time': start, 'seconds': took, 'hosts': len(hostIds), 'failed': len(failed), 'slowest': slowest}
+		summary = 'Reconciled %d hosts in %.2f seconds, %d failed' % (len(hostIds), took, len(failed))
+		if slowest is not None:
+			summary += ', slowest was host %s with %.2f seconds' % (slowest[0], slowest[1][1])
+		if took > min(self.expireHostTime, self.allowDecayed):
+			self.log.warning(summary)
+		else:
+			self.log.info(summary)
+
+	def __fetchVms(self, hostName, deadline):
+		"""Returns the VMs the node manager on hostName runs, or raises
+		   TimeoutException if it has not told us by the deadline"""
+		hostProxy = self.proxy[hostName]
+		vmIds = self.__resultBy(hostProxy.callAsync('listVms'), deadline)
+		if len(vmIds) == 0:
+			return []
+		# one round trip for all VMs on the host
+		calls = [('getVmInfo', (vmId,)) for vmId in vmIds]
+		try:
+			results = self.__resultBy(hostProxy.callAsync('batch', calls), deadline)
+		except AttributeError:
+			# node manager predates batch
+			results = []
+			for vmId in vmIds:
+				if self.__now() > deadline:
+					raise TimeoutException('%s did not list its VMs in time' % (hostName))
+				try:
+					results.append(self.__getVmInfo(hostName, vmId))
+				except Exception, e:
+					results.append(e)
+		for rv in results:
+			if isinstance(rv, Exception):
+				raise rv
+			if not isinstance(rv, Instance):
+				raise ValueError
+		return results
+
+	def __resultBy(self, future, deadline):
+		try:
+			return future.result(max(deadline - self.__now(), 0))
+		except TimeoutException:
+			future.cancel("passed its deadline")
+			raise
+
+	def __digestedVms(self, hostId, myInstances, myInstancesThisHost):
+		"""Returns the ids of the instances the host runs, from its last
+		   heartbeat, if that is recent and names the same instances as
+		   I have for the host. Otherwise returns None."""
+		(digestTime, vms) = self.hostDigests.get(hostId, (0, None))
+		if vms is None or digestTime < (self.__now() - self.allowDecayed):
+			return None
+		for instanceId in vms:
+			if instanceId not in myInstances:
+				return None
+		for instance in myInstancesThisHost:
+			if instance.id not in vms:
+				return None
+		return set(vms)
+
+	def __reconcileHost(self, hostId, myInstances, myInstancesThisHost, deadline):
+		# the node manager is asked without holding the host lock
+		try:
+			hostName = self.data.getHost(hostId).name
+		except:
+			return False
+
+		remoteInstanceIds = self.__digestedVms(hostId, myInstances, myInstancesThisHost)
+		if remoteInstanceIds is not None:
+			# the last heartbeat told us all we need
+			remoteInstances = []
+		else:
+			self.log.debug('Fetching state from host %s because it is decayed' % (hostName))
+			try:
+				remoteInstances = self.__fetchVms(hostName, deadline)
+			except Exception, e:
+				self.log.warning('Failure getting instances from host %s: %s' % (hostName, e))
+				try:
+					host = self.data.acquireHost(hostId)
+				except:
+					return False
+				host.decayed = True
+				self.data.releaseHost(host)
+				return False
+			remoteInstanceIds = set([i.id for i in remoteInstances])
+
+		try:
+			host = self.data.acquireHost(hostId)
+		except:
+			return False
+		try:
+			# register instances I don't know about
+			for instance in remoteInstances:
+				if (instance.id not in myInstances):
+					if instance.state == InstanceState.Exited:
+						self.log.warning("%s telling me about exited instance %s, ignoring." % (host.name, instance.id))
+						continue
+					instance.hostId = host.id
+					instance = self.data.registerInstance(instance)
+					self.data.releaseInstance(instance)
+			# remove instances that shouldn't be running
+			for instance in myInstancesThisHost:
+				if (instance.id not in remoteInstanceIds):
+					# XXXstroucki before 20110902 excepted here with host lock
+					try:
+						instance = self.data.acquireInstance(instance.id)
+					except:
+						continue
+
+					# it may have been moved since the pass started
+					if instance.hostId != host.id:
+						self.data.releaseInstance(instance)
+						continue
+
+					# XXXstroucki destroy?
+					try:
+						del self.instanceLastContactTime[instance.id]
+					except:
+						pass
+					self.data.removeInstance(instance)
+
+			self.__touchHost(hostId)
+			host.decayed = False
+		finally:
+			self.data.releaseHost(host)
+		return True
+
 	def __getVmInfo(self, host, vmid):
 		hostProxy = self.proxy[host]
 		rv = hostProxy.getVmInfo(vmid)
@@ -337,7 +592,7 @@ class ClusterManagerService(object):
 
 		return rv
 
-	def __normalize(self, instance):
+	def __normalize(self, instance, checkName=True):
 		instance.id = None
 		instance.vmId = None
 		instance.hostId = None
@@ -345,10 +600,9 @@ class ClusterManagerService(object):
 		instance.name = scrubString(instance.name, allowed="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-.")
 		instance.state = InstanceState.Pending
 		# XXXstroucki At some point, check userId
-		if (not self.allowDuplicateNames):
-			for i in self.data.getInstances().itervalues():
-				if (i.name == instance.name):
-					raise TashiException(d={'errno':Errors.InvalidInstance,'msg':"The name %s is already in use" % (instance.name)})
+		if (checkName and not self.allowDuplicateNames):
+			if (len(self.data.getInstancesByName(instance.name)) > 0):
+				raise TashiException(d={'errno':Errors.InvalidInstance,'msg':"The name %s is already in use" % (instance.name)})
 		if (instance.cores < 1):
 			raise TashiException(d={'errno':Errors.InvalidInstance,'msg':"Number of cores must be >= 1"})
 		if (instance.cores > self.maxCores):
@@ -375,6 +629,35 @@ class ClusterManagerService(object):
 		self.__ACCOUNT("CM VM REQUEST", instance=instance)
 		return instance
 
+	# extern
+	def createVms(self, instances):
+		"""Adds a list of VMs to the pending VMs. Returns a list with
+		   each instance as registered, or the exception that kept it
+		   from being added."""
+		results = []
+		valid = []
+		names = set()
+		for instance in instances:
+			try:
+				instance = self.__normalize(instance, checkName=False)
+				if (not self.allowDuplicateNames):
+					if (instance.name in names or len(self.data.getInstancesByName(instance.name)) > 0):
+						raise TashiException(d={'errno':Errors.InvalidInstance,'msg':"The name %s is already in use" % (instance.name)})
+					names.add(instance.name)
+				valid.append(instance)
+				results.append(instance)
+			except Exception, e:
+				results.append(e)
+
+		registered = self.data.registerInstances(valid)
+		for instance in registered:
+			self.data.releaseInstance(instance)
+		if (len(registered) > 0):
+			self.__ACCOUNT("CM VMS REQUEST", instances=registered)
+
+		# registering assigned the ids in place
+		return results
+
 	# extern
 	def shutdownVm(self, instanceId):
 		instance = self.data.acquireInstance(instanceId)
@@ -463,6 +746,8 @@ class ClusterManagerService(object):
 			# FIXME: should these be acquire/release host?
 			targetHost = self.data.getHost(targetHostId)
 			sourceHost = self.data.getHost(instance.hostId)
+			if (self.checkCapacity):
+				self.capacity.check(instance, targetHost)
 			# FIXME: Are these the correct state transitions?
 		except:
 			self.data.releaseInstance(instance)
@@ -485,6 +770,7 @@ class ClusterManagerService(object):
 			cookie = self.proxy[targetHost.name].prepReceiveVm(instance, sourceHost)
 		except Exception:
 			self.log.exception('prepReceiveVm failed')
+			self.__abortMigration(instance.id, sourceHost.id)
 			raise
 
 		instance = self.data.acquireInstance(instance.id)
@@ -496,10 +782,11 @@ class ClusterManagerService(object):
 
 		self.data.releaseInstance(instance)
 		try:
-			# Send the VM
-			self.proxy[sourceHost.name].migrateVm(instance.vmId, targetHost, cookie)
+			# Send the VM; this takes as long as the transfer
+			self.migrationProxy[sourceHost.name].migrateVm(instance.vmId, targetHost, cookie)
 		except Exception:
 			self.log.exception('migrateVm failed')
+			self.__abortMigration(instance.id, sourceHost.id)
 			raise
 		try:
 			instance = self.data.acquireInstance(instance.id)
@@ -517,6 +804,16 @@ class ClusterManagerService(object):
 		self.log.info("migrateVM finished")
 		return
 
+	def __abortMigration(self, instanceId, sourceHostId):
+		# the VM is still running on the source, so it may be
+		# migrated again
+		instance = self.data.acquireInstance(instanceId)
+		try:
+			if (instance.hostId == sourceHostId and instance.state in [InstanceState.MigratePrep, InstanceState.MigrateTrans]):
+				self.__stateTransition(instance, None, InstanceState.Running)
+		finally:
+			self.data.releaseInstance(instance)
+
 	# extern
 	def pauseVm(self, instanceId):
 		instance = self.data.acquireInstance(instanceId)
@@ -571,9 +868,150 @@ class ClusterManagerService(object):
 		self.data.releaseInstance(instance)
 		return
 
+	def __selectInstances(self, selector):
+		"""Returns the instances matching every criterion of selector,
+		   a dict that may hold ids (a list), name (a pattern as for
+		   fnmatch), userId and hostId"""
+		for key in selector:
+			if key not in ['ids', 'name', 'userId', 'hostId']:
+				raise TashiException(d={'errno':Errors.InvalidInstance,'msg':"Unknown selector %s" % (key)})
+		if len(selector) == 0:
+			raise TashiException(d={'errno':Errors.InvalidInstance,'msg':"Refusing to select all VMs"})
+
+		# start from the narrowest index
+		name = selector.get('name', None)
+		if 'ids' in selector:
+			candidates = {}
+			for instanceId in selector['ids']:
+				try:
+					candidates[instanceId] = self.data.getInstance(instanceId)
+				except TashiException:
+					pass
+		elif 'hostId' in selector:
+			candidates = self.data.getInstancesByHost(selector['hostId'])
+		elif name is not None and not any([c in name for c in '*?[']):
+			candidates = self.data.getInstancesByName(name)
+		elif 'userId' in selector:
+			candidates = self.data.getInstancesByUser(selector['userId'])
+		else:
+			candidates = self.data.getInstances()
+
+		instances = []
+		for instance in candidates.itervalues():
+			if 'userId' in selector and instance.userId != selector['userId']:
+				continue
+			if 'hostId' in selector and instance.hostId != selector['hostId']:
+				continue
+			if name is not None and not fnmatch.fnmatchcase(instance.name, name):
+				continue
+			instances.append(instance)
+		return instances
+
+	def __manyVms(self, action, selector):
+		# run the single-VM RPC for each selected VM, several at a
+		# time; each waits on its own node manager
+		instances = self.__selectInstances(selector)
+		cv = threading.Condition()
+		# instanceId -> return value or exception
+		results = {}
+		def run(instanceId):
+			try:
+				rv = action(instanceId)
+			except Exception, e:
+				rv = e
+			cv.acquire()
+			results[instanceId] = rv
+			cv.notify()
+			cv.release()
+
+		for instance in instances:
+			self.bulkPool.submit(run, instance.id)
+		cv.acquire()
+		try:
+			while len(results) < len(instances):
+				cv.wait(1.0)
+		finally:
+			cv.release()
+		return [(instance.id, instance.name, results[instance.id]) for instance in instances]
+
+	# extern
+	def destroyVms(self, selector):
+		"""Destroys the VMs matching selector, see __selectInstances.
+		   Returns a list of (instanceId, name, result) where result is
+		   what destroyVm returned or the exception it raised."""
+		return self.__manyVms(self.destroyVm, selector)
+
+	# extern
+	def shutdownVms(self, selector):
+		"""Like destroyVms, with shutdownVm"""
+		return self.__manyVms(self.shutdownVm, selector)
+
+	# extern
+	def pauseVms(self, selector):
+		"""Like destroyVms, with pauseVm"""
+		return self.__manyVms(self.pauseVm, selector)
+
+	# extern
+	def suspendVms(self, selector):
+		"""Like destroyVms, with suspendVm"""
+		return self.__manyVms(self.suspendVm, selector)
+
+	# extern
+	def evacuateHost(self, hostId, policy=None):
+		"""Starts moving all VMs off a host, see Evacuation. policy
+		   is a dict that may override retries, fallback ('suspend' or
+		   None), maxPerSource, suspendTimeout and drain, and limit
+		   destinations to a list of host ids. Progress is reported by
+		   getEvacuations."""
+		host = self.data.getHost(hostId)
+		if policy is None:
+			policy = {}
+		self.evacuationsLock.acquire()
+		try:
+			evacuation = self.evacuations.get(hostId, None)
+			if evacuation is not None and evacuation.finished is None:
+				return "Host %s is already being evacuated" % (host.name)
+			evacuation = Evacuation(self, hostId, policy, self.migrationSlots)
+			self.evacuations[hostId] = evacuation
+		finally:
+			self.evacuationsLock.release()
+		self.log.info("Evacuating host %s" % (host.name))
+		evacuation.start()
+		return "Evacuating host %s" % (host.name)
+
+	# extern
+	def cancelEvacuation(self, hostId):
+		evacuation = self.evacuations.get(hostId, None)
+		if evacuation is None:
+			return "Host %s is not being evacuated" % (hostId)
+		evacuation.cancel()
+		return "Evacuation of host %s cancelled, migrations under way will finish" % (hostId)
+
+	# extern
+	def getEvacuations(self):
+		"""Returns the progress of each evacuation by host id"""
+		self.evacuationsLock.acquire()
+		try:
+			evacuations = self.evacuations.values()
+		finally:
+			self.evacuationsLock.release()
+		progress = {}
+		for evacuation in evacuations:
+			progress[evacuation.hostId] = evacuation.progress()
+		return progress
+
 	# extern
 	def getHosts(self):
 		return self.data.getHosts().values()
+
+	# extern
+	def getHostCapacity(self):
+		return self.capacity.getCapacity(self.data.getHosts().itervalues())
+
+	# extern
+	def getHostsSince(self, generation):
+		(generation, hosts, removed) = self.data.getHostsSince(generation)
+		return (generation, hosts.values(), removed)
 	
 	# extern
 	def setHostState(self, hostId, state):
@@ -681,6 +1119,11 @@ class ClusterManagerService(object):
 	def getInstances(self):
 		return self.data.getInstances().values()
 
+	# extern
+	def getInstancesSince(self, generation):
+		(generation, instances, removed) = self.data.getInstancesSince(generation)
+		return (generation, instances.values(), removed)
+
 	# extern
 	def getImages(self):
 		return self.data.getImages()
@@ -734,10 +1177,56 @@ class ClusterManagerService(object):
 	# extern
 	def registerNodeManager(self, host, instances):
 		"""Called by the NM every so often as a keep-alive/state polling -- state changes here are NOT AUTHORITATIVE"""
+		oldHost = self.__heartbeat(host)
+
+		# let the host communicate what it is running
+		# and note that the information is not stale
+		for instance in instances:
+			if instance.state == InstanceState.Exited:
+				self.log.warning("%s reporting exited instance %s, ignoring." % (host.name, instance.id))
+				continue
+			self.instanceLastContactTime.setdefault(instance.id, 0)
+
+		self.data.releaseHost(oldHost)
+		return host.id
+
+	# extern
+	def registerNodeManagerDigest(self, host, digests):
+		"""Like registerNodeManager, but the NM only sends an (instanceId, vmId, state, decayed, generation) tuple per VM. VMs whose digest agrees with what the CM last fetched are not asked about again."""
+		oldHost = self.__heartbeat(host)
+
+		now = self.__now()
+		vms = {}
+		try:
+			for digest in digests:
+				(instanceId, vmId, state, decayed, generation) = digest
+				if state == InstanceState.Exited:
+					self.log.warning("%s reporting exited instance %s, ignoring." % (host.name, instanceId))
+					continue
+				vms[instanceId] = digest
+				self.instanceLastContactTime.setdefault(instanceId, 0)
+				self.reportedGenerations[instanceId] = generation
+				if decayed or self.syncedGenerations.get(instanceId, None) != generation:
+					# changed since the CM last fetched it,
+					# have __checkInstances fetch it again
+					self.instanceLastContactTime[instanceId] = 0
+					continue
+				try:
+					instance = self.data.getInstance(instanceId)
+				except:
+					continue
+				if instance.hostId == host.id and instance.vmId == vmId and instance.state == state and not instance.decayed:
+					self.instanceLastContactTime[instanceId] = now
+			self.hostDigests[host.id] = (now, vms)
+		finally:
+			self.data.releaseHost(oldHost)
+		return host.id
 
+	def __heartbeat(self, host):
+		# returns the host, locked
 		# Handle a new registration
 		if (host.id == None):
-			hostList = [h for h in self.data.getHosts().itervalues() if h.name == host.name]
+			hostList = self.data.getHostsByName(host.name).values()
 			if (len(hostList) != 1):
 				raise TashiException(d={'errno':Errors.NoSuchHost, 'msg':'A host with name %s is not identifiable' % (host.name)})
 			host.id = hostList[0].id
@@ -750,7 +1239,7 @@ class ClusterManagerService(object):
 
 		if oldHost.up == False:
 			self.__upHost(oldHost)
-		self.hostLastContactTime[host.id] = self.__now()
+		self.__touchHost(host.id)
 		oldHost.version = host.version
 		oldHost.memory = host.memory
 		oldHost.cores = host.cores
@@ -760,17 +1249,7 @@ class ClusterManagerService(object):
 			oldHost.state = HostState.VersionMismatch
 		if (host.version == version and oldHost.state == HostState.VersionMismatch):
 			oldHost.state = HostState.Normal
-
-		# let the host communicate what it is running
-		# and note that the information is not stale
-		for instance in instances:
-			if instance.state == InstanceState.Exited:
-				self.log.warning("%s reporting exited instance %s, ignoring." % (host.name, instance.id))
-				continue
-			self.instanceLastContactTime.setdefault(instance.id, 0)
-
-		self.data.releaseHost(oldHost)
-		return host.id
+		return oldHost
 	
 	def __vmUpdate(self, oldInstance, instance, oldState):
 		# this function assumes a lock is held on the instance
@@ -835,8 +1314,7 @@ class ClusterManagerService(object):
 			self.log.exception("Could not acquire instance")
 			raise
 
-		import copy
-		displayInstance = copy.copy(oldInstance)
+		displayInstance = oldInstance.clone()
 		displayInstance.state = instance.state
 		self.__ACCOUNT("CM VM UPDATE", instance=displayInstance)
 
@@ -852,9 +1330,6 @@ class ClusterManagerService(object):
 
 	# extern
 	def activateVm(self, instanceId, host):
-		# XXXstroucki: check my idea of the host's capacity before
-		# trying.
-
 		dataHost = self.data.acquireHost(host.id)
 
 		if (dataHost.name != host.name):
@@ -870,6 +1345,7 @@ class ClusterManagerService(object):
 		self.data.releaseHost(dataHost)
 		instance = self.data.acquireInstance(instanceId)
 		self.__ACCOUNT("CM VM ACTIVATE", instance=instance)
+		oldState = instance.state
 
 		if ('__resume_source' in instance.hints):
 			self.__stateTransition(instance, None, InstanceState.Resuming)
@@ -878,6 +1354,15 @@ class ClusterManagerService(object):
 			#self.__stateTransition(instance, InstanceState.Pending, InstanceState.Activating)
 			self.__stateTransition(instance, None, InstanceState.Activating)
 
+		if (self.checkCapacity):
+			try:
+				self.capacity.admit(instance, dataHost)
+			except TashiException:
+				# leave it for the scheduler to try again
+				self.__stateTransition(instance, None, oldState)
+				self.data.releaseInstance(instance)
+				raise
+
 		instance.hostId = host.id
 		self.data.releaseInstance(instance)
 
@@ -956,17 +1441,32 @@ class ClusterManagerService(object):
 
 	# service thread
 	def __monitorCluster(self):
+		period = min(self.expireHostTime, self.allowDecayed)
+		nextReconcile = 0
 		while True:
-			sleepFor = min(self.expireHostTime, self.allowDecayed)
-
 			try:
 				self.__checkHosts()
-				self.__checkInstances()
+				if self.__now() >= nextReconcile:
+					self.__checkInstances()
+					self.proxy.evictIdle()
+					self.liveCheckProxy.evictIdle()
+					self.migrationProxy.evictIdle()
+					nextReconcile = self.__now() + period
 			except:
 				self.log.exception('monitorCluster iteration failed')
+				nextReconcile = self.__now() + period
 			#  XXXrgass too chatty.  Remove
 			# XXXstroucki the risk is that a deadlock in obtaining
 			# data could prevent this loop from continuing.
+
+			# wake up for the next host to expire, or the next
+			# reconciliation. Hosts heard from for the first time
+			# expire after that anyway.
+			wakeAt = nextReconcile
+			nextExpiry = self.__nextHostExpiry()
+			if nextExpiry is not None and nextExpiry < wakeAt:
+				wakeAt = nextExpiry
+			sleepFor = max(wakeAt - self.__now(), 0.5)
 			#self.log.info("Sleeping for %d seconds" % sleepFor)
 			time.sleep(sleepFor)
 
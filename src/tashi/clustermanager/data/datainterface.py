@@ -15,16 +15,294 @@
 # specific language governing permissions and limitations
 # under the License.    
 
+import bisect
+import cPickle
+import logging
+import threading
+import time
+
+from tashi.rpycservices.rpyctypes import TashiException, Errors
+
+class ChangeLog(object):
+	"""Numbers the changes made to the instances and hosts of a data
+	   store, so clients can ask for what changed since they last
+	   looked. Generations start from the clock, so they keep growing
+	   across restarts of the cluster manager. Only the last maxEntries
+	   changes are kept; older generations cannot be answered.
+
+	   Listeners are called with (generation, kind, change, old, new)
+	   for each change, where change is 'added', 'changed' or
+	   'removed'. old is None for added objects, and for changed ones
+	   that were not acquired first; new is None for removed ones.
+	   They run in the thread making the change, with the object
+	   locked, so they must not block."""
+
+	def __init__(self, maxEntries=100000):
+		self.maxEntries = maxEntries
+		self.lock = threading.Lock()
+		self.generation = int(time.time()) * 1000000
+		# the oldest generation changes can be listed from
+		self.horizon = self.generation
+		# in order of generation
+		self.generations = []
+		self.entries = []
+		self.listeners = []
+		self.views = None
+
+	def addListener(self, listener):
+		self.listeners.append(listener)
+
+	def setViews(self, views):
+		"""Sets a function called with (kind, change, old, new) before
+		   the generation of a change is advanced, so that whoever
+		   reads the new generation also finds the change in the views"""
+		self.views = views
+
+	def getGeneration(self):
+		return self.generation
+
+	def fingerprint(self, obj):
+		"""Remembers the contents of an acquired object, for changed()"""
+		obj._fingerprint = cPickle.dumps(obj, 2)
+
+	def added(self, kind, obj):
+		"""Records a new object"""
+		self.__updateViews(kind, 'added', None, obj)
+		generation = self.touch(kind, obj.id)
+		self.__notify(generation, kind, 'added', None, obj)
+		# a release straight after registering is not a change
+		self.fingerprint(obj)
+
+	def changed(self, kind, obj):
+		"""Records a change to obj if it differs from its fingerprint"""
+		fingerprint = getattr(obj, '_fingerprint', None)
+		if fingerprint is not None:
+			obj._fingerprint = None
+			if fingerprint == cPickle.dumps(obj, 2):
+				return
+		old = None
+		if fingerprint is not None and len(self.listeners) > 0:
+			old = cPickle.loads(fingerprint)
+		self.__updateViews(kind, 'changed', old, obj)
+		generation = self.touch(kind, obj.id)
+		if len(self.listeners) > 0:
+			self.__notify(generation, kind, 'changed', old, obj)
+
+	def removed(self, kind, obj):
+		"""Records the removal of obj"""
+		self.__updateViews(kind, 'removed', obj, None)
+		generation = self.touch(kind, obj.id, removed=True)
+		self.__notify(generation, kind, 'removed', obj, None)
+
+	def __updateViews(self, kind, change, old, new):
+		if self.views is not None:
+			try:
+				self.views(kind, change, old, new)
+			except Exception:
+				logging.getLogger(__name__).exception("Updating views failed")
+
+	def __notify(self, generation, kind, change, old, new):
+		for listener in self.listeners:
+			try:
+				listener(generation, kind, change, old, new)
+			except Exception:
+				logging.getLogger(__name__).exception("Change listener failed")
+
+	def touch(self, kind, _id, removed=False):
+		"""Records a change to, or the removal of, object _id of the
+		   given kind, without telling listeners. Returns the generation
+		   of the change."""
+		self.lock.acquire()
+		try:
+			self.generation += 1
+			generation = self.generation
+			self.generations.append(self.generation)
+			self.entries.append((kind, _id, removed))
+			if len(self.entries) > 2 * self.maxEntries:
+				# trim in bulk rather than on every change
+				drop = len(self.entries) - self.maxEntries
+				self.horizon = self.generations[drop - 1]
+				del self.generations[:drop]
+				del self.entries[:drop]
+		finally:
+			self.lock.release()
+		return generation
+
+	def since(self, kind, generation):
+		"""Returns the current generation, and the ids of objects of the
+		   given kind that changed and that were removed after
+		   generation. Both lists are None if generation is unknown or
+		   too old."""
+		self.lock.acquire()
+		try:
+			current = self.generation
+			if generation is None or generation < self.horizon or generation > current:
+				return (current, None, None)
+			latest = {}
+			for i in range(bisect.bisect_right(self.generations, generation), len(self.entries)):
+				(entryKind, _id, removed) = self.entries[i]
+				if entryKind == kind:
+					latest[_id] = removed
+		finally:
+			self.lock.release()
+		changed = [_id for (_id, removed) in latest.iteritems() if not removed]
+		removed = [_id for (_id, removed) in latest.iteritems() if removed]
+		return (current, changed, removed)
+
+class SecondaryIndex(object):
+	"""Maps values of some attributes of instances or hosts to the ids
+	   of the objects having them. It is kept up to date from the change
+	   log, so objects being changed are filed under the values they had
+	   when last released."""
+
+	def __init__(self, attributes):
+		self.attributes = attributes
+		self.lock = threading.Lock()
+		# id -> values of the attributes, as indexed
+		self.keys = {}
+		# attribute -> value -> set of ids
+		self.ids = {}
+		for attribute in attributes:
+			self.ids[attribute] = {}
+
+	def __unfile(self, _id):
+		# expects self.lock to be held
+		keys = self.keys.pop(_id, None)
+		if keys is None:
+			return
+		for (attribute, value) in zip(self.attributes, keys):
+			ids = self.ids[attribute][value]
+			ids.discard(_id)
+			if len(ids) == 0:
+				del self.ids[attribute][value]
+
+	def __file(self, obj):
+		# expects self.lock to be held
+		keys = tuple([getattr(obj, attribute) for attribute in self.attributes])
+		self.keys[obj.id] = keys
+		for (attribute, value) in zip(self.attributes, keys):
+			self.ids[attribute].setdefault(value, set()).add(obj.id)
+
+	def update(self, obj):
+		self.lock.acquire()
+		try:
+			self.__unfile(obj.id)
+			self.__file(obj)
+		finally:
+			self.lock.release()
+
+	def remove(self, _id):
+		self.lock.acquire()
+		try:
+			self.__unfile(_id)
+		finally:
+			self.lock.release()
+
+	def rebuild(self, objects):
+		self.lock.acquire()
+		try:
+			self.keys = {}
+			for attribute in self.attributes:
+				self.ids[attribute] = {}
+			for obj in objects:
+				self.__file(obj)
+		finally:
+			self.lock.release()
+
+	def lookup(self, attribute, value):
+		"""Returns the ids of the objects with the given value"""
+		self.lock.acquire()
+		try:
+			return list(self.ids[attribute].get(value, ()))
+		finally:
+			self.lock.release()
+
+class Snapshot(object):
+	"""Copies of the instances or hosts of a data store, as they were
+	   when last released, for reading without taking their locks.
+	   Writers replace the copy of an object; readers get a dict of all
+	   the copies that is never changed afterwards, so it may be
+	   iterated while writers carry on. A new dict is only made when
+	   something changed since the last one was handed out."""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		# id -> copy, changed in place by writers
+		self.objects = {}
+		# shared with readers, None when out of date
+		self.current = {}
+
+	def __copy(self, obj):
+		# pickling leaves out the lock and fingerprint
+		return cPickle.loads(cPickle.dumps(obj, 2))
+
+	def publish(self, obj):
+		copy = self.__copy(obj)
+		self.lock.acquire()
+		try:
+			self.objects[copy.id] = copy
+			self.current = None
+		finally:
+			self.lock.release()
+
+	def remove(self, _id):
+		self.lock.acquire()
+		try:
+			if self.objects.pop(_id, None) is not None:
+				self.current = None
+		finally:
+			self.lock.release()
+
+	def rebuild(self, objects):
+		copies = {}
+		for obj in objects:
+			copies[obj.id] = self.__copy(obj)
+		self.lock.acquire()
+		try:
+			self.objects = copies
+			self.current = None
+		finally:
+			self.lock.release()
+
+	def get(self):
+		"""Returns the copies by id. The dict and the objects in it
+		   are shared, and must not be changed."""
+		current = self.current
+		if current is not None:
+			return current
+		self.lock.acquire()
+		try:
+			if self.current is None:
+				self.current = dict(self.objects)
+			return self.current
+		finally:
+			self.lock.release()
+
+	def getOne(self, _id):
+		"""Returns the copy of object _id, or None"""
+		return self.objects.get(_id, None)
+
 class DataInterface(object):
 	"""Interface for a functional data access mechanism"""
 	def __init__(self, config):
 		if (self.__class__ is DataInterface):
 			raise NotImplementedError
 		self.config = config
+		self.changes = ChangeLog(config.getint("ClusterManager", "changeLogSize", 100000))
+		# backends call rebuildViews once their data is loaded
+		self.instanceIndex = SecondaryIndex(('hostId', 'name', 'userId', 'state'))
+		self.hostIndex = SecondaryIndex(('name',))
+		self.instanceSnapshot = Snapshot()
+		self.hostSnapshot = Snapshot()
+		self.changes.setViews(self.__updateViews)
 	
 	def registerInstance(self, instance):
 		raise NotImplementedError
 	
+	def registerInstances(self, instances):
+		"""Registers a list of instances, returning them acquired"""
+		return [self.registerInstance(instance) for instance in instances]
+	
 	def acquireInstance(self, instanceId):
 		raise NotImplementedError
 	
@@ -41,19 +319,28 @@ class DataInterface(object):
 		raise NotImplementedError
 	
 	def getHosts(self):
-		raise NotImplementedError
+		"""Returns the hosts by id, as last released. Neither the dict
+		   nor the hosts may be changed; acquire a host to change it."""
+		return self.hostSnapshot.get()
 	
 	def getHost(self, _id):
-		raise NotImplementedError
+		host = self.hostSnapshot.getOne(_id)
+		if (host is None):
+			raise TashiException(d={'errno':Errors.NoSuchHostId,'msg':"No such hostId - %s" % (_id)})
+		return host
 
 	def getImages(self):
 		raise NotImplementedError
 	
 	def getInstances(self):
-		raise NotImplementedError
+		"""Like getHosts, for instances"""
+		return self.instanceSnapshot.get()
 	
 	def getInstance(self, _id):
-		raise NotImplementedError
+		instance = self.instanceSnapshot.getOne(_id)
+		if (instance is None):
+			raise TashiException(d={'errno':Errors.NoSuchInstanceId,'msg':"No such instanceId - %s" % (_id)})
+		return instance
 	
 	def getNetworks(self):
 		raise NotImplementedError
@@ -72,3 +359,97 @@ class DataInterface(object):
 	
 	def unregisterHost(self, hostId):
 		raise NotImplementedError
+
+	def getGeneration(self):
+		"""Returns the number of the latest change to instances or hosts"""
+		return self.changes.getGeneration()
+
+	def addChangeListener(self, listener):
+		"""Calls listener for every change to instances or hosts, see ChangeLog"""
+		self.changes.addListener(listener)
+
+	def __updateViews(self, kind, change, old, new):
+		if kind == 'instances':
+			index = self.instanceIndex
+			snapshot = self.instanceSnapshot
+		else:
+			index = self.hostIndex
+			snapshot = self.hostSnapshot
+		if change == 'removed':
+			index.remove(old.id)
+			snapshot.remove(old.id)
+		else:
+			index.update(new)
+			snapshot.publish(new)
+
+	def rebuildViews(self, instances, hosts):
+		"""Indexes and takes snapshots of all instances and hosts,
+		   given as dicts by id"""
+		self.instanceIndex.rebuild(instances.itervalues())
+		self.hostIndex.rebuild(hosts.itervalues())
+		self.instanceSnapshot.rebuild(instances.itervalues())
+		self.hostSnapshot.rebuild(hosts.itervalues())
+
+	def __lookup(self, index, attribute, value, getOne):
+		objects = {}
+		for _id in index.lookup(attribute, value):
+			try:
+				obj = getOne(_id)
+			except TashiException:
+				# removed since
+				continue
+			objects[_id] = obj
+		return objects
+
+	def getInstancesByHost(self, hostId):
+		"""Returns the instances on a host by id. Instances being
+		   changed may have moved; check under the instance lock."""
+		return self.__lookup(self.instanceIndex, 'hostId', hostId, self.getInstance)
+
+	def getInstancesByName(self, name):
+		"""Like getInstancesByHost, for instances with the given name"""
+		return self.__lookup(self.instanceIndex, 'name', name, self.getInstance)
+
+	def getInstancesByUser(self, userId):
+		"""Like getInstancesByHost, for instances of the given user"""
+		return self.__lookup(self.instanceIndex, 'userId', userId, self.getInstance)
+
+	def getInstancesByState(self, state):
+		"""Like getInstancesByHost, for instances in the given state"""
+		return self.__lookup(self.instanceIndex, 'state', state, self.getInstance)
+
+	def getHostsByName(self, name):
+		"""Returns the hosts with the given name by id"""
+		return self.__lookup(self.hostIndex, 'name', name, self.getHost)
+
+	def getUserByName(self, name):
+		"""Returns the user with the given name, or None"""
+		for user in self.getUsers().itervalues():
+			if user.name == name:
+				return user
+		return None
+
+	def __getSince(self, kind, generation, getAll, getOne):
+		# read the generation first, so nothing changed after it is missed
+		(current, changed, removed) = self.changes.since(kind, generation)
+		if changed is None:
+			return (current, getAll(), None)
+		objects = {}
+		for _id in changed:
+			try:
+				objects[_id] = getOne(_id)
+			except TashiException:
+				# removed since
+				removed.append(_id)
+		return (current, objects, removed)
+
+	def getInstancesSince(self, generation):
+		"""Returns the current generation, the instances added or changed
+		   after generation by id, and the ids of those removed. If
+		   generation is too old the instances are all returned, and
+		   the removed ids are None."""
+		return self.__getSince('instances', generation, self.getInstances, self.getInstance)
+
+	def getHostsSince(self, generation):
+		"""Like getInstancesSince, for hosts"""
+		return self.__getSince('hosts', generation, self.getHosts, self.getHost)
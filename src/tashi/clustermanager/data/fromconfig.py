@@ -20,6 +20,7 @@ from __future__ import with_statement
 
 import logging
 import threading
+import time
 import os
 import ConfigParser
 
@@ -41,19 +42,29 @@ class FromConfig(DataInterface):
 		self.instanceIdLock = threading.Lock()
 		self.lockNames[self.instanceIdLock] = "instanceIdLock"
 		self.maxInstanceId = 1
+		# one lock per host, held from acquireHost to releaseHost
 		self.hostLocks = {}
+		# held briefly to change self.hosts or self.hostLocks
 		self.hostLock = threading.Lock()
 		self.idLock = threading.Lock()
-		if not self.config.has_section("FromConfig"):
-			return
+		if self.config.has_section("FromConfig"):
+			self.__load()
+		self.rebuildViews(self.instances, self.hosts)
+		self.saveDelay = float(self.config.get("FromConfig", "saveDelay", 5.0))
+		self.saveRequested = False
+		self.saveCv = threading.Condition()
+		thread = threading.Thread(name="fromConfigSaver", target=self.__saver)
+		thread.setDaemon(True)
+		thread.start()
+
+	def __load(self):
 		for (name, value) in self.config.items("FromConfig"):
 			name = name.lower()
 			if (name.startswith("host")):
 				host = eval(value)
 				if (host.__class__ is not Host):
 					raise ValueError, "Entry %s is not a Host" % (name)
-				host._lock = threading.Lock()
-				self.lockNames[host._lock] = "h%d" % (host.id)
+				host._lock = self.getHostLock(host.id)
 				self.hosts[host.id] = host
 			if (name.startswith("network")):
 				network = eval(value)
@@ -75,33 +86,49 @@ class FromConfig(DataInterface):
 		l.release()
 	
 	def getNewInstanceId(self):
+		return self.getNewInstanceIds(1)[0]
+	
+	def getNewInstanceIds(self, count):
 		self.acquireLock(self.instanceIdLock)
 		instanceId = self.maxInstanceId
-		self.maxInstanceId = self.maxInstanceId + 1
+		self.maxInstanceId = self.maxInstanceId + count
 		self.releaseLock(self.instanceIdLock)
-		return instanceId
+		return range(instanceId, instanceId + count)
 	
 	def registerInstance(self, instance):
-		if type(instance) is not Instance:
-			self.log.exception("Argument is not of type Instance, but of type %s" % (type(instance)))
-			raise TypeError
+		return self.registerInstances([instance])[0]
+	
+	def registerInstances(self, instances):
+		for instance in instances:
+			if type(instance) is not Instance:
+				self.log.exception("Argument is not of type Instance, but of type %s" % (type(instance)))
+				raise TypeError
 
 		self.acquireLock(self.instanceLock)
 		try:
-			if (instance.id is not None and instance.id not in self.instances):
-				self.acquireLock(self.instanceIdLock)
-				if (instance.id >= self.maxInstanceId):
-					self.maxInstanceId = instance.id + 1
-				self.releaseLock(self.instanceIdLock)
-			else:
-				instance.id = self.getNewInstanceId()
-			instance._lock = threading.Lock()
-			self.lockNames[instance._lock] = "i%d" % (instance.id)
-			self.acquireLock(instance._lock)
-			self.instances[instance.id] = instance
+			needIds = []
+			claimed = set()
+			for instance in instances:
+				if (instance.id is not None and instance.id not in self.instances and instance.id not in claimed):
+					claimed.add(instance.id)
+					self.acquireLock(self.instanceIdLock)
+					if (instance.id >= self.maxInstanceId):
+						self.maxInstanceId = instance.id + 1
+					self.releaseLock(self.instanceIdLock)
+				else:
+					needIds.append(instance)
+			for (instance, _id) in zip(needIds, self.getNewInstanceIds(len(needIds))):
+				instance.id = _id
+			for instance in instances:
+				instance._lock = threading.Lock()
+				self.lockNames[instance._lock] = "i%d" % (instance.id)
+				self.acquireLock(instance._lock)
+				self.instances[instance.id] = instance
+				self.changes.added('instances', instance)
 		finally:
 			self.releaseLock(self.instanceLock)
-		return instance
+		self.flushChanges()
+		return instances
 	
 	def acquireInstance(self, instanceId):
 		self.acquireLock(self.instanceLock)
@@ -112,6 +139,7 @@ class FromConfig(DataInterface):
 			self.acquireLock(instance._lock)
 		finally:
 			self.releaseLock(self.instanceLock)
+		self.changes.fingerprint(instance)
 		return instance
 	
 	def releaseInstance(self, instance):
@@ -122,8 +150,10 @@ class FromConfig(DataInterface):
 		try:
 			if (instance.id not in self.instances): # MPR: should never be true, but good to check
 				raise TashiException(d={'errno':Errors.NoSuchInstanceId,'msg':"No such instanceId - %d" % (instance.id)})
+			self.changes.changed('instances', instance)
 		finally:
 			self.releaseLock(instance._lock)
+		self.flushChanges()
 	
 	def removeInstance(self, instance):
 		if type(instance) is not Instance:
@@ -133,26 +163,48 @@ class FromConfig(DataInterface):
 		self.acquireLock(self.instanceLock)
 		try:
 			del self.instances[instance.id]
+			self.changes.removed('instances', instance)
 			self.releaseLock(instance._lock)
 		finally:
 			self.releaseLock(self.instanceLock)
+		self.flushChanges()
 	
 	def acquireHost(self, hostId):
 		if type(hostId) is not int:
 			self.log.exception("Argument is not of type int, but of type %s" % (type(hostId)))
 			raise TypeError
 
+		self.hostLock.acquire()
+		try:
+			if (hostId not in self.hosts):
+				raise TashiException(d={'errno':Errors.NoSuchHostId,'msg':"No such hostId - %s" % (hostId)})
+			lock = self.getHostLock(hostId)
+		finally:
+			self.hostLock.release()
+
+		# wait for this host only, not for others being changed
+		self.acquireLock(lock)
 		self.hostLock.acquire()
 		host = self.hosts.get(hostId, None)
+		self.hostLock.release()
 		if (host is None):
+			# unregistered meanwhile
+			self.releaseLock(lock)
 			raise TashiException(d={'errno':Errors.NoSuchHostId,'msg':"No such hostId - %s" % (hostId)})
-		# hostLocks dict added when registerHost was implemented, otherwise newly added hosts don't have _lock 
-		self.hostLocks[hostId] = self.hostLocks.get(hostId, threading.Lock())
-		host._lock = self.hostLocks[host.id]
-		self.acquireLock(host._lock)
+		host._lock = lock
+		self.changes.fingerprint(host)
 		return host
 
-	
+	def getHostLock(self, hostId):
+		"""Returns the lock of host hostId, expects self.hostLock to be
+		   held or the host map not to be shared yet"""
+		lock = self.hostLocks.get(hostId, None)
+		if (lock is None):
+			lock = threading.Lock()
+			self.lockNames[lock] = "h%d" % (hostId)
+			self.hostLocks[hostId] = lock
+		return lock
+
 	def releaseHost(self, host):
 		if type(host) is not Host:
 			self.log.exception("Argument is not of type Host, but of type %s" % (type(host)))
@@ -161,28 +213,11 @@ class FromConfig(DataInterface):
 		try:
 			if (host.id not in self.hosts): # MPR: should never be true, but good to check
 				raise TashiException(d={'errno':Errors.NoSuchHostId,'msg':"No such hostId - %s" % (host.id)})
+			self.changes.changed('hosts', host)
 		finally:
-			self.save()
 			self.releaseLock(host._lock)
-			self.hostLock.release()
-	
-	def getHosts(self):
-		return self.hosts
-	
-	def getHost(self, _id):
-		host = self.hosts.get(_id, None)
-		if (not host):
-			raise TashiException(d={'errno':Errors.NoSuchHostId,'msg':"No such hostId - %s" % (_id)})
-		return host
-
-	def getInstances(self):
-		return self.instances
-	
-	def getInstance(self, _id):
-		instance = self.instances.get(_id, None)
-		if (not instance):
-			raise TashiException(d={'errno':Errors.NoSuchInstanceId,'msg':"No such instanceId - %d" % (_id)})
-		return instance
+			self.requestSave()
+		self.flushChanges()
 	
 	def getNetworks(self):
 		return self.networks
@@ -198,27 +233,57 @@ class FromConfig(DataInterface):
 		
 	def registerHost(self, hostname, memory, cores, version):
 		self.hostLock.acquire()
-		for _id in self.hosts.keys():
-			if self.hosts[_id].name == hostname:
-				host = Host(d={'id':_id,'name':hostname,'state':HostState.Normal,'memory':memory,'cores':cores,'version':version})
+		_id = None
+		for hostId in self.hosts.keys():
+			if self.hosts[hostId].name == hostname:
+				_id = hostId
+				lock = self.getHostLock(_id)
+				break
+
+		if (_id is None):
+			# this is a new host
+			try:
+				_id = self.getNewId("hosts")
+				host = Host(d={'id':_id,'name':hostname,'state':HostState.Normal,'memory':memory,'cores':cores,'version':version, 'up':False, 'decayed':False, 'notes':'', 'reserved':[]})
+				host._lock = self.getHostLock(_id)
 				self.hosts[_id] = host
-				self.save()
+				self.changes.added('hosts', host)
+			finally:
 				self.hostLock.release()
-				return _id, True
+			self.requestSave()
+			self.flushChanges()
+			return _id, False
 
-		# this is a new host
-		_id = self.getNewId("hosts")
-		self.hosts[_id] = Host(d={'id':_id,'name':hostname,'state':HostState.Normal,'memory':memory,'cores':cores,'version':version, 'up':False, 'decayed':False, 'notes':'', 'reserved':[]})
-		self.save()
 		self.hostLock.release()
-		return _id, False
+		# wait for whoever has the old one to finish with it
+		self.acquireLock(lock)
+		try:
+			host = Host(d={'id':_id,'name':hostname,'state':HostState.Normal,'memory':memory,'cores':cores,'version':version})
+			host._lock = lock
+			self.hostLock.acquire()
+			self.hosts[_id] = host
+			self.hostLock.release()
+			self.changes.changed('hosts', host)
+		finally:
+			self.releaseLock(lock)
+		self.requestSave()
+		self.flushChanges()
+		return _id, True
 		
 	def unregisterHost(self, hostId):
 		# what about VMs that may run on this host?
+		host = self.acquireHost(hostId)
 		self.hostLock.acquire()
-		del self.hosts[hostId]
-		self.save()
-		self.hostLock.release()
+		try:
+			del self.hosts[hostId]
+			# anyone waiting for the host finds it gone
+			del self.hostLocks[hostId]
+		finally:
+			self.hostLock.release()
+		self.changes.removed('hosts', host)
+		self.releaseLock(host._lock)
+		self.requestSave()
+		self.flushChanges()
 
 	def getNewId(self, table):
 		""" Generates id for a new object. For example for hosts and users.  
@@ -243,6 +308,34 @@ class FromConfig(DataInterface):
 			self.idLock.release()
 			return maxId + 1
 		
+	def flushChanges(self):
+		"""Called once a change has been made and its locks released;
+		   stores that keep changes on disk wait for them here"""
+		pass
+
+	def requestSave(self):
+		"""Saves after saveDelay seconds, once for all changes made
+		   until then"""
+		self.saveCv.acquire()
+		self.saveRequested = True
+		self.saveCv.notify()
+		self.saveCv.release()
+
+	def __saver(self):
+		while True:
+			self.saveCv.acquire()
+			while not self.saveRequested:
+				self.saveCv.wait()
+			self.saveCv.release()
+			time.sleep(self.saveDelay)
+			self.saveCv.acquire()
+			self.saveRequested = False
+			self.saveCv.release()
+			try:
+				self.save()
+			except Exception:
+				self.log.exception("Failed to save hosts")
+
 	def save(self):
 		# XXXstroucki: a relative path? Where does it go
 		# and in what order does it get loaded
@@ -266,8 +359,7 @@ class FromConfig(DataInterface):
 		for h in hostsInFile:
 			parser.remove_option("FromConfig", h)
 			
-		for hId in self.hosts.keys():
-			host = self.hosts[hId]
+		for (hId, host) in self.getHosts().iteritems():
 			hostPresentation = "Host(d={'id':%s,'name':'%s','state':HostState.Normal,'memory':%s,'cores':%s,'version':'%s'})" % (hId, host.name, host.memory, host.cores, host.version)
 			parser.set("FromConfig", "host%s" % hId, hostPresentation)
 		
@@ -33,6 +33,7 @@ class GetentOverride(DataInterface):
 		self.localFileName = config.get("GetentOverride", "getentLocalFile")
 
 		self.users = {}
+		self.usersByName = {}
 		self.lastUserUpdate = 0.0
 		self.fetchThreshold = float(config.get("GetentOverride", "fetchThreshold"))
 	
@@ -43,6 +44,9 @@ class GetentOverride(DataInterface):
 
 		return self.baseDataObject.registerInstance(instance)
 	
+	def registerInstances(self, instances):
+		return self.baseDataObject.registerInstances(instances)
+	
 	def acquireInstance(self, instanceId):
 		return self.baseDataObject.acquireInstance(instanceId)
 	
@@ -86,6 +90,33 @@ class GetentOverride(DataInterface):
 	def getInstance(self, _id):
 		return self.baseDataObject.getInstance(_id)
 	
+	def getGeneration(self):
+		return self.baseDataObject.getGeneration()
+
+	def getInstancesSince(self, generation):
+		return self.baseDataObject.getInstancesSince(generation)
+
+	def getHostsSince(self, generation):
+		return self.baseDataObject.getHostsSince(generation)
+
+	def addChangeListener(self, listener):
+		return self.baseDataObject.addChangeListener(listener)
+
+	def getInstancesByHost(self, hostId):
+		return self.baseDataObject.getInstancesByHost(hostId)
+
+	def getInstancesByName(self, name):
+		return self.baseDataObject.getInstancesByName(name)
+
+	def getInstancesByUser(self, userId):
+		return self.baseDataObject.getInstancesByUser(userId)
+
+	def getInstancesByState(self, state):
+		return self.baseDataObject.getInstancesByState(state)
+
+	def getHostsByName(self, name):
+		return self.baseDataObject.getHostsByName(name)
+	
 	def getNetworks(self):
 		return self.baseDataObject.getNetworks()
 	
@@ -107,6 +138,7 @@ class GetentOverride(DataInterface):
 		now = time.time()
 		if (now - self.lastUserUpdate > self.fetchThreshold):
 			myUsers = {}
+			myUsersByName = {}
             #  Use local getent file instead of querying the administrative db
 			if self.useLocal:
 				if os.path.exists(self.localFileName):
@@ -128,7 +160,9 @@ class GetentOverride(DataInterface):
 					user.id = _id
 					user.name = name
 					myUsers[_id] = user
+					myUsersByName[name] = user
 				self.users = myUsers
+				self.usersByName = myUsersByName
 				self.lastUserUpdate = now
 			finally:	
 				p.wait()
@@ -140,6 +174,10 @@ class GetentOverride(DataInterface):
 	def getUser(self, _id):
 		self.fetchFromGetent()
 		return self.users[_id]
+
+	def getUserByName(self, name):
+		self.fetchFromGetent()
+		return self.usersByName.get(name, None)
 		
 	def registerHost(self, hostname, memory, cores, version):
 		return self.baseDataObject.registerHost(hostname, memory, cores, version)
@@ -0,0 +1,359 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import cPickle
+import logging
+import os
+import struct
+import threading
+import time
+
+frameHeader = struct.Struct("!I")
+
+class Batch(object):
+	"""Records written out together, and how that went"""
+	def __init__(self):
+		self.frames = []
+		self.done = False
+		self.error = None
+
+class Journal(object):
+	"""Write-ahead log of changes to a data store, next to a snapshot of
+	   the whole store.
+
+	   Records are appended to "<snapshot>.journal", each a 4 byte
+	   length followed by a pickle. One thread writes them out, as many
+	   as have been appended since its last write, and fsyncs once for
+	   all of them. With sync, append waits for its record to be on
+	   disk, or, called with wait=False, leaves that to a later flush
+	   from the same thread, so that records can be appended while
+	   holding locks. Every compactInterval seconds, or sooner once the
+	   journal has grown past compactBytes, a new snapshot is written
+	   from takeSnapshot and the journal started afresh. If a write
+	   fails, append or flush raises IOError for the records in it, and
+	   a compaction is started so that the snapshot picks up what they
+	   described.
+
+	   Records must describe whole objects, so that replaying one that
+	   is already reflected in the snapshot does no harm."""
+
+	def __init__(self, snapshotFile, takeSnapshot, sync=True, compactInterval=300.0, compactBytes=16*1024*1024):
+		self.log = logging.getLogger(__name__)
+		self.snapshotFile = snapshotFile
+		self.journalFile = "%s.journal" % (snapshotFile)
+		# journal being compacted away
+		self.oldJournalFile = "%s.journal.old" % (snapshotFile)
+		self.takeSnapshot = takeSnapshot
+		self.sync = sync
+		self.compactInterval = compactInterval
+		self.compactBytes = compactBytes
+		self.cv = threading.Condition()
+		self.batch = Batch()
+		# batches each thread appended to without waiting
+		self.pending = threading.local()
+		# held while writing to, or swapping, the journal file
+		self.fileLock = threading.Lock()
+		self.filehandle = None
+		self.size = 0
+		# set when the journal could not be cut back after a failed
+		# write; nothing more is written to it until it is swapped
+		self.broken = None
+		self.compactNow = threading.Event()
+
+	def load(self):
+		"""Returns the snapshot, or None if there is none, and the
+		   records journaled since, oldest first"""
+		snapshot = None
+		if os.access(self.snapshotFile, os.F_OK):
+			filehandle = open(self.snapshotFile, "rb")
+			try:
+				snapshot = cPickle.load(filehandle)
+			finally:
+				filehandle.close()
+		records = []
+		for filename in [self.oldJournalFile, self.journalFile]:
+			if os.access(filename, os.F_OK):
+				records.extend(self.__read(filename))
+		return (snapshot, records)
+
+	def __read(self, filename):
+		records = []
+		filehandle = open(filename, "r+b")
+		try:
+			good = 0
+			while True:
+				header = filehandle.read(frameHeader.size)
+				if len(header) == 0:
+					break
+				try:
+					if len(header) < frameHeader.size:
+						raise EOFError("partial header")
+					(length,) = frameHeader.unpack(header)
+					data = filehandle.read(length)
+					if len(data) < length:
+						raise EOFError("partial record")
+					records.append(cPickle.loads(data))
+				except Exception, e:
+					# a write cut short by a crash; what
+					# follows cannot be trusted either
+					self.log.warning("Ignoring %s from offset %d on: %s" % (filename, good, e))
+					filehandle.truncate(good)
+					break
+				good = filehandle.tell()
+		finally:
+			filehandle.close()
+		return records
+
+	def start(self):
+		"""Opens the journal for appending and starts writing"""
+		self.filehandle = open(self.journalFile, "ab")
+		self.size = self.filehandle.tell()
+		for target in [self.__write, self.__compact]:
+			thread = threading.Thread(target=target)
+			thread.setDaemon(True)
+			thread.start()
+
+	def append(self, record, wait=True):
+		data = cPickle.dumps(record, 2)
+		self.cv.acquire()
+		try:
+			batch = self.batch
+			batch.frames.append(frameHeader.pack(len(data)) + data)
+			self.cv.notifyAll()
+			if not self.sync:
+				return
+			if wait:
+				self.__wait([batch])
+				return
+			pending = getattr(self.pending, 'batches', [])
+			if len(pending) == 0 or pending[-1] is not batch:
+				pending.append(batch)
+			self.pending.batches = pending
+		finally:
+			self.cv.release()
+
+	def flush(self):
+		"""Waits for the records this thread appended without waiting
+		   to be on disk"""
+		pending = getattr(self.pending, 'batches', [])
+		if len(pending) == 0:
+			return
+		self.pending.batches = []
+		self.cv.acquire()
+		try:
+			self.__wait(pending)
+		finally:
+			self.cv.release()
+
+	def __wait(self, batches):
+		# expects self.cv to be held
+		for batch in batches:
+			while not batch.done:
+				self.cv.wait()
+		for batch in batches:
+			if batch.error is not None:
+				raise IOError("Failed to journal record: %s" % (batch.error))
+
+	def __write(self):
+		while True:
+			self.cv.acquire()
+			try:
+				while len(self.batch.frames) == 0:
+					self.cv.wait()
+				batch = self.batch
+				self.batch = Batch()
+			finally:
+				self.cv.release()
+
+			data = "".join(batch.frames)
+			self.fileLock.acquire()
+			try:
+				try:
+					if self.broken is not None:
+						raise self.broken
+					self.filehandle.write(data)
+					self.filehandle.flush()
+					os.fsync(self.filehandle.fileno())
+					self.size += len(data)
+				except (IOError, OSError), e:
+					self.log.exception("Failed to write %d records to %s" % (len(batch.frames), self.journalFile))
+					batch.error = e
+					self.__cut()
+			finally:
+				self.fileLock.release()
+
+			self.cv.acquire()
+			batch.done = True
+			self.cv.notifyAll()
+			self.cv.release()
+			if batch.error is not None or self.size > self.compactBytes:
+				self.compactNow.set()
+
+	def __cut(self):
+		# drop whatever part of a failed write made it out, so that
+		# later records are not stuck behind a torn one on replay
+		if self.broken is not None:
+			return
+		try:
+			self.filehandle.truncate(self.size)
+			self.filehandle.flush()
+			os.fsync(self.filehandle.fileno())
+		except (IOError, OSError), e:
+			self.log.exception("Failed to truncate %s" % (self.journalFile))
+			self.broken = e
+
+	def __compact(self):
+		while True:
+			self.compactNow.wait(self.compactInterval)
+			self.compactNow.clear()
+			try:
+				self.compact()
+			except Exception:
+				self.log.exception("Failed to compact %s" % (self.journalFile))
+				time.sleep(10)
+
+	def compact(self):
+		"""Writes a new snapshot and drops the journal up to it"""
+		start = time.time()
+		# changes made from here on go to a new journal; the
+		# snapshot taken next may include some of them, which is
+		# harmless
+		self.fileLock.acquire()
+		try:
+			# after a failed compaction the old journal is still
+			# needed; keep adding to the current one instead
+			if not os.access(self.oldJournalFile, os.F_OK):
+				try:
+					self.filehandle.close()
+				except (IOError, OSError):
+					# everything that counts has been fsynced
+					self.log.exception("Failed to close %s" % (self.journalFile))
+				os.rename(self.journalFile, self.oldJournalFile)
+				self.filehandle = open(self.journalFile, "ab")
+				self.size = 0
+				self.broken = None
+		finally:
+			self.fileLock.release()
+
+		newFile = "%s.new" % (self.snapshotFile)
+		filehandle = open(newFile, "wb")
+		try:
+			cPickle.dump(self.takeSnapshot(), filehandle, 2)
+			filehandle.flush()
+			os.fsync(filehandle.fileno())
+		finally:
+			filehandle.close()
+		os.rename(newFile, self.snapshotFile)
+		os.unlink(self.oldJournalFile)
+		self.log.info("Compacted %s in %.2f seconds" % (self.journalFile, time.time() - start))
+
+import errno
+import shutil
+import tempfile
+import unittest
+
+class FullFile(object):
+	"""Journal file on a full disk"""
+	def __init__(self, filehandle):
+		self.filehandle = filehandle
+	def write(self, data):
+		raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+	truncate = write
+	def close(self):
+		self.filehandle.close()
+
+class TestJournal(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.snapshotFile = os.path.join(self.dir, "store")
+		self.state = {}
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def waitForSnapshot(self):
+		deadline = time.time() + 5.0
+		while not os.access(self.snapshotFile, os.F_OK) and time.time() < deadline:
+			time.sleep(0.01)
+
+	def journal(self):
+		return Journal(self.snapshotFile, lambda: dict(self.state), compactInterval=3600.0)
+
+	def testReplay(self):
+		journal = self.journal()
+		journal.start()
+		for i in range(3):
+			journal.append(('hosts', 'changed', i))
+		self.assertEqual(self.journal().load(), (None, [('hosts', 'changed', i) for i in range(3)]))
+
+	def testTruncation(self):
+		journal = self.journal()
+		journal.start()
+		journal.append(('hosts', 'changed', 1))
+		good = os.path.getsize(journal.journalFile)
+		# a record cut short by a crash
+		data = cPickle.dumps(('hosts', 'changed', 2), 2)
+		filehandle = open(journal.journalFile, "ab")
+		filehandle.write(frameHeader.pack(len(data)) + data[:-1])
+		filehandle.close()
+		self.assertEqual(self.journal().load(), (None, [('hosts', 'changed', 1)]))
+		self.assertEqual(os.path.getsize(journal.journalFile), good)
+
+	def testCompaction(self):
+		journal = self.journal()
+		journal.start()
+		self.state[1] = 'a'
+		journal.append(('hosts', 'changed', 1))
+		journal.compact()
+		self.assertEqual(self.journal().load(), ({1: 'a'}, []))
+		self.assertFalse(os.access(journal.oldJournalFile, os.F_OK))
+		journal.append(('hosts', 'changed', 2))
+		self.assertEqual(self.journal().load(), ({1: 'a'}, [('hosts', 'changed', 2)]))
+
+	def testFlush(self):
+		journal = self.journal()
+		journal.start()
+		for i in range(3):
+			journal.append(('hosts', 'changed', i), wait=False)
+		journal.flush()
+		self.assertEqual(self.journal().load(), (None, [('hosts', 'changed', i) for i in range(3)]))
+		journal.fileLock.acquire()
+		journal.filehandle = FullFile(journal.filehandle)
+		journal.fileLock.release()
+		journal.append(('hosts', 'changed', 3), wait=False)
+		self.assertRaises(IOError, journal.flush)
+		# reported once
+		journal.flush()
+		self.waitForSnapshot()
+
+	def testWriteFailure(self):
+		journal = self.journal()
+		journal.start()
+		journal.fileLock.acquire()
+		journal.filehandle = FullFile(journal.filehandle)
+		journal.fileLock.release()
+		self.state[1] = 'a'
+		self.assertRaises(IOError, journal.append, ('hosts', 'changed', 1))
+		# the failure starts a compaction, which gets a fresh journal
+		self.waitForSnapshot()
+		journal.append(('hosts', 'changed', 2))
+		self.assertEqual(self.journal().load(), ({1: 'a'}, [('hosts', 'changed', 2)]))
+
+if __name__ == '__main__':
+	logging.basicConfig(level=logging.CRITICAL)
+	suite = unittest.TestLoader().loadTestsFromTestCase(TestJournal)
+	unittest.TextTestRunner(verbosity=2).run(suite)
@@ -28,6 +28,7 @@ class LdapOverride(DataInterface):
 		DataInterface.__init__(self, config)
 		self.baseDataObject = instantiateImplementation(config.get("LdapOverride", "baseData"), config)
 		self.users = {}
+		self.usersByName = {}
 		self.lastUserUpdate = 0.0
 		self.fetchThreshold = float(config.get("LdapOverride", "fetchThreshold"))
 		self.nameKey = config.get("LdapOverride", "nameKey")
@@ -38,6 +39,9 @@ class LdapOverride(DataInterface):
 	def registerInstance(self, instance):
 		return self.baseDataObject.registerInstance(instance)
 	
+	def registerInstances(self, instances):
+		return self.baseDataObject.registerInstances(instances)
+	
 	def acquireInstance(self, instanceId):
 		return self.baseDataObject.acquireInstance(instanceId)
 	
@@ -65,6 +69,33 @@ class LdapOverride(DataInterface):
 	def getInstance(self, _id):
 		return self.baseDataObject.getInstance(_id)
 	
+	def getGeneration(self):
+		return self.baseDataObject.getGeneration()
+
+	def getInstancesSince(self, generation):
+		return self.baseDataObject.getInstancesSince(generation)
+
+	def getHostsSince(self, generation):
+		return self.baseDataObject.getHostsSince(generation)
+
+	def addChangeListener(self, listener):
+		return self.baseDataObject.addChangeListener(listener)
+
+	def getInstancesByHost(self, hostId):
+		return self.baseDataObject.getInstancesByHost(hostId)
+
+	def getInstancesByName(self, name):
+		return self.baseDataObject.getInstancesByName(name)
+
+	def getInstancesByUser(self, userId):
+		return self.baseDataObject.getInstancesByUser(userId)
+
+	def getInstancesByState(self, state):
+		return self.baseDataObject.getInstancesByState(state)
+
+	def getHostsByName(self, name):
+		return self.baseDataObject.getHostsByName(name)
+	
 	def getNetworks(self):
 		return self.baseDataObject.getNetworks()
 	
@@ -86,6 +117,7 @@ class LdapOverride(DataInterface):
 		now = time.time()
 		if (now - self.lastUserUpdate > self.fetchThreshold):
 			myUsers = {}
+			myUsersByName = {}
 			#p = subprocess.Popen("getent passwd".split(), stdout=subprocess.PIPE)
 			p = subprocess.Popen(self.ldapCommand.split(), stdout=subprocess.PIPE)
 			try:
@@ -98,6 +130,7 @@ class LdapOverride(DataInterface):
 								user.id = int(thisUser[self.idKey])
 								user.name = thisUser[self.nameKey]
 								myUsers[user.id] = user
+								myUsersByName[user.name] = user
 							thisUser = {}
 						else:
 							(key, __sep, val) = l.partition(":")
@@ -107,6 +140,7 @@ class LdapOverride(DataInterface):
 					except:
 						pass
 				self.users = myUsers
+				self.usersByName = myUsersByName
 				self.lastUserUpdate = now
 			finally:
 				p.wait()
@@ -118,6 +152,10 @@ class LdapOverride(DataInterface):
 	def getUser(self, _id):
 		self.fetchFromLdap()
 		return self.users[_id]
+
+	def getUserByName(self, name):
+		self.fetchFromLdap()
+		return self.usersByName.get(name, None)
 		
 	def registerHost(self, hostname, memory, cores, version):
 		return self.baseDataObject.registerHost(hostname, memory, cores, version)
@@ -16,13 +16,16 @@
 # under the License.    
 
 import logging
-import cPickle
-import os
 import threading
-from tashi.rpycservices.rpyctypes import Instance, Host
+from tashi.util import boolean
 from tashi.clustermanager.data import FromConfig, DataInterface
+from tashi.clustermanager.data.journal import Journal
 
 class Pickled(FromConfig):
+	"""Keeps instances and hosts in a pickle file. Changes are appended
+	   to a journal next to it as they are made, and folded into the
+	   file from time to time, see Journal."""
+
 	def __init__(self, config):
 		DataInterface.__init__(self, config)
 		self.log = logging.getLogger(__name__)
@@ -37,48 +40,55 @@ class Pickled(FromConfig):
 		self.hostLock = threading.Lock()
 		self.hostLocks = {}
 		self.idLock = threading.Lock()
-		self.dbLock = threading.Lock()
+		self.journal = Journal(self.file, self.__snapshot,
+			sync=boolean(self.config.get("Pickled", "journalSync", True)),
+			compactInterval=float(self.config.get("Pickled", "compactInterval", 300.0)),
+			compactBytes=self.config.getint("Pickled", "compactBytes", 16*1024*1024))
 		self.load()
-	
-	def cleanInstances(self):
-		ci = {}
-		for __ignore, i in self.instances.items():
-			i2 = Instance(d=i.__dict__)
-			ci[i2.id] = i2
-		return ci
-	
-	def cleanHosts(self):
-		ch = {}
-		for __ignore, h in self.hosts.items():
-			h2 = Host(d=h.__dict__)
-			ch[h2.id] = h2
-		return ch
-	
-	def save(self):
-		filename = self.file
-		# XXXstroucki could be better
-		tempfile = "%s.new" % filename
+		self.rebuildViews(self.instances, self.hosts)
+		self.addChangeListener(self.__journal)
+		self.journal.start()
 
-		self.dbLock.acquire()
-		try:
-			filehandle = open(tempfile, "w")
-			cPickle.dump((self.cleanHosts(), self.cleanInstances(), self.networks, self.users), filehandle)
-			filehandle.close()
-			os.rename(tempfile, filename)
+	def __snapshot(self):
+		# the snapshots are published before a change reaches the
+		# journal, so they hold everything journaled up to now
+		return (self.getHosts(), self.getInstances(), self.networks, self.users)
 
-		except OSError:
-			self.log.exception("Error saving database")
+	def __journal(self, generation, kind, change, old, new):
+		# listeners run under the data locks; flushChanges waits
+		# for the disk once they are released
+		if change == 'removed':
+			self.journal.append((kind, change, old.id), wait=False)
+		else:
+			self.journal.append((kind, change, new), wait=False)
+
+	def flushChanges(self):
+		self.journal.flush()
 
-		finally:
-			self.dbLock.release()
+	def requestSave(self):
+		# changes are journaled as they are made
+		pass
+
+	def save(self):
+		self.journal.compact()
 
 	def load(self):
-		if (os.access(self.file, os.F_OK)):
-			filehandle = open(self.file, "r")
-			(hosts, instances, networks, users) = cPickle.load(filehandle)
-			filehandle.close()
+		(snapshot, records) = self.journal.load()
+		if snapshot is not None:
+			(hosts, instances, networks, users) = snapshot
 		else:
 			(hosts, instances, networks, users) = ({}, {}, {}, {})
+		for (kind, change, obj) in records:
+			if kind == 'instances':
+				objects = instances
+			else:
+				objects = hosts
+			if change == 'removed':
+				objects.pop(obj, None)
+			else:
+				objects[obj.id] = obj
+		if len(records) > 0:
+			self.log.info("Replayed %d changes from %s" % (len(records), self.journal.journalFile))
 		self.hosts = hosts
 		self.instances = instances
 		self.networks = networks
@@ -89,5 +99,4 @@ class Pickled(FromConfig):
 			i._lock = threading.Lock()
 			self.lockNames[i._lock] = "i%d" % (i.id)
 		for __ignore, h in self.hosts.items():
-			h._lock = threading.Lock()
-			self.lockNames[h._lock] = "h%d" % (h.id)
+			h._lock = self.getHostLock(h.id)
@@ -15,14 +15,112 @@
 # specific language governing permissions and limitations
 # under the License.    
 
+import cPickle
+import json
 import logging
+import sys
 import threading
+import time
+import traceback
 # XXXstroucki getImages needs os?
 import os
-from tashi.rpycservices.rpyctypes import Errors, Network, Host, User, Instance, TashiException, LocalImages, DiskConfiguration, NetworkConfiguration
+from tashi.rpycservices.rpyctypes import Errors, Network, Host, User, Instance, TashiException, LocalImages, DiskConfiguration, NetworkConfiguration, SlottedType
 from tashi.clustermanager.data.datainterface import DataInterface
 from tashi.util import stringPartition, boolean, instantiateImplementation, humanReadable
 
+# the layout of disks, nics, hints and reserved; see __migrate
+schemaVersion = 2
+
+def toJson(value):
+	return json.dumps(value, separators=(',', ':'), default=__jsonDefault)
+
+def __jsonDefault(value):
+	if isinstance(value, SlottedType):
+		return value.toDict()
+	return str(value)
+
+def fromJson(text):
+	return plain(json.loads(text))
+
+def plain(value):
+	"""Turns the unicode strings json produces into str"""
+	if isinstance(value, unicode):
+		return value.encode('utf-8')
+	if isinstance(value, list):
+		return [plain(v) for v in value]
+	if isinstance(value, dict):
+		return dict([(plain(k), plain(v)) for (k, v) in value.iteritems()])
+	return value
+
+def __str(value):
+	if type(value) is unicode:
+		return value.encode('utf-8')
+	return value
+
+def makeDisks(disks):
+	"""Returns DiskConfigurations for the decoded json of a disks
+	   column. Only the fields known to hold strings are converted,
+	   which is a lot quicker than plain."""
+	if disks is None:
+		return None
+	return [DiskConfiguration(d={'uri':__str(d.get('uri')), 'persistent':d.get('persistent')}) for d in disks]
+
+def makeNics(nics):
+	if nics is None:
+		return None
+	return [NetworkConfiguration(d={'network':n.get('network'), 'mac':__str(n.get('mac')), 'ip':__str(n.get('ip'))}) for n in nics]
+
+def makeHints(hints):
+	if hints is None:
+		return None
+	return dict([(__str(k), plain(v)) for (k, v) in hints.iteritems()])
+
+class ConnectionPool(object):
+	"""Hands out database connections, opening up to size of them. A
+	   connection is used by one thread at a time; threads that find
+	   them all busy wait for one to be put back."""
+
+	def __init__(self, connect, size):
+		self.connect = connect
+		self.size = max(1, size)
+		self.idle = []
+		self.opened = 0
+		self.cv = threading.Condition()
+
+	def get(self):
+		self.cv.acquire()
+		try:
+			while len(self.idle) == 0 and self.opened >= self.size:
+				self.cv.wait()
+			if len(self.idle) > 0:
+				return self.idle.pop()
+			self.opened += 1
+		finally:
+			self.cv.release()
+		try:
+			return self.connect()
+		except:
+			self.discard(None)
+			raise
+
+	def put(self, conn):
+		self.cv.acquire()
+		self.idle.append(conn)
+		self.cv.notify()
+		self.cv.release()
+
+	def discard(self, conn):
+		"""Forgets a connection that can no longer be used"""
+		if conn is not None:
+			try:
+				conn.close()
+			except Exception:
+				pass
+		self.cv.acquire()
+		self.opened -= 1
+		self.cv.notify()
+		self.cv.release()
+
 class SQL(DataInterface):
 	def __init__(self, config):
 		DataInterface.__init__(self, config)
@@ -31,176 +129,343 @@ class SQL(DataInterface):
 		self.dfs = instantiateImplementation(config.get("ClusterManager", "dfs"), config)
 
 		if (self.uri.startswith("sqlite://")):
-			import sqlite
+			import sqlite3
 			self.dbEngine = "sqlite"
-			self.conn = sqlite.connect(self.uri[9:], autocommit=1, timeout=1500)
+			self.db = sqlite3
+			path = self.uri[9:]
+			self.busyTimeout = float(self.config.get("SQL", "busyTimeout", 1.5))
+			if (boolean(self.config.get("SQL", "sharedCache", False))):
+				# connections share one page cache, and lock
+				# tables rather than the whole file
+				sqlite3.enable_shared_cache(True)
+			def connect():
+				conn = sqlite3.connect(path, timeout=self.busyTimeout, check_same_thread=False)
+				conn.text_factory = str
+				return conn
 		elif (self.uri.startswith("mysql://")):
 			import MySQLdb
 			self.dbEngine = "mysql"
+			self.db = MySQLdb
 			uri = self.uri[8:]
 			(user, _, hostdb) = stringPartition(uri, '@')
 			(host, _, db) = stringPartition(hostdb, '/')
 			self.password = self.config.get('SQL', 'password')
-			self.conn = MySQLdb.connect(host=host, user=user, passwd=self.password, db=db)
+			def connect():
+				return MySQLdb.connect(host=host, user=user, passwd=self.password, db=db)
 		else:
 			raise TashiException, 'Unknown SQL database engine by URI: %s' % (self.uri)
+		self.pool = ConnectionPool(connect, self.config.getint("SQL", "connections", 8))
 
 		self.instanceOrder = ['id', 'vmId', 'hostId', 'decayed', 'state', 'userId', 'name', 'cores', 'memory', 'disks', 'nics', 'hints', 'groupName']
 		self.hostOrder = ['id', 'name', 'up', 'decayed', 'state', 'memory', 'cores', 'version', 'notes', 'reserved']
+		self.instanceInsert = "INSERT INTO instances VALUES (%s)" % (", ".join(["%s"] * len(self.instanceOrder)))
+		self.hostInsert = "INSERT INTO hosts VALUES (%s)" % (", ".join(["%s"] * len(self.hostOrder)))
+		self.hostUpdate = "UPDATE hosts SET %s WHERE id = %%s" % (", ".join([column + " = %s" for column in self.hostOrder]))
+		self.jsonColumns = set(['disks', 'nics', 'hints', 'reserved'])
+		# instanceId -> (row, pickled instance) as last written by
+		# releaseInstance, so that acquireInstance need not decode a
+		# row that has not changed since
+		self.instanceCache = {}
+		# (table, columns) -> UPDATE statement for those columns
+		self.updates = {}
 		self.instanceLock = threading.Lock()
 		self.instanceIdLock = threading.Lock()
-		self.instanceLocks = {}
-		self.instanceBusy = {}
+		# instanceId -> (thread name, thread ident, time) of whoever
+		# has the instance acquired
+		self.instanceHolders = {}
+		# instanceId -> [Condition, number of waiting threads]
+		self.instanceWaiters = {}
+		self.lockWarning = float(self.config.get("SQL", "lockWarning", 30.0))
+		self.lockTimeout = float(self.config.get("SQL", "lockTimeout", 0))
 		self.hostLock = threading.Lock()
 		self.hostLocks = {}
 		self.maxInstanceId = 1
 		self.idLock = threading.Lock()
-		self.sqlLock = threading.Lock()
 		self.verifyStructure()
+		self.rebuildViews(self.__loadInstances(), self.__loadHosts())
 
-	def executeStatement(self, stmt):
-		self.sqlLock.acquire()
-		try:
-			cur = self.conn.cursor()
+	def executeStatement(self, stmt, params=()):
+		"""Runs stmt, with %s standing for each of params, in a
+		   transaction of its own. Returns the rows it produced."""
+		return self.executeStatements([(stmt, params)])[0]
+
+	def executeStatements(self, statements):
+		"""Runs a list of (stmt, params) in one transaction. Returns a
+		   list of the rows each statement produced."""
+		deadline = None
+		while True:
+			conn = self.pool.get()
 			try:
-				cur.execute(stmt)
-			except:
-				self.log.exception('Exception executing SQL statement %s' % stmt)
-		finally:
-			self.sqlLock.release()
-		return cur
+				results = []
+				cur = conn.cursor()
+				for (stmt, params) in statements:
+					if (self.dbEngine == "sqlite"):
+						stmt = stmt.replace("%s", "?")
+					cur.execute(stmt, params)
+					if (cur.description is not None):
+						results.append(cur.fetchall())
+					else:
+						results.append([])
+				cur.close()
+				conn.commit()
+			except Exception, e:
+				try:
+					conn.rollback()
+				except Exception:
+					# broken, do not hand it out again
+					self.pool.discard(conn)
+					conn = None
+				if (conn is not None):
+					self.pool.put(conn)
+				if (self.dbEngine == "sqlite" and isinstance(e, self.db.OperationalError) and "locked" in str(e)):
+					# another connection on the shared cache
+					# has the table
+					if (deadline is None):
+						deadline = time.time() + self.busyTimeout
+					if (time.time() < deadline):
+						time.sleep(0.01)
+						continue
+					self.log.error('Gave up on SQL statements %s after %.1f seconds: %s' % ([statement for (statement, __params) in statements], self.busyTimeout, e))
+					raise
+				self.log.exception('Exception executing SQL statements %s' % ([statement for (statement, __params) in statements]))
+				raise
+			self.pool.put(conn)
+			return results
 		
 	def getNewInstanceId(self):
+		return self.getNewInstanceIds(1)[0]
+	
+	def getNewInstanceIds(self, count):
 		self.instanceIdLock.acquire()
-		cur = self.executeStatement("SELECT MAX(id) FROM instances")
-		self.maxInstanceId = cur.fetchone()[0]
+		self.maxInstanceId = self.executeStatement("SELECT MAX(id) FROM instances")[0][0]
 		# XXXstroucki perhaps this can be handled nicer
 		if (self.maxInstanceId is None):
 			self.maxInstanceId = 0
-		self.maxInstanceId = self.maxInstanceId + 1
-		instanceId = self.maxInstanceId
+		instanceId = self.maxInstanceId + 1
+		self.maxInstanceId = self.maxInstanceId + count
 		self.instanceIdLock.release()
-		return instanceId
+		return range(instanceId, instanceId + count)
 	
 	def verifyStructure(self):
 		self.executeStatement("CREATE TABLE IF NOT EXISTS instances (id int(11) NOT NULL, vmId int(11), hostId int(11), decayed tinyint(1) NOT NULL, state int(11) NOT NULL, userId int(11), name varchar(256), cores int(11) NOT NULL, memory int(11) NOT NULL, disks varchar(1024) NOT NULL, nics varchar(1024) NOT NULL, hints varchar(1024) NOT NULL, groupName varchar(256))")
 		self.executeStatement("CREATE TABLE IF NOT EXISTS hosts (id INTEGER PRIMARY KEY, name varchar(256) NOT NULL, up tinyint(1) DEFAULT 0, decayed tinyint(1) DEFAULT 0, state int(11) DEFAULT 1, memory int(11), cores int(11), version varchar(256), notes varchar(256), reserved varchar(1024))")
 		self.executeStatement("CREATE TABLE IF NOT EXISTS networks (id int(11) NOT NULL, name varchar(256) NOT NULL)")
 		self.executeStatement("CREATE TABLE IF NOT EXISTS users (id int(11) NOT NULL, name varchar(256) NOT NULL, passwd varchar(256))")
+		self.executeStatement("CREATE TABLE IF NOT EXISTS schemaVersion (version int(11) NOT NULL)")
+		rows = self.executeStatement("SELECT version FROM schemaVersion")
+		if (len(rows) == 0 or rows[0][0] < schemaVersion):
+			self.__migrate()
+
+	def __migrate(self):
+		# disks, nics, hints and reserved used to hold str() of the
+		# Python objects, read back with eval
+		statements = []
+		for (_id, disks, nics, hints) in self.executeStatement("SELECT id, disks, nics, hints FROM instances"):
+			statements.append(("UPDATE instances SET disks = %s, nics = %s, hints = %s WHERE id = %s", (toJson(eval(disks)), toJson(eval(nics)), toJson(eval(hints)), _id)))
+		for (_id, reserved) in self.executeStatement("SELECT id, reserved FROM hosts WHERE reserved IS NOT NULL"):
+			statements.append(("UPDATE hosts SET reserved = %s WHERE id = %s", (toJson(eval(reserved)), _id)))
+		# every acquireInstance looks an instance up by id
+		statements.append(("CREATE INDEX instancesById ON instances (id)", ()))
+		statements.append(("DELETE FROM schemaVersion", ()))
+		statements.append(("INSERT INTO schemaVersion VALUES (%s)", (schemaVersion,)))
+		self.executeStatements(statements)
+		self.log.info("Converted %d rows to schema version %d" % (len(statements) - 3, schemaVersion))
 	
-	def sanitizeForSql(self, s):
-		if (s == '"True"'):
-			return '"1"'
-		if (s == '"False"'):
-			return '"0"'
-		if (s == '"None"'):
-			return 'NULL'
-		return s
+	def sqlValue(self, column, value):
+		if (column in self.jsonColumns):
+			return toJson(value)
+		if (isinstance(value, bool)):
+			return int(value)
+		return value
 	
 	def makeInstanceList(self, i):
-		l = []
-		for e in range(0, len(self.instanceOrder)):
-			l.append(i.__dict__[self.instanceOrder[e]])
-		return map(lambda x: self.sanitizeForSql('"%s"' % str(x)), l)
+		return [self.sqlValue(column, getattr(i, column)) for column in self.instanceOrder]
 	
-	def makeListInstance(self, l):
+	def makeListInstance(self, l, decoded=None):
+		"""Returns the instance in row l. decoded may give the json
+		   of the disks, nics and hints columns already decoded."""
+		if (decoded is None):
+			decoded = (json.loads(l[9]), json.loads(l[10]), json.loads(l[11]))
 		i = Instance()
-		for e in range(0, len(self.instanceOrder)):
-			i.__dict__[self.instanceOrder[e]] = l[e]
+		for e in range(0, 9):
+			setattr(i, self.instanceOrder[e], l[e])
+		i.groupName = l[12]
 		i.state = int(i.state)
 		i.decayed = boolean(i.decayed)
-		i.disks = map(lambda x: DiskConfiguration(d=x), eval(i.disks))
-		i.nics = map(lambda x: NetworkConfiguration(d=x), eval(i.nics))
-		i.hints = eval(i.hints)
+		i.disks = makeDisks(decoded[0])
+		i.nics = makeNics(decoded[1])
+		i.hints = makeHints(decoded[2])
 		return i
 	
 	def makeHostList(self, h):
-		l = []
-		for e in range(0, len(self.hostOrder)):
-			l.append(h.__dict__[self.hostOrder[e]])
-		return map(lambda x: self.sanitizeForSql('"%s"' % str(x)), l)
+		return [self.sqlValue(column, getattr(h, column)) for column in self.hostOrder]
 	
 	def makeListHost(self, l):
 		h = Host()
 		for e in range(0, len(self.hostOrder)):
-			h.__dict__[self.hostOrder[e]] = l[e]
+			setattr(h, self.hostOrder[e], l[e])
 		h.up = boolean(h.up)
 		h.decayed = boolean(h.decayed)
 		h.state = int(h.state)
 		if h.reserved is not None:
-			h.reserved = eval(h.reserved)
-		else:
+			h.reserved = fromJson(h.reserved)
+		if h.reserved is None:
 			h.reserved = []
 		return h
 	
 	def registerInstance(self, instance):
-		if type(instance) is not Instance:
-			self.log.exception("Argument is not of type Instance, but of type %s" % (type(instance)))
-			raise TypeError
+		return self.registerInstances([instance])[0]
+	
+	def registerInstances(self, instances):
+		for instance in instances:
+			if type(instance) is not Instance:
+				self.log.exception("Argument is not of type Instance, but of type %s" % (type(instance)))
+				raise TypeError
 
 		self.instanceLock.acquire()
 		try:
-			if (instance.id is not None and instance.id not in self.getInstances()):
-				self.instanceIdLock.acquire()
-				if (instance.id >= self.maxInstanceId):
-					self.maxInstanceId = instance.id + 1
-				self.instanceIdLock.release()
-			else:
-				instance.id = self.getNewInstanceId()
-			instance._lock = threading.Lock()
-			self.instanceLocks[instance.id] = instance._lock
-			instance._lock.acquire()
-			self.instanceBusy[instance.id] = True
-			l = self.makeInstanceList(instance)
-			# XXXstroucki nicer?
-			self.executeStatement("INSERT INTO instances VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" % tuple(l))
+			existing = self.getInstances()
+			needIds = []
+			claimed = set()
+			for instance in instances:
+				if (instance.id is not None and instance.id not in existing and instance.id not in claimed):
+					claimed.add(instance.id)
+					self.instanceIdLock.acquire()
+					if (instance.id >= self.maxInstanceId):
+						self.maxInstanceId = instance.id + 1
+					self.instanceIdLock.release()
+				else:
+					needIds.append(instance)
+			for (instance, _id) in zip(needIds, self.getNewInstanceIds(len(needIds))):
+				instance.id = _id
+			self.executeStatements([(self.instanceInsert, self.makeInstanceList(instance)) for instance in instances])
+			for instance in instances:
+				self.__hold(instance.id)
+				instance._row = self.makeInstanceList(instance)
+				self.changes.added('instances', instance)
 		finally:
 			self.instanceLock.release()
-		return instance
+		return instances
 	
+	def __hold(self, instanceId):
+		# expects self.instanceLock to be held
+		thread = threading.currentThread()
+		self.instanceHolders[instanceId] = (thread.getName(), thread.ident, time.time())
+
+	def __waitForInstance(self, instanceId):
+		# expects self.instanceLock to be held
+		entry = self.instanceWaiters.get(instanceId, None)
+		if (entry is None):
+			entry = [threading.Condition(self.instanceLock), 0]
+			self.instanceWaiters[instanceId] = entry
+		entry[1] += 1
+		try:
+			start = time.time()
+			warned = start
+			while instanceId in self.instanceHolders:
+				holder = self.instanceHolders[instanceId]
+				if (holder[1] == threading.currentThread().ident):
+					# waiting would never end
+					raise TashiException(d={'errno':Errors.LockTimeout,'msg':"%s is waiting for instance %d, which it holds itself" % (holder[0], instanceId)})
+				now = time.time()
+				if (self.lockTimeout > 0 and now - start >= self.lockTimeout):
+					raise TashiException(d={'errno':Errors.LockTimeout,'msg':"Instance %d has been held by %s for %.0f seconds" % (instanceId, holder[0], now - holder[2])})
+				if (now - warned >= self.lockWarning):
+					warned = now
+					self.log.warning("%s has waited %.0f seconds for instance %d, held by %s for %.0f seconds, which is at:\n%s" % (threading.currentThread().getName(), now - start, instanceId, holder[0], now - holder[2], self.__stackOf(holder[1])))
+				timeout = self.lockWarning - (now - warned)
+				if (self.lockTimeout > 0):
+					timeout = min(timeout, self.lockTimeout - (now - start))
+				entry[0].wait(timeout)
+		finally:
+			entry[1] -= 1
+			if (entry[1] == 0):
+				del self.instanceWaiters[instanceId]
+
+	def __stackOf(self, ident):
+		frame = sys._current_frames().get(ident, None)
+		if (frame is None):
+			return "(thread has exited without releasing it)"
+		return "".join(traceback.format_stack(frame))
+
+	def __unhold(self, instanceId):
+		# expects self.instanceLock to be held
+		self.instanceHolders.pop(instanceId, None)
+		entry = self.instanceWaiters.get(instanceId, None)
+		if (entry is not None):
+			entry[0].notify()
+
 	def acquireInstance(self, instanceId):
-		busyCheck = True
-		while busyCheck == True:
-			self.instanceLock.acquire()
-			busyCheck = self.instanceBusy.setdefault(instanceId, False)
-			if busyCheck:
-				self.instanceLock.release()
+		self.instanceLock.acquire()
+		try:
+			self.__waitForInstance(instanceId)
+			self.__hold(instanceId)
+		finally:
+			self.instanceLock.release()
 
 		try:
-			cur = self.executeStatement("SELECT * from instances WHERE id = %d" % (instanceId))
-			l = cur.fetchone()
-			if (not l):
+			rows = self.executeStatement("SELECT * FROM instances WHERE id = %s", (instanceId,))
+			if (len(rows) == 0):
 				raise TashiException(d={'errno':Errors.NoSuchInstanceId,'msg':"No such instanceId - %d" % (instanceId)})
-			instance = self.makeListInstance(l)
-			self.instanceLocks[instance.id] = self.instanceLocks.get(instance.id, threading.Lock())
-			instance._lock = self.instanceLocks[instance.id]
-			instance._lock.acquire()
-			self.instanceBusy[instance.id] = True
-		finally:
+			cached = self.instanceCache.get(instanceId, None)
+			if (cached is not None and cached[0] == rows[0]):
+				# as this process last wrote it
+				instance = cPickle.loads(cached[1])
+			else:
+				instance = self.makeListInstance(rows[0])
+			# what is in the database, for releaseInstance to
+			# compare with
+			instance._row = self.makeInstanceList(instance)
+		except:
+			self.instanceLock.acquire()
+			self.__unhold(instanceId)
 			self.instanceLock.release()
+			raise
 
+		self.changes.fingerprint(instance)
 		return instance
+
+	def __update(self, table, obj, old, new):
+		"""Writes the columns that differ between old and new, the
+		   values of the row of obj as acquired and as released.
+		   Returns whether anything was written."""
+		if (table == 'instances'):
+			order = self.instanceOrder
+		else:
+			order = self.hostOrder
+		columns = []
+		values = []
+		for e in range(0, len(order)):
+			if (old is None or old[e] != new[e]):
+				columns.append(order[e])
+				values.append(new[e])
+		if (len(columns) == 0):
+			return False
+		key = (table, tuple(columns))
+		stmt = self.updates.get(key, None)
+		if (stmt is None):
+			stmt = "UPDATE %s SET %s WHERE id = %%s" % (table, ", ".join([column + " = %s" for column in columns]))
+			self.updates[key] = stmt
+		self.executeStatement(stmt, values + [obj.id])
+		return True
 	
 	def releaseInstance(self, instance):
 		if type(instance) is not Instance:
 			self.log.exception("Argument is not of type Instance, but of type %s" % (type(instance)))
 			raise TypeError
 
-		self.instanceLock.acquire()
 		try:
 			l = self.makeInstanceList(instance)
-			s = ""
-			for e in range(0, len(self.instanceOrder)):
-				s = s + self.instanceOrder[e] + "=" + l[e]
-				if (e < len(self.instanceOrder)-1):
-					s = s + ", "
-			self.executeStatement("UPDATE instances SET %s WHERE id = %d" % (s, instance.id))
-			self.instanceBusy[instance.id] = False
-			instance._lock.release()
+			if (self.__update('instances', instance, getattr(instance, '_row', None), l)):
+				self.instanceCache[instance.id] = (tuple(l), cPickle.dumps(instance, 2))
+			instance._row = None
+			self.changes.changed('instances', instance)
 		except:
 			self.log.exception("Excepted while holding lock")
 			raise
 		finally:
+			self.instanceLock.acquire()
+			self.__unhold(instance.id)
 			self.instanceLock.release()
 	
 	def removeInstance(self, instance):
@@ -208,17 +473,14 @@ class SQL(DataInterface):
 			self.log.exception("Argument is not of type Instance, but of type %s" % (type(instance)))
 			raise TypeError
 
-		self.instanceLock.acquire()
 		try:
-			self.executeStatement("DELETE FROM instances WHERE id = %d" % (instance.id))
-			#XXXstroucki extraneous instance won't have a lock
-			try:
-				instance._lock.release()
-			except:
-				pass
-			del self.instanceLocks[instance.id]
-			del self.instanceBusy[instance.id]
+			self.executeStatement("DELETE FROM instances WHERE id = %s", (instance.id,))
+			self.instanceCache.pop(instance.id, None)
+			self.changes.removed('instances', instance)
 		finally:
+			# anyone waiting finds it gone
+			self.instanceLock.acquire()
+			self.__unhold(instance.id)
 			self.instanceLock.release()
 	
 	def acquireHost(self, hostId):
@@ -226,12 +488,20 @@ class SQL(DataInterface):
 			self.log.exception("Argument is not of type int, but of type %s" % (type(hostId)))
 			raise TypeError
 
-		host = self.getHost(hostId)
 		self.hostLock.acquire()
-		self.hostLocks[host.id] = self.hostLocks.get(host.id, threading.Lock())
+		lock = self.hostLocks.setdefault(hostId, threading.Lock())
 		self.hostLock.release()
-		host._lock = self.hostLocks[host.id]
-		host._lock.acquire()
+		# read it only once it is ours, or the last holder's
+		# changes could be lost
+		lock.acquire()
+		try:
+			host = self.__loadHost(hostId)
+		except:
+			lock.release()
+			raise
+		host._lock = lock
+		host._row = self.makeHostList(host)
+		self.changes.fingerprint(host)
 		return host
 	
 	def releaseHost(self, host):
@@ -239,75 +509,56 @@ class SQL(DataInterface):
 			self.log.exception("Argument is not of type Host, but of type %s" % (type(host)))
 			raise TypeError
 
-		l = self.makeHostList(host)
-		s = ""
-		for e in range(0, len(self.hostOrder)):
-			s = s + self.hostOrder[e] + "=" + l[e]
-			if (e < len(self.hostOrder)-1):
-				s = s + ", "
-		self.executeStatement("UPDATE hosts SET %s WHERE id = %d" % (s, host.id))
-		host._lock.release()
+		try:
+			self.__update('hosts', host, getattr(host, '_row', None), self.makeHostList(host))
+			host._row = None
+			self.changes.changed('hosts', host)
+		finally:
+			host._lock.release()
 	
-	def getHosts(self):
-		cur = self.executeStatement("SELECT * FROM hosts")
-		res = cur.fetchall()
+	def __loadHosts(self):
 		hosts = {}
-		for r in res:
+		for r in self.executeStatement("SELECT * FROM hosts"):
 			host = self.makeListHost(r)
 			hosts[host.id] = host
 		return hosts
 	
-	def getHost(self, in_id):
+	def __loadHost(self, in_id):
 		try:
 			_id = int(in_id)
 		except TypeError:
-			self.log.exception("Argument to getHost was not integer: %s" % in_id)
+			self.log.exception("Host id was not integer: %s" % in_id)
 			raise
 
-		cur = self.executeStatement("SELECT * FROM hosts WHERE id = %d" % _id)
-		r = cur.fetchone()
-		if (r == None):
+		rows = self.executeStatement("SELECT * FROM hosts WHERE id = %s", (_id,))
+		if (len(rows) == 0):
 			raise TashiException(d={'errno':Errors.NoSuchHostId,'msg':"No such hostId - %s" % (_id)})
-		host = self.makeListHost(r)
+		host = self.makeListHost(rows[0])
 		return host
 	
-	def getInstances(self):
-		cur = self.executeStatement("SELECT * FROM instances")
-		res = cur.fetchall()
+	def __loadInstances(self):
+		rows = self.executeStatement("SELECT * FROM instances")
+		try:
+			# one call to the json decoder for all rows
+			decoded = json.loads("[%s]" % (",".join(["[%s,%s,%s]" % (r[9], r[10], r[11]) for r in rows])))
+		except ValueError:
+			# find the bad row the slow way
+			decoded = [None] * len(rows)
 		instances = {}
-		for r in res:
-			instance = self.makeListInstance(r)
+		for (r, d) in zip(rows, decoded):
+			instance = self.makeListInstance(r, d)
 			instances[instance.id] = instance
 		return instances
 	
-	def getInstance(self, in_id):
-		try:
-			_id = int(in_id)
-		except TypeError:
-			self.log.exception("Argument to getInstance was not integer: %s" % in_id)
-			raise
-
-		cur = self.executeStatement("SELECT * FROM instances WHERE id = %d" % (_id))
-		# XXXstroucki should only return one row.
-		# what about migration? should it be enforced?
-		r = cur.fetchone()
-		if (not r):
-			raise TashiException(d={'errno':Errors.NoSuchInstanceId, 'msg':"No such instanceId - %d" % (_id)})
-		instance = self.makeListInstance(r)
-		return instance
-	
 	def getNetworks(self):
-		cur = self.executeStatement("SELECT * FROM networks")
-		res = cur.fetchall()
 		networks = {}
-		for r in res:
+		for r in self.executeStatement("SELECT * FROM networks"):
 			network = Network(d={'id':r[0], 'name':r[1]})
 			networks[network.id] = network
 		return networks
 	
 	def getNetwork(self, _id):
-		cur = self.executeStatement("SELECT * FROM networks WHERE id = %d" % (_id))
-		r = cur.fetchone()
+		r = self.executeStatement("SELECT * FROM networks WHERE id = %s", (_id,))[0]
 		network = Network(d={'id':r[0], 'name':r[1]})
 		return network
 
@@ -324,66 +575,53 @@ class SQL(DataInterface):
 		return myList
 	
 	def getUsers(self):
-		cur = self.executeStatement("SELECT * from users")
-		res = cur.fetchall()
 		users = {}
-		for r in res:
+		for r in self.executeStatement("SELECT * FROM users"):
 			user = User(d={'id':r[0], 'name':r[1], 'passwd':r[2]})
 			users[user.id] = user
 		return users
 	
 	def getUser(self, _id):
-		cur = self.executeStatement("SELECT * FROM users WHERE id = %d" % (_id))
-		r = cur.fetchone()
+		r = self.executeStatement("SELECT * FROM users WHERE id = %s", (_id,))[0]
 		user = User(d={'id':r[0], 'name':r[1], 'passwd':r[2]})
 		return user
 		
 	def registerHost(self, hostname, memory, cores, version):
 		self.hostLock.acquire()
-		# does this have to be so general?
-		cur = self.executeStatement("SELECT * from hosts")
-		res = cur.fetchall()
-		for r in res:
-			if r[1] == hostname:
-				_id = r[0]
+		try:
+			rows = self.executeStatement("SELECT id FROM hosts WHERE name = %s", (hostname,))
+			if (len(rows) > 0):
+				_id = rows[0][0]
 				self.log.warning("Host %s already registered, update will be done" % _id)
-				s = ""
 				host = Host(d={'id': _id, 'up': 0, 'decayed': 0, 'state': 1, 'name': hostname, 'memory':memory, 'cores': cores, 'version':version})
-				l = self.makeHostList(host)
-				for e in range(0, len(self.hostOrder)):
-					s = s + self.hostOrder[e] + "=" + l[e]
-					if (e < len(self.hostOrder)-1):
-						s = s + ", "
-				self.executeStatement("UPDATE hosts SET %s WHERE id = %d" % (s, _id))
-				self.hostLock.release()
-				return r[0], True
-
-		# this is a new host
-		_id = self.getNewId("hosts")
-		host = Host(d={'id': _id, 'up': 0, 'decayed': 0, 'state': 1, 'name': hostname, 'memory':memory, 'cores': cores, 'version':version, 'notes':'', 'reserved':[]})
-		l = self.makeHostList(host)
-		# XXXstroucki nicer?
-		self.executeStatement("INSERT INTO hosts VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)" % tuple(l))
-		self.hostLock.release()
-		return _id, False
+				self.executeStatement(self.hostUpdate, self.makeHostList(host) + [_id])
+				self.changes.changed('hosts', host)
+				return _id, True
+
+			# this is a new host
+			_id = self.getNewId("hosts")
+			host = Host(d={'id': _id, 'up': 0, 'decayed': 0, 'state': 1, 'name': hostname, 'memory':memory, 'cores': cores, 'version':version, 'notes':'', 'reserved':[]})
+			self.executeStatement(self.hostInsert, self.makeHostList(host))
+			self.changes.added('hosts', host)
+			return _id, False
+		finally:
+			self.hostLock.release()
 	
 	def unregisterHost(self, hostId):
 		# what about VMs that may run on this host?
 		self.hostLock.acquire()
-		# does this have to be so general?
-		cur = self.executeStatement("SELECT * from hosts")
-		res = cur.fetchall()
-		for r in res:
-			if r[0] == hostId:
-				self.executeStatement("DELETE FROM hosts WHERE id = %d" % hostId)
-		self.hostLock.release()
+		try:
+			(rows, __deleted) = self.executeStatements([("SELECT * FROM hosts WHERE id = %s", (hostId,)), ("DELETE FROM hosts WHERE id = %s", (hostId,))])
+			for r in rows:
+				self.changes.removed('hosts', self.makeListHost(r))
+		finally:
+			self.hostLock.release()
 
 	def getNewId(self, table):
 		""" Generates id for a new object. For example for hosts and users.  
 		"""
 		self.idLock.acquire()
-		cur = self.executeStatement("SELECT * from %s" % table)
-		res = cur.fetchall()
+		res = self.executeStatement("SELECT id FROM %s" % table)
 		maxId = 0 # the first id would be 1
 		l = []
 		for r in res:
@@ -402,3 +640,55 @@ class SQL(DataInterface):
 		else:
 			self.idLock.release()
 			return maxId + 1
+
+if __name__ == '__main__':
+	# benchmark against a scratch sqlite database: loading all
+	# instances, and acquireInstance/releaseInstance throughput with
+	# several threads
+	import sys
+	import tempfile
+	from tashi.rpycservices.rpyctypes import InstanceState
+	from tashi.utils.config import Config
+
+	count = 10000
+	duration = 2.0
+	# run from the top of the tree, or with a config installed
+	config = Config(["ClusterManager"], ["etc/TashiDefaults.cfg"])
+	(fd, filename) = tempfile.mkstemp(suffix=".db")
+	os.close(fd)
+	config.config.set("SQL", "uri", "sqlite://%s" % (filename))
+	if len(sys.argv) > 1:
+		config.config.set("SQL", "connections", sys.argv[1])
+	try:
+		data = SQL(config)
+		instances = []
+		for i in range(count):
+			instances.append(Instance(d={'id':None, 'vmId':None, 'hostId':None, 'decayed':False, 'state':InstanceState.Pending, 'userId':1, 'name':'vm%d' % i, 'cores':1, 'memory':1024, 'disks':[DiskConfiguration(d={'uri':'image.qcow2', 'persistent':False})], 'nics':[NetworkConfiguration(d={'network':1, 'mac':'52:54:00:00:%02x:%02x' % (i / 256 % 256, i % 256), 'ip':None})], 'hints':{'display':'False'}, 'groupName':None}))
+		start = time.time()
+		data.registerInstances(instances)
+		print "registerInstances: %d in %.3f seconds" % (count, time.time() - start)
+		for instance in instances:
+			data.releaseInstance(instance)
+		start = time.time()
+		SQL(config)
+		print "loading %d instances: %.3f seconds" % (count, time.time() - start)
+
+		for threads in [1, 4, 16]:
+			done = [0] * threads
+			stop = time.time() + duration
+			def work(slot):
+				i = slot
+				while time.time() < stop:
+					instance = data.acquireInstance(instances[i % count].id)
+					instance.state = InstanceState.Running
+					data.releaseInstance(instance)
+					done[slot] += 1
+					i += threads
+			workers = [threading.Thread(target=work, args=(slot,)) for slot in range(threads)]
+			for worker in workers:
+				worker.start()
+			for worker in workers:
+				worker.join()
+			print "%d threads, %d connections: %.0f acquire/release per second" % (threads, data.pool.size, sum(done) / duration)
+	finally:
+		os.unlink(filename)
@@ -0,0 +1,314 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import logging
+import threading
+import time
+
+from tashi.rpycservices.rpyctypes import Errors, HostState, InstanceState, TashiException
+
+class MigrationSlots(object):
+	"""Counts the migrations running into each host, so that
+	   evacuations running at the same time share destinations fairly"""
+
+	def __init__(self, maxPerHost):
+		self.maxPerHost = maxPerHost
+		self.running = {}
+		self.cv = threading.Condition()
+
+	def tryAcquire(self, hostId):
+		self.cv.acquire()
+		try:
+			running = self.running.get(hostId, 0)
+			if running >= self.maxPerHost:
+				return False
+			self.running[hostId] = running + 1
+			return True
+		finally:
+			self.cv.release()
+
+	def release(self, hostId):
+		self.cv.acquire()
+		try:
+			running = self.running.get(hostId, 0) - 1
+			if running > 0:
+				self.running[hostId] = running
+			else:
+				self.running.pop(hostId, None)
+			self.cv.notifyAll()
+		finally:
+			self.cv.release()
+
+	def wait(self, timeout):
+		"""Waits up to timeout seconds for a slot to be released"""
+		self.cv.acquire()
+		try:
+			self.cv.wait(timeout)
+		finally:
+			self.cv.release()
+
+class Evacuation(object):
+	"""Moves the VMs off a host, for ClusterManagerService.evacuateHost.
+
+	   The host is first drained, so that nothing new is placed there.
+	   Running VMs are then live-migrated, up to maxPerSource at a time,
+	   each to the up and normal host with the most free memory according
+	   to the capacity ledger that has fewer than maxPerDestination
+	   migrations arriving. Capacity for a VM is reserved on its
+	   destination before the migration starts. A VM that fails to
+	   migrate is tried again, on another host if one is free, up to
+	   retries more times; it is then suspended and resumed, and left to
+	   the scheduler to place, if fallback is 'suspend'. VMs that are
+	   not running are left alone and reported as skipped."""
+
+	def __init__(self, service, hostId, policy, slots):
+		self.log = logging.getLogger(__name__)
+		self.service = service
+		self.data = service.data
+		self.hostId = hostId
+		self.slots = slots
+		config = service.config
+		self.retries = int(policy.get('retries', config.getint('ClusterManagerService', 'evacuateRetries', 1)))
+		self.fallback = policy.get('fallback', config.get('ClusterManagerService', 'evacuateFallback', 'suspend'))
+		maxPerSource = config.getint('ClusterManagerService', 'evacuateMaxPerSource', 0)
+		if maxPerSource <= 0:
+			# the node manager runs no more at once anyway
+			maxPerSource = config.getint('Qemu', 'maxParallelMigrations', 10)
+		self.maxPerSource = max(1, int(policy.get('maxPerSource', maxPerSource)))
+		self.destinations = policy.get('destinations', None)
+		self.suspendTimeout = float(policy.get('suspendTimeout', config.get('ClusterManagerService', 'evacuateSuspendTimeout', 600.0)))
+		self.drain = policy.get('drain', True)
+		self.cancelled = False
+		self.lock = threading.Lock()
+		self.state = 'starting'
+		self.started = time.time()
+		self.finished = None
+		# instanceId -> dict of name, state, destination, attempts, error
+		self.instances = {}
+		self.running = 0
+		self.pending = []
+
+	def start(self):
+		thread = threading.Thread(name="evacuate%s" % (self.hostId), target=self.__run)
+		thread.setDaemon(True)
+		thread.start()
+
+	def cancel(self):
+		"""Stops starting migrations; those under way carry on"""
+		self.cancelled = True
+
+	def progress(self):
+		self.lock.acquire()
+		try:
+			counts = {}
+			instances = {}
+			for (instanceId, entry) in self.instances.iteritems():
+				counts[entry['state']] = counts.get(entry['state'], 0) + 1
+				instances[instanceId] = dict(entry)
+			return {'hostId': self.hostId, 'state': self.state, 'started': self.started, 'finished': self.finished, 'counts': counts, 'instances': instances}
+		finally:
+			self.lock.release()
+
+	def __set(self, instanceId, **kwargs):
+		self.lock.acquire()
+		try:
+			self.instances[instanceId].update(kwargs)
+		finally:
+			self.lock.release()
+
+	def __run(self):
+		try:
+			if self.drain:
+				self.service.setHostState(self.hostId, "drained")
+			self.__evacuate()
+			if self.cancelled:
+				self.state = 'cancelled'
+			else:
+				self.state = 'done'
+		except Exception, e:
+			self.log.exception("Evacuation of host %s failed" % (self.hostId))
+			self.state = 'failed: %s' % (e)
+		self.finished = time.time()
+		self.log.info("Evacuation of host %s finished: %s" % (self.hostId, self.progress()['counts']))
+
+	def __evacuate(self):
+		self.lock.acquire()
+		for instance in self.data.getInstancesByHost(self.hostId).itervalues():
+			entry = {'name': instance.name, 'state': 'pending', 'destination': None, 'attempts': 0, 'error': None}
+			if instance.state != InstanceState.Running:
+				entry['state'] = 'skipped'
+				entry['error'] = 'VM is not running'
+			else:
+				self.pending.append(instance.id)
+			self.instances[instance.id] = entry
+		self.state = 'running'
+		self.lock.release()
+
+		cv = threading.Condition()
+		def finished():
+			cv.acquire()
+			self.running -= 1
+			cv.notify()
+			cv.release()
+
+		while len(self.pending) > 0 and not self.cancelled:
+			cv.acquire()
+			while self.running >= self.maxPerSource:
+				cv.wait(1.0)
+			cv.release()
+
+			instanceId = self.pending.pop(0)
+			try:
+				instance = self.data.getInstance(instanceId)
+			except TashiException:
+				self.__set(instanceId, state='gone')
+				continue
+			if instance.hostId != self.hostId:
+				self.__set(instanceId, state='gone')
+				continue
+
+			destination = self.__pickDestination(instance)
+			if destination is None:
+				# full everywhere; suspending frees the memory
+				self.__set(instanceId, error='No host has room')
+				destination = 'fallback'
+			elif destination == 'busy':
+				# try again when a migration finishes
+				self.pending.insert(0, instanceId)
+				self.slots.wait(1.0)
+				continue
+
+			cv.acquire()
+			self.running += 1
+			cv.release()
+			thread = threading.Thread(target=self.__move, args=(instance, destination, finished))
+			thread.setDaemon(True)
+			thread.start()
+
+		cv.acquire()
+		while self.running > 0:
+			cv.wait(1.0)
+		cv.release()
+
+	def __candidates(self):
+		hosts = []
+		for host in self.data.getHosts().itervalues():
+			if host.id == self.hostId or not host.up or host.state != HostState.Normal:
+				continue
+			if self.destinations is not None and host.id not in self.destinations:
+				continue
+			hosts.append(host)
+		capacity = self.service.capacity.getCapacity(hosts)
+		hosts.sort(key=lambda host: capacity[host.id]['freeMemory'], reverse=True)
+		return hosts
+
+	def __pickDestination(self, instance, exclude=()):
+		"""Returns a host with room reserved for instance and a slot
+		   taken, 'busy' if the hosts with room have no slot free, or
+		   None if no host has room"""
+		busy = False
+		for host in self.__candidates():
+			if host.id in exclude:
+				continue
+			if not self.slots.tryAcquire(host.id):
+				busy = True
+				continue
+			try:
+				self.service.capacity.reserve(instance, host)
+			except TashiException, e:
+				self.slots.release(host.id)
+				if e.errno != Errors.InsufficientCapacity:
+					raise
+				continue
+			return host
+		if busy:
+			return 'busy'
+		return None
+
+	def __move(self, instance, destination, finished):
+		try:
+			tried = []
+			while destination != 'fallback':
+				tried.append(destination.id)
+				self.__set(instance.id, state='migrating', destination=destination.name, attempts=len(tried))
+				try:
+					self.service.migrateVm(instance.id, destination.id)
+					self.__set(instance.id, state='migrated', error=None)
+					return
+				except Exception, e:
+					self.log.warning("Migrating %s to %s failed: %s" % (instance.name, destination.name, e))
+					self.__set(instance.id, error=str(e))
+				finally:
+					self.service.capacity.unreserve(instance.id)
+					self.slots.release(destination.id)
+
+				if len(tried) > self.retries or self.cancelled:
+					break
+				# another host if there is one, else the same again
+				destination = self.__waitForDestination(instance, tried)
+				if destination is None:
+					break
+
+			self.__suspendAndResume(instance)
+		except Exception, e:
+			self.log.exception("Moving %s off host %s failed" % (instance.name, self.hostId))
+			self.__set(instance.id, state='failed', error=str(e))
+		finally:
+			finished()
+
+	def __waitForDestination(self, instance, tried):
+		while not self.cancelled:
+			destination = self.__pickDestination(instance, exclude=tried)
+			if destination is None:
+				destination = self.__pickDestination(instance)
+			if destination != 'busy':
+				return destination
+			self.slots.wait(1.0)
+		return None
+
+	def __suspendAndResume(self, instance):
+		if self.fallback != 'suspend' or self.cancelled:
+			self.__set(instance.id, state='failed')
+			return
+		current = self.data.getInstance(instance.id)
+		if current.hostId != self.hostId:
+			# it got away after all
+			self.__set(instance.id, state='migrated', error=None)
+			return
+		self.__set(instance.id, state='suspending')
+		deadline = time.time() + self.suspendTimeout
+		while True:
+			try:
+				self.service.suspendVm(instance.id)
+				break
+			except TashiException, e:
+				if e.errno != Errors.IncorrectVmState or time.time() > deadline:
+					raise
+			time.sleep(1.0)
+
+		while True:
+			current = self.data.getInstance(instance.id)
+			if current.state == InstanceState.Suspended:
+				break
+			if time.time() > deadline:
+				raise TashiException(d={'errno':Errors.UnableToSuspend,'msg':"%s did not suspend within %.0f seconds" % (instance.name, self.suspendTimeout)})
+			time.sleep(1.0)
+
+		# the scheduler places it on another host, the source being
+		# drained
+		self.service.resumeVm(instance.id)
+		self.__set(instance.id, state='resumed', destination=None)
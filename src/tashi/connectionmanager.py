@@ -5,31 +5,195 @@
 # to you under the Apache License, Version 2.0 (the
 # "License"); you may not use this file except in compliance
 # with the License.  You may obtain a copy of the License at
-# 
+#
 #   http://www.apache.org/licenses/LICENSE-2.0
-# 
+#
 # Unless required by applicable law or agreed to in writing,
 # software distributed under the License is distributed on an
 # "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
 # KIND, either express or implied.  See the License for the
 # specific language governing permissions and limitations
-# under the License.    
+# under the License.
+
+import threading
+import time
 
 from tashi import Connection
+from tashi.utils.timeout import TimeoutException
 #from tashi.rpycservices.rpyctypes import *
 
+class ConnectionPool(object):
+	"""Keeps idle connections to one (host, port, auth mode) endpoint
+	   for reuse, and caps the number of connections in use at once."""
+
+	def __init__(self, host, port, credentials, authAndEncrypt, maxConnections, idleTimeout, callTimeout=None, retryPolicy=None):
+		self.host = host
+		self.port = port
+		self.credentials = credentials
+		self.authAndEncrypt = authAndEncrypt
+		self.callTimeout = callTimeout
+		self.retryPolicy = retryPolicy
+		self.maxConnections = maxConnections
+		self.idleTimeout = idleTimeout
+		# list of (connection, time returned to the pool)
+		self.idle = []
+		self.inUse = 0
+		self.cv = threading.Condition()
+
+	def __evictIdle(self, now):
+		# expects self.cv to be held
+		keep = []
+		for (connection, lastUsed) in self.idle:
+			if (now - lastUsed > self.idleTimeout) or (not connection.isConnected()):
+				connection.close()
+			else:
+				keep.append((connection, lastUsed))
+		self.idle = keep
+
+	def evictIdle(self):
+		self.cv.acquire()
+		try:
+			self.__evictIdle(time.time())
+		finally:
+			self.cv.release()
+
+	def get(self, timeout=None):
+		"""Checks out a connection, waiting up to timeout seconds
+		   if the per-host limit has been reached"""
+		start = time.time()
+		self.cv.acquire()
+		try:
+			while True:
+				now = time.time()
+				self.__evictIdle(now)
+				if len(self.idle) > 0:
+					# most recently used is most likely to be alive
+					(connection, __lastUsed) = self.idle.pop()
+					self.inUse += 1
+					return connection
+
+				if self.inUse < self.maxConnections:
+					self.inUse += 1
+					# this does not touch the network until the
+					# first call is made
+					return Connection(self.host, self.port, credentials=self.credentials, authAndEncrypt=self.authAndEncrypt, timeout=self.callTimeout, retryPolicy=self.retryPolicy)
+
+				if timeout is None:
+					self.cv.wait()
+				else:
+					remaining = timeout - (now - start)
+					if remaining <= 0:
+						raise TimeoutException("no connection to %s:%s available after %.2f seconds" % (self.host, self.port, timeout))
+					self.cv.wait(remaining)
+		finally:
+			self.cv.release()
+
+	def put(self, connection, healthy=True):
+		"""Returns a connection to the pool. Connections whose link was
+		   dropped are discarded so the next user reconnects."""
+		self.cv.acquire()
+		try:
+			self.inUse -= 1
+			if healthy and connection.isConnected():
+				self.idle.append((connection, time.time()))
+			else:
+				connection.close()
+			self.cv.notify()
+		finally:
+			self.cv.release()
+
+	def close(self):
+		self.cv.acquire()
+		try:
+			for (connection, __lastUsed) in self.idle:
+				connection.close()
+			self.idle = []
+		finally:
+			self.cv.release()
+
+class PooledConnection(object):
+	"""Looks like a tashi.util.Connection, but borrows a connection from
+	   a pool for the duration of each call"""
+
+	def __init__(self, pool, timeout=None):
+		self.pool = pool
+		self.timeout = timeout
+		self.host = pool.host
+		self.port = pool.port
+		self.username = None
+		if pool.credentials is not None:
+			self.username = pool.credentials[0]
+
+	def __call(self, name, *args, **kwargs):
+		connection = self.pool.get(self.timeout)
+		try:
+			return getattr(connection, name)(*args, **kwargs)
+		finally:
+			# Connection drops its rpyc link on transport
+			# failure, so it will not be reused
+			self.pool.put(connection)
+
+	def callAsync(self, name, *args):
+		"""Starts the RPC call name and returns an RPCFuture. The
+		   connection goes back to the pool when the future is done,
+		   so the caller must wait on it."""
+		connection = self.pool.get(self.timeout)
+		try:
+			future = connection.callAsync(name, *args)
+		except:
+			self.pool.put(connection)
+			raise
+		future.addCallback(lambda f: self.pool.put(connection))
+		return future
+
+	def __getattr__(self, name):
+		if name.startswith("__"):
+			raise AttributeError(name)
+		def call(*args, **kwargs):
+			return self.__call(name, *args, **kwargs)
+		return call
+
 class ConnectionManager(object):
-	def __init__(self, username, password, port, timeout=10000.0, authAndEncrypt=False):
+	def __init__(self, username, password, port, timeout=10000.0, authAndEncrypt=False, maxConnections=4, idleTimeout=60.0, retryPolicy=None):
 		self.username = username
 		self.password = password
 		self.timeout = timeout
 		self.port = port
 		self.authAndEncrypt = authAndEncrypt
-	
+		self.maxConnections = maxConnections
+		self.idleTimeout = idleTimeout
+		self.retryPolicy = retryPolicy
+		self.pools = {}
+		self.poolsLock = threading.Lock()
+
+	def __getPool(self, hostname, port):
+		key = (hostname, port, self.authAndEncrypt)
+		self.poolsLock.acquire()
+		try:
+			pool = self.pools.get(key, None)
+			if pool is None:
+				# timeout is in milliseconds
+				pool = ConnectionPool(hostname, port, (self.username, self.password), self.authAndEncrypt, self.maxConnections, self.idleTimeout, callTimeout=self.timeout/1000.0, retryPolicy=self.retryPolicy)
+				self.pools[key] = pool
+		finally:
+			self.poolsLock.release()
+		return pool
+
+	def evictIdle(self):
+		"""Closes connections that have been idle for too long"""
+		self.poolsLock.acquire()
+		try:
+			pools = self.pools.values()
+		finally:
+			self.poolsLock.release()
+		for pool in pools:
+			pool.evictIdle()
+
 	def __getitem__(self, hostname):
 		port = self.port
-		if len(hostname) == 2:
+		if isinstance(hostname, tuple) and len(hostname) == 2:
 			port = hostname[1]
 			hostname = hostname[0]
 
-		return Connection(hostname, port, credentials=(self.username, self.password), authAndEncrypt=self.authAndEncrypt)
+		# timeout is in milliseconds
+		return PooledConnection(self.__getPool(hostname, port), timeout=self.timeout/1000.0)
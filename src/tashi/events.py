@@ -0,0 +1,355 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Push notification of changes to instances and hosts. The cluster
+# manager runs an EventServer; agents connect with an EventSubscriber
+# instead of polling on a timer. Every message on the connection is a
+# 4 byte length followed by the message. The subscriber first sends its
+# subscription, a JSON object that may hold:
+#   types: list of event types wanted, all if missing
+#   userId, hostId, instanceId: only events about these
+# Everything after that comes from the server and is a protocol 2
+# pickle; the server never unpickles what a subscriber sends.
+# The server answers with a 'subscribed' event holding the current
+# generation (see DataInterface.getInstancesSince), then streams
+# events, each a dict with type, generation, time, id and object,
+# plus state and oldState for instance state changes. A 'keepalive'
+# event is sent when nothing happened for a while. Subscribers that
+# fall more than a queue's worth of events behind are disconnected.
+#
+# The stream is not authenticated, so by default the server only
+# listens on localhost.
+
+import cPickle
+import json
+import logging
+import os
+import Queue
+import socket
+import struct
+import threading
+import time
+
+eventTypes = ['instanceAdded', 'instanceState', 'instanceChanged', 'instanceRemoved', 'hostAdded', 'hostUp', 'hostDown', 'hostChanged', 'hostRemoved']
+
+frameHeader = struct.Struct("!I")
+maxFrameSize = 64 * 1024 * 1024
+maxSubscriptionSize = 64 * 1024
+keepaliveInterval = 30.0
+
+def encodeFrame(obj):
+	data = cPickle.dumps(obj, 2)
+	return frameHeader.pack(len(data)) + data
+
+def __recvExactly(sock, length):
+	chunks = []
+	while length > 0:
+		chunk = sock.recv(min(length, 65536))
+		if chunk == "":
+			raise EOFError("connection closed")
+		chunks.append(chunk)
+		length -= len(chunk)
+	return "".join(chunks)
+
+def __recvData(sock, maxSize):
+	(length,) = frameHeader.unpack(__recvExactly(sock, frameHeader.size))
+	if length > maxSize:
+		raise ValueError("frame of %d bytes is too large" % (length))
+	return __recvExactly(sock, length)
+
+def recvFrame(sock):
+	"""Receives a pickled frame; only for use on frames from the server"""
+	return cPickle.loads(__recvData(sock, maxFrameSize))
+
+def encodeSubscription(subscription):
+	data = json.dumps(subscription)
+	return frameHeader.pack(len(data)) + data
+
+def recvSubscription(sock):
+	"""Receives and checks a subscription, see parseSubscription"""
+	return parseSubscription(__recvData(sock, maxSubscriptionSize))
+
+def parseSubscription(data):
+	"""Returns the subscription in JSON data. Raises ValueError if it is
+	   not one."""
+	decoded = json.loads(data)
+	if not isinstance(decoded, dict):
+		raise ValueError("subscription is not an object")
+	subscription = {}
+	for (key, value) in decoded.iteritems():
+		key = str(key)
+		if key == 'types':
+			if not isinstance(value, list):
+				raise ValueError("types is not a list")
+			types = []
+			for eventType in value:
+				if eventType not in eventTypes:
+					raise ValueError("unknown event type %r" % (eventType))
+				types.append(str(eventType))
+			subscription[key] = types
+		elif key in ['userId', 'hostId', 'instanceId']:
+			if type(value) not in [int, long]:
+				raise ValueError("%s is not an integer" % (key))
+			subscription[key] = int(value)
+		else:
+			raise ValueError("unknown subscription key %r" % (key))
+	return subscription
+
+def makeEvent(generation, kind, change, old, new):
+	"""Returns the event for a change reported by the data layer"""
+	obj = new
+	if obj is None:
+		obj = old
+	event = {'generation': generation, 'time': time.time(), 'id': obj.id, 'object': obj}
+	if kind == 'instances':
+		event['state'] = obj.state
+		if change == 'added':
+			event['type'] = 'instanceAdded'
+		elif change == 'removed':
+			event['type'] = 'instanceRemoved'
+		elif old is not None and old.state != new.state:
+			event['type'] = 'instanceState'
+			event['oldState'] = old.state
+		else:
+			event['type'] = 'instanceChanged'
+	else:
+		if change == 'added':
+			event['type'] = 'hostAdded'
+		elif change == 'removed':
+			event['type'] = 'hostRemoved'
+		elif old is not None and old.up != new.up:
+			if new.up:
+				event['type'] = 'hostUp'
+			else:
+				event['type'] = 'hostDown'
+		else:
+			event['type'] = 'hostChanged'
+	return event
+
+def matches(event, subscription):
+	"""Returns True if the subscriber asked for the event"""
+	types = subscription.get('types', None)
+	if types is not None and event['type'] not in types:
+		return False
+	obj = event['object']
+	isInstance = event['type'].startswith('instance')
+	if 'instanceId' in subscription and not (isInstance and obj.id == subscription['instanceId']):
+		return False
+	if 'userId' in subscription and not (isInstance and obj.userId == subscription['userId']):
+		return False
+	if 'hostId' in subscription:
+		if isInstance:
+			hostId = obj.hostId
+		else:
+			hostId = obj.id
+		if hostId != subscription['hostId']:
+			return False
+	return True
+
+class Subscriber(object):
+	def __init__(self, sock, address, maxQueue):
+		self.sock = sock
+		self.address = address
+		self.queue = Queue.Queue(maxQueue)
+		self.subscription = None
+		self.closed = False
+
+	def close(self):
+		self.closed = True
+		try:
+			self.sock.shutdown(socket.SHUT_RDWR)
+		except Exception:
+			pass
+		self.sock.close()
+
+class EventServer(object):
+	"""Streams changes to instances and hosts to subscribers. Register
+	   publish with DataInterface.addChangeListener."""
+
+	def __init__(self, host, port, getGeneration, maxQueue=1000, maxSubscribers=100):
+		self.log = logging.getLogger(__name__)
+		self.getGeneration = getGeneration
+		self.maxQueue = maxQueue
+		self.maxSubscribers = maxSubscribers
+		self.subscribers = []
+		self.lock = threading.Lock()
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind((host, port))
+		self.listener.listen(16)
+		self.__startThread(self.__accept)
+
+	def __startThread(self, target, *args):
+		thread = threading.Thread(target=target, args=args)
+		thread.setDaemon(True)
+		thread.start()
+
+	def __accept(self):
+		while True:
+			try:
+				(sock, address) = self.listener.accept()
+			except socket.error:
+				self.log.exception("Failed to accept event subscriber")
+				time.sleep(1)
+				continue
+			subscriber = Subscriber(sock, address, self.maxQueue)
+			self.lock.acquire()
+			full = len(self.subscribers) >= self.maxSubscribers
+			if not full:
+				self.subscribers.append(subscriber)
+			self.lock.release()
+			if full:
+				self.log.warning("Refusing event subscriber %s:%s, there are already %d" % (address[0], address[1], self.maxSubscribers))
+				subscriber.close()
+				continue
+			self.__startThread(self.__serve, subscriber)
+
+	def __remove(self, subscriber):
+		self.lock.acquire()
+		try:
+			if subscriber in self.subscribers:
+				self.subscribers.remove(subscriber)
+		finally:
+			self.lock.release()
+		subscriber.close()
+
+	def __serve(self, subscriber):
+		try:
+			subscriber.sock.settimeout(keepaliveInterval)
+			subscription = recvSubscription(subscriber.sock)
+			subscriber.sock.settimeout(None)
+			# changes made after this generation and before the
+			# subscription takes effect can be fetched with the
+			# *Since RPCs
+			subscriber.queue.put(encodeFrame({'type': 'subscribed', 'generation': self.getGeneration(), 'time': time.time()}))
+			subscriber.subscription = subscription
+			self.log.info("Event subscriber %s:%s subscribed to %s" % (subscriber.address[0], subscriber.address[1], subscription))
+
+			while not subscriber.closed:
+				try:
+					frame = subscriber.queue.get(True, keepaliveInterval)
+				except Queue.Empty:
+					frame = encodeFrame({'type': 'keepalive', 'generation': self.getGeneration(), 'time': time.time()})
+				subscriber.sock.sendall(frame)
+		except Exception, e:
+			if not subscriber.closed:
+				self.log.info("Event subscriber %s:%s went away: %s" % (subscriber.address[0], subscriber.address[1], e))
+		self.__remove(subscriber)
+
+	def publish(self, generation, kind, change, old, new):
+		"""Change listener for the data layer"""
+		if len(self.subscribers) == 0:
+			return
+		event = makeEvent(generation, kind, change, old, new)
+		# encode once for all subscribers, while the object
+		# is still locked
+		frame = None
+		self.lock.acquire()
+		subscribers = list(self.subscribers)
+		self.lock.release()
+		for subscriber in subscribers:
+			if subscriber.subscription is None or not matches(event, subscriber.subscription):
+				continue
+			if frame is None:
+				frame = encodeFrame(event)
+			try:
+				subscriber.queue.put_nowait(frame)
+			except Queue.Full:
+				self.log.warning("Disconnecting event subscriber %s:%s, which is %d events behind" % (subscriber.address[0], subscriber.address[1], self.maxQueue))
+				self.__remove(subscriber)
+
+class EventSubscriber(object):
+	"""Receives events from a cluster manager's EventServer in a
+	   background thread, and reconnects if the connection drops. A
+	   'subscribed' event is delivered after every (re)connection, as
+	   events may have been missed; callers should then refresh their
+	   state, for instance with tashi.util.StateMirror."""
+
+	def __init__(self, host, port, subscription=None, maxQueue=1000, retryDelay=5.0):
+		self.log = logging.getLogger(__name__)
+		self.host = host
+		self.port = int(port)
+		if subscription is None:
+			subscription = {}
+		self.subscription = subscription
+		self.retryDelay = retryDelay
+		self.events = Queue.Queue(maxQueue)
+		thread = threading.Thread(target=self.__run)
+		thread.setDaemon(True)
+		thread.start()
+
+	def __deliver(self, event):
+		try:
+			self.events.put_nowait(event)
+		except Queue.Full:
+			# the caller is not keeping up; make it resync
+			self.log.warning("Dropping events from %s:%s, queue full" % (self.host, self.port))
+			try:
+				while True:
+					self.events.get_nowait()
+			except Queue.Empty:
+				pass
+			self.events.put_nowait({'type': 'subscribed', 'generation': None, 'time': time.time()})
+
+	def __run(self):
+		while True:
+			sock = None
+			try:
+				sock = socket.create_connection((self.host, self.port))
+				# the server sends keepalives, so a silent
+				# connection is a dead one
+				sock.settimeout(3 * keepaliveInterval)
+				sock.sendall(encodeSubscription(self.subscription))
+				while True:
+					event = recvFrame(sock)
+					if event.get('type') != 'keepalive':
+						self.__deliver(event)
+			except Exception, e:
+				self.log.info("Lost event stream from %s:%s: %s" % (self.host, self.port, e))
+			if sock is not None:
+				sock.close()
+			time.sleep(self.retryDelay)
+
+	def get(self, timeout=None):
+		"""Returns the next event, or None if there was none within timeout seconds"""
+		try:
+			return self.events.get(True, timeout)
+		except Queue.Empty:
+			return None
+
+	def wait(self, timeout):
+		"""Waits up to timeout seconds for an event. Returns the events
+		   that have arrived, which may be none."""
+		event = self.get(timeout)
+		if event is None:
+			return []
+		events = [event]
+		try:
+			while True:
+				events.append(self.events.get_nowait())
+		except Queue.Empty:
+			pass
+		return events
+
+def createEventSubscriber(config, subscription=None):
+	"""Returns an EventSubscriber for the cluster manager in the Client
+	   configuration, or None if it has no event port configured"""
+	host = os.getenv('TASHI_CM_HOST', config.get('Client', 'clusterManagerHost'))
+	port = int(os.getenv('TASHI_CM_EVENT_PORT', config.get('Client', 'clusterManagerEventPort', 0)))
+	if port <= 0:
+		return None
+	return EventSubscriber(host, port, subscription)
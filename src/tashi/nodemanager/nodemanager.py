@@ -20,6 +20,7 @@
 import logging.config
 import sys
 import os
+import signal
 
 from tashi.util import instantiateImplementation, debugConsole
 import tashi
@@ -28,7 +29,7 @@ from tashi import boolean
 from tashi.rpycservices import rpycservices
 from tashi.utils.config import Config
 
-from rpyc.utils.server import ThreadedServer
+from tashi.rpycservices.poolserver import createServer
 from rpyc.utils.authenticators import TlsliteVdbAuthenticator
 
 def main():
@@ -78,19 +79,23 @@ def startNodeManager():
 		users = {}
 		users[config.get('AllowedUsers', 'clusterManagerUser')] = config.get('AllowedUsers', 'clusterManagerPassword')
 		authenticator = TlsliteVdbAuthenticator.from_dict(users)
-
-		# XXXstroucki: ThreadedServer is liable to have exceptions
-		# occur within if an endpoint is lost.
-		t = ThreadedServer(service=rpycservices.ManagerService, hostname='0.0.0.0', port=int(config.get('NodeManagerService', 'port')), auto_register=False, authenticator=authenticator)
 	else:
-		t = ThreadedServer(service=rpycservices.ManagerService, hostname='0.0.0.0', port=int(config.get('NodeManagerService', 'port')), auto_register=False)
-	t.logger.setLevel(logging.ERROR)
+		authenticator = None
+
+	# XXXstroucki: ThreadedServer is liable to have exceptions
+	# occur within if an endpoint is lost.
+	t = createServer(rpycservices.ManagerService, config, 'NodeManagerService', authenticator=authenticator)
 	t.service.service = service
 	t.service._type = 'NodeManagerService'
 
 	debugConsole(globals())
 
-	t.start()
+	# unwind through the cleanup below on SIGTERM as on SIGINT
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	try:
+		t.start()
+	finally:
+		service.stop()
 	# shouldn't exit by itself
 	sys.exit(0)
 
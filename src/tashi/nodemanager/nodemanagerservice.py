@@ -15,10 +15,12 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import cPickle
 import logging
 import socket
 import threading
 import time
+import zlib
 
 # these allow discovery of IP addresses assigned to the VM.
 # making these optional in case of ancient installs that don't
@@ -35,6 +37,8 @@ from struct import pack
 
 from tashi.rpycservices.rpyctypes import InstanceState, TashiException, Errors, Instance
 from tashi import boolean, vmStates, ConnectionManager
+from tashi.accounting.shipper import createAccountingShipper
+from tashi.rpycservices.rpycservices import rpcStats
 
 class NodeManagerService(object):
 	"""RPC handler for the NodeManager
@@ -76,6 +80,11 @@ class NodeManagerService(object):
 		self.__initAccounting()
 
 		self.id = None
+		# vmId -> (checksum, generation) for heartbeat digests; the
+		# generations continue from a different number each start
+		self.vmGenerations = {}
+		self.nextGeneration = int(time.time() * 1000)
+		self.sendDigests = True
 		# XXXstroucki this fn could be in this level maybe?
 		# note we are passing our information down to the VMM here.
 		self.host = self.vmm.getHostInfo(self)
@@ -90,7 +99,7 @@ class NodeManagerService(object):
 
 		# XXXstroucki: should make an effort to retry
 		# This can time out now with an exception
-		self.id = self.cm.registerNodeManager(self.host, self.instances.values())
+		self.id = self.__register()
 
 		# make arp monitoring optional
 		self.haveIpDiscovery = False
@@ -106,16 +115,22 @@ class NodeManagerService(object):
 			self.log.warning("Disabling ARP monitoring thread")
 
 	def __initAccounting(self):
-		self.accountBuffer = []
-		self.accountLines = 0
-		self.accountingClient = None
+		self.accounting = None
 		try:
 			if (self.accountingHost is not None) and \
 						(self.accountingPort is not None):
-				self.accountingClient = ConnectionManager(self.username, self.password, self.accountingPort)[self.accountingHost]
+				accountingClient = ConnectionManager(self.username, self.password, self.accountingPort)[self.accountingHost]
+				self.accounting = createAccountingShipper(accountingClient, self.config, 'NodeManagerService')
+				rpcStats.addGauge('accounting', self.accounting.stats)
 		except:
 			self.log.exception("Could not init accounting")
 
+	def stop(self):
+		"""Sends, or spills, the accounting lines still queued. Called
+		   when the server exits."""
+		if (self.accounting is not None):
+			self.accounting.stop(10.0)
+
 	def __loadVmInfo(self):
 		try:
 			self.instances = self.vmm.getInstances()
@@ -160,16 +175,6 @@ class NodeManagerService(object):
 		#if (toSleep > 0):
 			#time.sleep(toSleep)
 
-	def __ACCOUNTFLUSH(self):
-		try:
-			if (self.accountingClient is not None):
-				self.accountingClient.record(self.accountBuffer)
-			self.accountLines = 0
-			self.accountBuffer = []
-		except:
-			self.log.exception("Failed to flush accounting data")
-
-
 	def __ACCOUNT(self, text, instance=None, host=None):
 		now = time.time()
 		instanceText = None
@@ -191,12 +196,9 @@ class NodeManagerService(object):
 
 		line = "%s|%s|%s" % (now, text, secondary)
 
-		self.accountBuffer.append(line)
-		self.accountLines += 1
-
-		# XXXstroucki think about force flush every so often
-		if (self.accountLines > 0):
-			self.__ACCOUNTFLUSH()
+		# sent in the background, in batches
+		if (self.accounting is not None):
+			self.accounting.record(line)
 
 
 	# service thread function
@@ -206,8 +208,7 @@ class NodeManagerService(object):
 			#self.__ACCOUNT("TESTING")
 			start = time.time()
 			try:
-				instances = self.instances.values()
-				self.id = self.cm.registerNodeManager(self.host, instances)
+				self.id = self.__register()
 				if not happy:
 					happy = True
 					self.log.info("Registered with the CM")
@@ -225,6 +226,31 @@ class NodeManagerService(object):
 			if (toSleep > 0):
 				time.sleep(toSleep)
 
+	def __register(self):
+		if self.sendDigests:
+			try:
+				return self.cm.registerNodeManagerDigest(self.host, self.__vmDigests())
+			except AttributeError:
+				self.log.info("The CM does not take VM digests, sending whole instances")
+				self.sendDigests = False
+		return self.cm.registerNodeManager(self.host, self.instances.values())
+
+	def __vmDigests(self):
+		# (instanceId, vmId, state, decayed, generation) per VM,
+		# where the generation changes whenever the instance does
+		digests = []
+		generations = {}
+		for (vmId, instance) in self.instances.items():
+			checksum = zlib.crc32(cPickle.dumps(instance, 2))
+			(oldChecksum, generation) = self.vmGenerations.get(vmId, (None, None))
+			if checksum != oldChecksum:
+				generation = self.nextGeneration
+				self.nextGeneration += 1
+			generations[vmId] = (checksum, generation)
+			digests.append((instance.id, vmId, instance.state, instance.decayed, generation))
+		self.vmGenerations = generations
+		return digests
+
 	#Convert a string of 6 characters of ethernet address into a colon separated hex string
 	def __stringToMac(self, a):
 		# XXXstroucki: enforce string length?
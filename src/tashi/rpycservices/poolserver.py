@@ -0,0 +1,306 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+import errno
+import logging
+import os
+import Queue
+import select
+import socket
+import threading
+
+from rpyc.core import SocketStream, Channel, Connection
+from rpyc.utils.server import Server, ThreadedServer
+from rpyc.utils.authenticators import AuthenticationError
+
+class Admission(object):
+	"""Decides whether an RPC may run now. Calls are refused while the
+	   server is shedding load, or when the caller already has too many
+	   calls running. Refused calls have not been started, so clients
+	   may safely send them again."""
+
+	def __init__(self, maxCallsPerClient):
+		self.maxCallsPerClient = maxCallsPerClient
+		self.running = {}
+		self.lock = threading.Lock()
+		self.local = threading.local()
+
+	def setShedding(self, shedding):
+		# set by a worker thread before it serves a request
+		self.local.shedding = shedding
+
+	def enter(self, caller):
+		"""Returns None if the call may run, else the reason it may
+		   not. A call that may run must be followed by leave(caller)."""
+		if getattr(self.local, 'shedding', False):
+			return "server is overloaded"
+		self.lock.acquire()
+		try:
+			running = self.running.get(caller, 0)
+			if self.maxCallsPerClient > 0 and running >= self.maxCallsPerClient:
+				return "%s already has %d calls running" % (caller, running)
+			self.running[caller] = running + 1
+			return None
+		finally:
+			self.lock.release()
+
+	def leave(self, caller):
+		self.lock.acquire()
+		try:
+			running = self.running.get(caller, 0) - 1
+			if running > 0:
+				self.running[caller] = running
+			else:
+				self.running.pop(caller, None)
+		finally:
+			self.lock.release()
+
+class WorkerPoolServer(Server):
+	"""rpyc server that serves all connections from a fixed pool of
+	   worker threads, instead of a thread per connection.
+
+	   One thread polls the idle connections and queues those with a
+	   request waiting. Workers take connections from the queue and
+	   serve one request each. When more than queueSize connections are
+	   waiting, requests are answered with an overload error instead of
+	   being run, until the queue has drained. New connections beyond
+	   maxConnections are closed straight away, as are those that have
+	   not authenticated within authTimeout seconds. The Admission
+	   object is handed to the service in the connection config as
+	   'admission'.
+
+	   Workers blocked in a long RPC are not available to other
+	   clients, so there should be more workers than RPCs expected to
+	   wait on other servers at the same time."""
+
+	def __init__(self, service, workers=16, queueSize=64, maxConnections=1024, maxCallsPerClient=8, authTimeout=10.0, **kwargs):
+		Server.__init__(self, service, **kwargs)
+		self.workers = workers
+		self.authTimeout = authTimeout
+		self.queueSize = queueSize
+		self.maxConnections = maxConnections
+		self.admission = Admission(maxCallsPerClient)
+		self.protocol_config = dict(self.protocol_config, admission=self.admission)
+		# ('connect', socket) to authenticate, or ('serve', fd)
+		# for a connection with a request waiting
+		self.jobs = Queue.Queue()
+		# fd -> (rpyc connection, raw socket)
+		self.connections = {}
+		self.connecting = 0
+		self.lock = threading.Lock()
+		self.poller = select.poll()
+		(self.wakeupRead, self.wakeupWrite) = os.pipe()
+		self.poller.register(self.wakeupRead, select.POLLIN)
+		self.threads = []
+
+	def start(self):
+		self.active = True
+		for i in range(self.workers):
+			self.__startThread(self.__work, "RPC worker %d" % (i))
+		self.__startThread(self.__poll, "RPC poller")
+		Server.start(self)
+
+	def __startThread(self, target, name):
+		thread = threading.Thread(target=target, name=name)
+		thread.setDaemon(True)
+		thread.start()
+		self.threads.append(thread)
+
+	def close(self):
+		Server.close(self)
+		for i in range(self.workers):
+			self.jobs.put(None)
+		self.__wakeup()
+		self.lock.acquire()
+		try:
+			connections = self.connections.values()
+			self.connections = {}
+		finally:
+			self.lock.release()
+		for (conn, sock) in connections:
+			try:
+				conn.close()
+			except Exception:
+				pass
+
+	def __wakeup(self):
+		try:
+			os.write(self.wakeupWrite, "x")
+		except OSError:
+			pass
+
+	def _accept_method(self, sock):
+		self.lock.acquire()
+		try:
+			full = len(self.connections) + self.connecting >= self.maxConnections
+			if not full:
+				self.connecting += 1
+		finally:
+			self.lock.release()
+
+		if full:
+			self.logger.warning("refusing connection, %d connections open" % (self.maxConnections))
+			self.__closeSocket(sock)
+			return
+
+		# authentication may take a while, leave it to a worker
+		self.jobs.put(('connect', sock))
+
+	def __closeSocket(self, sock):
+		try:
+			sock.shutdown(socket.SHUT_RDWR)
+		except Exception:
+			pass
+		sock.close()
+		self.clients.discard(sock)
+
+	def __connect(self, sock):
+		try:
+			try:
+				addrinfo = sock.getpeername()
+				if self.authenticator:
+					# the handshake runs on a worker; a client
+					# that stalls in it must not keep it
+					sock.settimeout(self.authTimeout)
+					try:
+						(sock2, credentials) = self.authenticator(sock)
+					except (AuthenticationError, socket.timeout):
+						self.logger.info("%s failed to authenticate, rejecting connection", addrinfo)
+						self.__closeSocket(sock)
+						return
+					sock.settimeout(None)
+					if sock2 is not sock and hasattr(sock2, 'settimeout'):
+						sock2.settimeout(None)
+				else:
+					credentials = None
+					sock2 = sock
+				config = dict(self.protocol_config, credentials=credentials, endpoints=(sock.getsockname(), addrinfo))
+				conn = Connection(self.service, Channel(SocketStream(sock2)), config=config)
+			except Exception:
+				self.logger.exception("failed to set up client connection")
+				self.__closeSocket(sock)
+				return
+			self.__watch(conn.fileno(), conn, sock)
+		finally:
+			self.lock.acquire()
+			self.connecting -= 1
+			self.lock.release()
+
+	def __watch(self, fd, conn, sock):
+		"""Waits for the next request on the connection"""
+		self.lock.acquire()
+		try:
+			self.connections[fd] = (conn, sock)
+			self.poller.register(fd, select.POLLIN | select.POLLPRI)
+		finally:
+			self.lock.release()
+		# a poll already in progress does not see the new fd
+		self.__wakeup()
+
+	def __drop(self, fd, conn, sock):
+		self.lock.acquire()
+		try:
+			self.connections.pop(fd, None)
+		finally:
+			self.lock.release()
+		try:
+			conn.close()
+		except Exception:
+			pass
+		self.__closeSocket(sock)
+
+	def __poll(self):
+		while self.active:
+			try:
+				events = self.poller.poll(1000)
+			except select.error, e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+
+			for (fd, event) in events:
+				if fd == self.wakeupRead:
+					os.read(fd, 4096)
+					continue
+
+				self.lock.acquire()
+				try:
+					try:
+						self.poller.unregister(fd)
+					except KeyError:
+						pass
+					(conn, sock) = self.connections.get(fd, (None, None))
+				finally:
+					self.lock.release()
+				if conn is None:
+					continue
+
+				if not (event & (select.POLLIN | select.POLLPRI)):
+					# hung up or broken
+					self.__drop(fd, conn, sock)
+					continue
+				self.jobs.put(('serve', fd))
+
+	def __work(self):
+		while self.active:
+			job = self.jobs.get()
+			if job is None:
+				return
+			(kind, item) = job
+			if kind == 'connect':
+				self.__connect(item)
+				continue
+
+			fd = item
+			self.lock.acquire()
+			(conn, sock) = self.connections.get(fd, (None, None))
+			self.lock.release()
+			if conn is None:
+				continue
+
+			# the queue is long, refuse requests until it drains
+			self.admission.setShedding(self.jobs.qsize() >= self.queueSize)
+			try:
+				try:
+					conn.poll()
+				except EOFError:
+					self.__drop(fd, conn, sock)
+					continue
+				except Exception:
+					self.logger.exception("client connection terminated abruptly")
+					self.__drop(fd, conn, sock)
+					continue
+			finally:
+				self.admission.setShedding(False)
+			self.__watch(fd, conn, sock)
+
+def createServer(service, config, section, authenticator=None):
+	"""Returns the rpyc server for a Tashi daemon, with the server mode and
+	   limits taken from the rpc* settings in the given config section"""
+	port = int(config.get(section, 'port'))
+	workers = config.getint(section, 'rpcWorkers', 0)
+	if workers <= 0:
+		# one thread per connection
+		server = ThreadedServer(service=service, hostname='0.0.0.0', port=port, auto_register=False, authenticator=authenticator)
+	else:
+		queueSize = config.getint(section, 'rpcQueueSize', 4 * workers)
+		maxConnections = config.getint(section, 'rpcMaxConnections', 1024)
+		maxCallsPerClient = config.getint(section, 'rpcMaxCallsPerClient', 0)
+		authTimeout = float(config.get(section, 'rpcAuthTimeout', 10.0))
+		server = WorkerPoolServer(service, workers=workers, queueSize=queueSize, maxConnections=maxConnections, maxCallsPerClient=maxCallsPerClient, authTimeout=authTimeout, hostname='0.0.0.0', port=port, auto_register=False, authenticator=authenticator)
+	server.logger.setLevel(logging.ERROR)
+	return server
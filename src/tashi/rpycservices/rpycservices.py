@@ -16,12 +16,37 @@
 # under the License.
 
 import rpyc
-from tashi.rpycservices.rpyctypes import Instance, Host, User
+from tashi.rpycservices.rpyctypes import Instance, Host, User, TashiException, Errors
+from tashi.utils.timeout import TimeoutException
 import cPickle
+import select
+import struct
+import threading
+import time
+import zlib
 
-clusterManagerRPCs = ['createVm', 'shutdownVm', 'destroyVm', 'suspendVm', 'resumeVm', 'migrateVm', 'pauseVm', 'unpauseVm', 'getHosts', 'getNetworks', 'getUsers', 'getInstances', 'vmmSpecificCall', 'registerNodeManager', 'vmUpdate', 'activateVm', 'registerHost', 'unregisterHost', 'getImages', 'copyImage', 'cloneImage', 'rebaseImage', 'setHostState', 'setHostNotes', 'addReservation', 'delReservation', 'getReservation']
+# rpyc renamed async to async_ in 4.0
+asyncCall = getattr(rpyc, "async_", None) or getattr(rpyc, "async")
+
+clusterManagerRPCs = ['createVm', 'createVms', 'shutdownVm', 'destroyVm', 'suspendVm', 'resumeVm', 'migrateVm', 'pauseVm', 'unpauseVm', 'getHosts', 'getNetworks', 'getUsers', 'getInstances', 'vmmSpecificCall', 'registerNodeManager', 'registerNodeManagerDigest', 'vmUpdate', 'activateVm', 'registerHost', 'unregisterHost', 'getImages', 'copyImage', 'cloneImage', 'rebaseImage', 'setHostState', 'setHostNotes', 'addReservation', 'delReservation', 'getReservation', 'getInstancesSince', 'getHostsSince', 'getHostCapacity', 'destroyVms', 'shutdownVms', 'pauseVms', 'suspendVms', 'evacuateHost', 'cancelEvacuation', 'getEvacuations']
 nodeManagerRPCs = ['instantiateVm', 'shutdownVm', 'destroyVm', 'suspendVm', 'resumeVm', 'prepReceiveVm', 'prepSourceVm', 'migrateVm', 'receiveVm', 'pauseVm', 'unpauseVm', 'getVmInfo', 'listVms', 'vmmSpecificCall', 'getHostInfo', 'liveCheck']
 accountingRPCs = ['record']
+# RPCs every service answers
+commonRPCs = ['batch', 'getRpcStats']
+# RPCs only root and agents may call, as they act on or show everyone's VMs
+privilegedRPCs = ['evacuateHost', 'cancelEvacuation', 'getRpcStats']
+
+# Wire formats for arguments and results. Version 0 is a bare
+# protocol 0 cPickle, understood by every peer. Version 1 is a frame of
+# magic, version, flags and payload length, followed by a binary
+# pickle that is zlib compressed if it is large. Clients ask the server
+# which versions it knows when connecting; servers answer in the format
+# the request arrived in.
+wireVersions = (0, 1)
+wireMagic = "TSHW"
+wireHeader = struct.Struct("!4sBBI")
+wireCompressed = 0x01
+compressThreshold = 16384
 
 def clean(args):
 	"""Cleans the object so cPickle can be used."""
@@ -32,52 +57,359 @@ def clean(args):
 		if isinstance(args, tuple):
 			cleanArgs = tuple(cleanArgs)
 		return cleanArgs
-	if isinstance(args, Instance):
-		return Instance(args.__dict__)
-	if isinstance(args, Host):
-		return Host(args.__dict__)
+	# Instances and Hosts do not pickle the locks the data layer
+	# attaches to them, so they need no copying
 	if isinstance(args, User):
-		user = User(args.__dict__)
+		user = args.clone()
 		user.passwd = None
 		return user
 	return args
 
+def encode(obj, wireVersion=0):
+	"""Serializes obj for sending in the given wire format"""
+	if wireVersion == 0:
+		return cPickle.dumps(clean(obj))
+
+	payload = cPickle.dumps(clean(obj), 2)
+	flags = 0
+	if len(payload) >= compressThreshold:
+		payload = zlib.compress(payload, 1)
+		flags = flags | wireCompressed
+	return "".join((wireHeader.pack(wireMagic, wireVersion, flags, len(payload)), payload))
+
+def decode(data):
+	"""Returns the object in data and the wire format it was sent in"""
+	if not data.startswith(wireMagic):
+		return (cPickle.loads(data), 0)
+
+	(__magic, wireVersion, flags, length) = wireHeader.unpack_from(data)
+	payload = data[wireHeader.size:]
+	if len(payload) != length:
+		raise ValueError("Frame length %d does not match payload length %d" % (length, len(payload)))
+	if flags & wireCompressed:
+		payload = zlib.decompress(payload)
+	return (cPickle.loads(payload), wireVersion)
+
+class RPCFuture(object):
+	"""The pending result of an RPC started with client.callAsync. The
+	   reply is only read when a thread waits on the future, with
+	   result(), waitAll() or asCompleted(); callbacks run in that
+	   thread."""
+
+	def __init__(self, name, client=None, asyncResult=None, timeout=None):
+		self.name = name
+		self.client = client
+		self.asyncResult = asyncResult
+		self.deadline = None
+		if timeout is not None:
+			self.deadline = time.time() + timeout
+		self.timeout = timeout
+		self.finished = False
+		self.value = None
+		self.error = None
+		self.callbacks = []
+
+	def __finish(self, value=None, error=None):
+		self.finished = True
+		self.value = value
+		self.error = error
+		# don't keep the connection alive through the future
+		self.asyncResult = None
+		callbacks = self.callbacks
+		self.callbacks = []
+		for callback in callbacks:
+			callback(self)
+
+	def setException(self, error):
+		self.__finish(error=error)
+
+	def cancel(self, reason="cancelled"):
+		"""Gives up on the call, which then fails with TimeoutException.
+		   The connection is closed, as the reply may still arrive."""
+		if self.finished:
+			return
+		if self.client is not None:
+			self.client.conn.close()
+		self.__finish(error=TimeoutException("%s %s" % (self.name, reason)))
+
+	def addCallback(self, callback):
+		"""Calls callback(future) once the future is done"""
+		if self.finished:
+			callback(self)
+		else:
+			self.callbacks.append(callback)
+
+	def fileno(self):
+		return self.client.conn.fileno()
+
+	def done(self):
+		"""Reads any reply that has arrived, without blocking. Returns
+		   True if the call has finished."""
+		if self.finished:
+			return True
+
+		try:
+			ready = self.asyncResult.ready
+			if ready:
+				res = self.asyncResult.value
+		except Exception, e:
+			self.client.conn.close()
+			self.__finish(error=e)
+			return True
+
+		if ready:
+			try:
+				(res, __wireVersion) = decode(res)
+			except Exception, e:
+				self.__finish(error=e)
+				return True
+			if isinstance(res, Exception):
+				self.__finish(error=res)
+			else:
+				self.__finish(value=res)
+			return True
+
+		if self.deadline is not None and time.time() >= self.deadline:
+			self.client.conn.close()
+			self.__finish(error=TimeoutException("%s on %s:%s timed out after %.2f seconds" % (self.name, self.client.host, self.client.port, self.timeout)))
+			return True
+
+		return False
+
+	def result(self, timeout=None):
+		"""Waits for the call to finish. Returns its result, or raises
+		   the exception it produced."""
+		(done, __notDone) = waitAll([self], timeout)
+		if len(done) == 0:
+			raise TimeoutException("%s still running after %.2f seconds" % (self.name, timeout))
+		if self.error is not None:
+			raise self.error
+		return self.value
+
+def asCompleted(futures, timeout=None):
+	"""Yields futures as they finish. Raises TimeoutException if some
+	   have not finished after timeout seconds."""
+	start = time.time()
+	pending = list(futures)
+	while True:
+		notDone = []
+		for future in pending:
+			if future.done():
+				yield future
+			else:
+				notDone.append(future)
+		pending = notDone
+		if len(pending) == 0:
+			return
+
+		# sleep until a reply arrives or the next deadline passes
+		now = time.time()
+		waitFor = None
+		if timeout is not None:
+			waitFor = timeout - (now - start)
+			if waitFor <= 0:
+				raise TimeoutException("%d calls still running after %.2f seconds" % (len(pending), timeout))
+		for future in pending:
+			if future.deadline is not None:
+				untilDeadline = max(future.deadline - now, 0)
+				if waitFor is None or untilDeadline < waitFor:
+					waitFor = untilDeadline
+		try:
+			select.select(pending, [], [], waitFor)
+		except Exception:
+			# a connection was closed under us; done() will
+			# notice on the next pass
+			pass
+
+def waitAll(futures, timeout=None):
+	"""Waits up to timeout seconds for all futures to finish. Returns
+	   the lists of finished and unfinished futures."""
+	done = []
+	try:
+		for future in asCompleted(futures, timeout):
+			done.append(future)
+	except TimeoutException:
+		pass
+	notDone = [f for f in futures if not f.finished]
+	return (done, notDone)
+
+class RPCStats(object):
+	"""Counts calls, errors, latency, payload sizes and permission
+	   checking time per RPC, and calls, errors and time per caller,
+	   for the services of this process"""
+
+	# upper bounds of the latency histogram buckets, in seconds; the
+	# last bucket counts everything slower
+	latencyBuckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		# name -> function returning a dict of current values
+		self.gauges = {}
+		self.reset()
+
+	def addGauge(self, name, gauge):
+		"""Includes the dict returned by gauge() in snapshots"""
+		self.gauges[name] = gauge
+
+	def reset(self):
+		self.lock.acquire()
+		try:
+			self.since = time.time()
+			self.methods = {}
+			self.callers = {}
+		finally:
+			self.lock.release()
+
+	def __method(self, name):
+		# expects self.lock to be held
+		stats = self.methods.get(name, None)
+		if stats is None:
+			stats = {'calls': 0, 'errors': 0, 'rejected': 0, 'time': 0.0, 'maxTime': 0.0, 'histogram': [0] * (len(self.latencyBuckets) + 1), 'permissionTime': 0.0, 'requestBytes': 0, 'responseBytes': 0}
+			self.methods[name] = stats
+		return stats
+
+	def recordCall(self, name, caller, elapsed, permissionTime=0.0, failed=False):
+		bucket = 0
+		while bucket < len(self.latencyBuckets) and elapsed > self.latencyBuckets[bucket]:
+			bucket += 1
+		self.lock.acquire()
+		try:
+			stats = self.__method(name)
+			stats['calls'] += 1
+			stats['time'] += elapsed
+			stats['maxTime'] = max(stats['maxTime'], elapsed)
+			stats['histogram'][bucket] += 1
+			stats['permissionTime'] += permissionTime
+			if failed:
+				stats['errors'] += 1
+
+			callerStats = self.callers.get(caller, None)
+			if callerStats is None:
+				callerStats = {'calls': 0, 'errors': 0, 'rejected': 0, 'time': 0.0}
+				self.callers[caller] = callerStats
+			callerStats['calls'] += 1
+			callerStats['time'] += elapsed
+			if failed:
+				callerStats['errors'] += 1
+		finally:
+			self.lock.release()
+
+	def recordRejected(self, name, caller):
+		self.lock.acquire()
+		try:
+			self.__method(name)['rejected'] += 1
+			callerStats = self.callers.get(caller, None)
+			if callerStats is None:
+				callerStats = {'calls': 0, 'errors': 0, 'rejected': 0, 'time': 0.0}
+				self.callers[caller] = callerStats
+			callerStats['rejected'] += 1
+		finally:
+			self.lock.release()
+
+	def recordBytes(self, name, requestBytes, responseBytes):
+		self.lock.acquire()
+		try:
+			stats = self.__method(name)
+			stats['requestBytes'] += requestBytes
+			stats['responseBytes'] += responseBytes
+		finally:
+			self.lock.release()
+
+	def snapshot(self):
+		"""Returns a copy of the statistics made of plain dicts and lists"""
+		self.lock.acquire()
+		try:
+			methods = {}
+			for (name, stats) in self.methods.iteritems():
+				methods[name] = dict(stats)
+				methods[name]['histogram'] = list(stats['histogram'])
+			callers = {}
+			for (caller, stats) in self.callers.iteritems():
+				callers[caller] = dict(stats)
+		finally:
+			self.lock.release()
+		gauges = {}
+		for (name, gauge) in self.gauges.items():
+			try:
+				gauges[name] = gauge()
+			except Exception, e:
+				gauges[name] = {'error': str(e)}
+		return {'since': self.since, 'now': time.time(), 'latencyBuckets': list(self.latencyBuckets), 'methods': methods, 'callers': callers, 'gauges': gauges}
+
+# one set of statistics per process, shared by all connections
+rpcStats = RPCStats()
+
 class client:
-	def __init__(self, host, port, username=None, password=None):
-		"""Client for ManagerService. If username and password are provided, rpyc.tlslite_connect will be used to connect, else rpyc.connect will be used."""
+	def __init__(self, host, port, username=None, password=None, timeout=None):
+		"""Client for ManagerService. If username and password are provided, rpyc.tlslite_connect will be used to connect, else rpyc.connect will be used. Calls taking longer than timeout seconds are abandoned and the connection closed."""
 		self.host = host
 		self.port = int(port)
 		self.username = username
 		self.password = password
+		self.timeout = timeout
+		self.remoteFns = {}
+		self.wireVersion = 0
 		self.conn = self.createConn()
 	
 	def createConn(self):
 		"""Creates a rpyc connection."""
+		self.remoteFns = {}
+		config = {}
+		if self.timeout is not None:
+			# bounds attribute lookups on rpyc >= 3.4, ignored
+			# by older versions
+			config['sync_request_timeout'] = self.timeout
 		if self.username != None and self.password != None:
-			return rpyc.tlslite_connect(host=self.host, port=self.port, username=self.username, password=self.password)
+			conn = rpyc.tlslite_connect(host=self.host, port=self.port, username=self.username, password=self.password, config=config)
 		else:
-			return rpyc.connect(host=self.host, port=self.port)
+			conn = rpyc.connect(host=self.host, port=self.port, config=config)
+		self.wireVersion = self.__negotiateWire(conn)
+		return conn
+
+	def __negotiateWire(self, conn):
+		"""Returns the newest wire format both sides understand"""
+		try:
+			return int(conn.root.negotiateWire(wireVersions))
+		except Exception:
+			# servers predating negotiation refuse the call
+			return 0
+
+	def __remoteFn(self, name):
+		# look up the remote function only once per connection
+		fn = self.remoteFns.get(name, None)
+		if fn is None:
+			fn = getattr(self.conn.root, name)
+			self.remoteFns[name] = fn
+		return fn
+
+	def callAsync(self, name, timeout, *args):
+		"""Starts the RPC call and returns an RPCFuture for its result. The call fails if no reply has arrived after timeout seconds."""
+		if self.conn.closed == True:
+			self.conn = self.createConn()
+		# XXXstroucki: why not talk directly, instead
+		# of using rpyc? We're already using pickle to move
+		# args.
+		args = encode(args, self.wireVersion)
+		try:
+			res = asyncCall(self.__remoteFn(name))(args)
+		except Exception, e:
+			self.conn.close()
+			raise e
+		return RPCFuture(name, self, res, timeout)
+
+	def call(self, name, timeout, *args):
+		"""Makes the RPC call, waiting at most timeout seconds for the reply. The wait is done by serving the connection in the calling thread."""
+		return self.callAsync(name, timeout, *args).result()
 
 	def __getattr__(self, name):
 		"""Returns a function that makes the RPC call. No keyword arguments allowed when calling this function."""
 		if self.conn.closed == True:
 			self.conn = self.createConn()
-		if name not in clusterManagerRPCs and name not in nodeManagerRPCs and name not in accountingRPCs:
+		if name not in clusterManagerRPCs and name not in nodeManagerRPCs and name not in accountingRPCs and name not in commonRPCs:
 			return None
 		def connectWrap(*args):
-			# XXXstroucki: why not talk directly, instead
-			# of using rpyc? We're already using pickle to move
-			# args.
-			args = cPickle.dumps(clean(args))
-			try:
-				res = getattr(self.conn.root, name)(args)
-			except Exception, e:
-				self.conn.close()
-				raise e
-			res = cPickle.loads(res)
-			if isinstance(res, Exception):
-				raise res
-			return res
+			return self.call(name, self.timeout, *args)
 		return connectWrap
 
 class ManagerService(rpyc.Service):
@@ -89,6 +421,10 @@ class ManagerService(rpyc.Service):
 			return
 		if self._type == 'NodeManagerService':
 			return
+		if functionName in privilegedRPCs:
+			if clientUsername not in ['agent', 'root']:
+				raise Exception('Permission Denied: %s cannot perform %s' % (clientUsername, functionName))
+			return
 		if clientUsername in ['nodeManager', 'agent', 'root']:
 			return
 		if functionName in ['destroyVm', 'shutdownVm', 'pauseVm', 'vmmSpecificCall', 'suspendVm', 'unpauseVm', 'migrateVm', 'resumeVm']:
@@ -97,30 +433,156 @@ class ManagerService(rpyc.Service):
 			instanceUsername = self.service.data.getUser(instance.userId).name
 			if clientUsername != instanceUsername:
 				raise Exception('Permission Denied: %s cannot perform %s on VM owned by %s' % (clientUsername, functionName, instanceUsername))
+		if functionName in ['destroyVms', 'shutdownVms', 'pauseVms', 'suspendVms']:
+			# limit the selection to the caller's own VMs
+			selector = args[0]
+			user = self.service.data.getUserByName(clientUsername)
+			if user is None:
+				raise Exception('Permission Denied: %s is not a known user' % (clientUsername))
+			if selector.get('userId', user.id) != user.id:
+				raise Exception('Permission Denied: %s cannot perform %s on VMs owned by others' % (clientUsername, functionName))
+			selector['userId'] = user.id
 		return
+
+	def getRPCs(self):
+		if self._type == 'ClusterManagerService':
+			return clusterManagerRPCs
+		if self._type == 'NodeManagerService':
+			return nodeManagerRPCs
+		if self._type == 'AccountingService':
+			return accountingRPCs
+		return []
+
+	def __caller(self):
+		"""Returns the user name or address of the client, for statistics"""
+		caller = getattr(self, '_caller', None)
+		if caller is None:
+			caller = self._conn._config['credentials']
+			if caller is None:
+				try:
+					caller = self._conn._channel.stream.sock.getpeername()[0]
+				except Exception:
+					caller = 'unknown'
+			self._caller = caller
+		return caller
+
+	def __peer(self):
+		"""Returns the address of the client"""
+		try:
+			return self._conn._config['endpoints'][1][0]
+		except Exception:
+			return self.__caller()
+
+	def __checkAndCall(self, name, args):
+		"""Runs the RPC after checking permissions. Returns the result, or the exception that was raised."""
+		start = time.time()
+		permissionTime = 0.0
+		res = None
+		try:
+			if self._conn._config['credentials'] != None:
+				try:
+					self.checkValidUser(name, self._conn._config['credentials'], args)
+				except Exception, e:
+					res = e
+				permissionTime = time.time() - start
+			if res is None:
+				try:
+					res = getattr(self.service, name)(*args)
+				except Exception, e:
+					res = e
+			return res
+		finally:
+			rpcStats.recordCall(name, self.__caller(), time.time() - start, permissionTime, isinstance(res, Exception))
+
+	def batch(self, calls):
+		"""Runs a list of (name, args) RPCs in order. Returns a list with the result of each call, or the exception it raised."""
+		rpcs = self.getRPCs()
+		results = []
+		for (name, args) in calls:
+			if name not in rpcs:
+				results.append(AttributeError('RPC %s does not exist' % (name)))
+				continue
+			results.append(self.__checkAndCall(name, args))
+		return results
+
+	def getRpcStats(self):
+		"""Returns call, error, latency and payload statistics per RPC and per caller since the service started"""
+		return rpcStats.snapshot()
+
+	def negotiateWire(self, versions):
+		"""Returns the newest wire format known to both the client and this server"""
+		common = [v for v in versions if v in wireVersions]
+		if len(common) == 0:
+			return 0
+		return max(common)
 		
 	def _rpyc_getattr(self, name):
 		"""Returns the RPC corresponding to the function call"""
 		def makeCall(args):
-			args = cPickle.loads(args)
-			if self._conn._config['credentials'] != None:
+			start = time.time()
+			requestBytes = len(args)
+			(args, wireVersion) = decode(args)
+			# set by WorkerPoolServer
+			admission = self._conn._config.get('admission', None)
+			refusal = None
+			if admission is not None:
+				peer = self.__peer()
+				refusal = admission.enter(peer)
+			if refusal is not None:
+				res = TashiException(d={'errno':Errors.Overloaded, 'msg':'%s refused, %s' % (makeCall._name, refusal)})
+				rpcStats.recordRejected(makeCall._name, self.__caller())
+			else:
 				try:
-					self.checkValidUser(makeCall._name, self._conn._config['credentials'], args)
-				except Exception, e:
-					e = cPickle.dumps(clean(e))
-					return e
-			try:
-				res = getattr(self.service, makeCall._name)(*args)
-			except Exception, e:
-				res = e
-			res = cPickle.dumps(clean(res))
+					if makeCall._name in commonRPCs:
+						try:
+							if self._conn._config['credentials'] != None:
+								self.checkValidUser(makeCall._name, self._conn._config['credentials'], args)
+							res = getattr(self, makeCall._name)(*args)
+						except Exception, e:
+							res = e
+						rpcStats.recordCall(makeCall._name, self.__caller(), time.time() - start, failed=isinstance(res, Exception))
+					else:
+						res = self.__checkAndCall(makeCall._name, args)
+				finally:
+					if admission is not None:
+						admission.leave(peer)
+			res = encode(res, wireVersion)
+			rpcStats.recordBytes(makeCall._name, requestBytes, len(res))
 			return res
 		makeCall._name = name
-		if self._type == 'ClusterManagerService' and name in clusterManagerRPCs:
-			return makeCall
-		if self._type == 'NodeManagerService' and name in nodeManagerRPCs:
-			return makeCall
-		if self._type == 'AccountingService' and name in accountingRPCs:
+		if name == 'negotiateWire':
+			return self.negotiateWire
+		if name in self.getRPCs() or name in commonRPCs:
 			return makeCall
 
 		raise AttributeError('RPC does not exist')
+
+import unittest
+
+class TestCheckValidUser(unittest.TestCase):
+	def setUp(self):
+		self.manager = ManagerService.__new__(ManagerService)
+		self.manager._type = 'ClusterManagerService'
+
+	def testPrivilegedRPCs(self):
+		for name in privilegedRPCs:
+			for username in ['alice', 'nodeManager']:
+				self.assertRaises(Exception, self.manager.checkValidUser, name, username, [1])
+			for username in ['root', 'agent']:
+				self.manager.checkValidUser(name, username, [1])
+
+	def testRpcStats(self):
+		class Connection(object):
+			_config = {'credentials': 'alice'}
+		self.manager._conn = Connection()
+		self.manager._caller = 'alice'
+		getRpcStats = self.manager._rpyc_getattr('getRpcStats')
+		(res, __wireVersion) = decode(getRpcStats(encode(())))
+		self.assertTrue(isinstance(res, Exception) and "Permission Denied" in str(res))
+		Connection._config = {'credentials': 'agent'}
+		(res, __wireVersion) = decode(getRpcStats(encode(())))
+		self.assertTrue(isinstance(res, dict))
+
+if __name__ == '__main__':
+	suite = unittest.TestLoader().loadTestsFromTestCase(TestCheckValidUser)
+	unittest.TextTestRunner(verbosity=2).run(suite)
@@ -17,6 +17,11 @@
 
 # XXXstroucki: shouldn't this be tashitypes.py instead?
 
+import copy_reg
+import operator
+
+_missing = object()
+
 class Errors(object):
 	ConvertedException = 1
 	NoSuchInstanceId = 2
@@ -31,6 +36,14 @@ class Errors(object):
 	InvalidInstance = 11
 	UnableToResume = 12
 	UnableToSuspend = 13
+	# the server refused the call without running it
+	Overloaded = 14
+	# the target host has too little memory or cores free; the
+	# call may be made again later or for another host
+	InsufficientCapacity = 15
+	# an instance stayed acquired by another caller for longer than
+	# the data layer was configured to wait
+	LockTimeout = 16
 
 class InstanceState(object):
 	Pending = 1
@@ -77,7 +90,105 @@ class TashiException(Exception):
 	def __ne__(self, other):
 		return not (self == other)
 
-class Host(object):
+class SlottedType(object):
+	"""Base for data types that keep their fields in slots instead of a
+	   per-object __dict__. Other attributes, like the locks the data
+	   layer attaches, still work; they go to a __dict__ that is only
+	   created when the first one is set, and are not pickled unless
+	   listed in _wireExtras.
+
+	   Pickle protocol 2 (and copy) uses a compact tuple of field values.
+	   Lower protocols produce the plain attribute dict older versions
+	   of Tashi expect, so the cPickle wire format and pickled databases
+	   stay compatible."""
+	__slots__ = ('__dict__',)
+	_fields = ()
+	_wireExtras = ()
+	# operator.attrgetter over _fields, set up per class below
+	_getter = None
+
+	def _values(self):
+		return self._getter(self)
+
+	def __extras(self):
+		extras = None
+		for name in self._wireExtras:
+			value = getattr(self, name, _missing)
+			if value is not _missing:
+				if extras is None:
+					extras = {}
+				extras[name] = value
+		return extras
+
+	def toDict(self):
+		"""Returns the fields and pickled extras as a dict"""
+		d = dict(zip(self._fields, self._values()))
+		extras = self.__extras()
+		if extras is not None:
+			d.update(extras)
+		return d
+
+	def clone(self):
+		"""Returns a shallow copy. Lists and dicts held in fields are
+		   shared with the original, so replace rather than modify
+		   them in either object."""
+		c = self.__class__.__new__(self.__class__)
+		for (name, value) in zip(self._fields, self._values()):
+			setattr(c, name, value)
+		extras = self.__extras()
+		if extras is not None:
+			for (name, value) in extras.iteritems():
+				setattr(c, name, value)
+		return c
+
+	def __getstate__(self):
+		return (self._values(), self.__extras())
+
+	def __setstate__(self, state):
+		if isinstance(state, dict):
+			# pickled by protocol 0 or an older version
+			values = None
+			extras = state
+			for name in self._fields:
+				if name not in state:
+					# pickled with a different set of
+					# fields; default the missing ones
+					self.__init__()
+					break
+		else:
+			(values, extras) = state
+			if len(values) != len(self._fields):
+				# pickled with a different set of fields,
+				# which may leave some of them unset
+				self.__init__()
+		if values is not None:
+			for (name, value) in zip(self._fields, values):
+				setattr(self, name, value)
+		if extras is not None:
+			for (name, value) in extras.iteritems():
+				setattr(self, name, value)
+
+	def __reduce_ex__(self, protocol):
+		if protocol >= 2:
+			return (copy_reg.__newobj__, (self.__class__,), self.__getstate__())
+		return (copy_reg._reconstructor, (self.__class__, object, None), self.toDict())
+
+	def __str__(self): 
+		return str(self.toDict())
+
+	def __repr__(self): 
+		return repr(self.toDict())
+
+	def __eq__(self, other):
+		return isinstance(other, self.__class__) and self._values() == other._values()
+
+	def __ne__(self, other):
+		return not (self == other)
+
+class Host(SlottedType):
+	__slots__ = ('id', 'name', 'up', 'decayed', 'state', 'memory', 'cores', 'version', 'notes', 'reserved')
+	_fields = __slots__
+
 	def __init__(self, d=None):
 		self.id = None
 		self.name = None
@@ -111,19 +222,12 @@ class Host(object):
 			if 'reserved' in d:
 				self.reserved = d['reserved']
 
-	def __str__(self): 
-		return str(self.__dict__)
-
-	def __repr__(self): 
-		return repr(self.__dict__)
-
-	def __eq__(self, other):
-		return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
-
-	def __ne__(self, other):
-		return not (self == other)
+class Network(SlottedType):
+	__slots__ = ('id', 'name')
+	_fields = __slots__
+	# set by the cluster manager for the client
+	_wireExtras = ('default',)
 
-class Network(object):
 	def __init__(self, d=None):
 		self.id = None
 		self.name = None
@@ -133,18 +237,6 @@ class Network(object):
 			if 'name' in d:
 				self.name = d['name']
 
-	def __str__(self): 
-		return str(self.__dict__)
-
-	def __repr__(self): 
-		return repr(self.__dict__)
-
-	def __eq__(self, other):
-		return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
-
-	def __ne__(self, other):
-		return not (self == other)
-
 class LocalImages(object):
 	def __init__(self, d=None):
 		self.id = None
@@ -179,7 +271,10 @@ class LocalImages(object):
 	def __ne__(self, other):
 		return not (self == other)
 
-class User(object):
+class User(SlottedType):
+	__slots__ = ('id', 'name', 'passwd')
+	_fields = __slots__
+
 	def __init__(self, d=None):
 		self.id = None
 		self.name = None
@@ -192,19 +287,10 @@ class User(object):
 			if 'passwd' in d:
 				self.passwd = d['passwd']
 
-	def __str__(self): 
-		return str(self.__dict__)
-
-	def __repr__(self): 
-		return repr(self.__dict__)
+class DiskConfiguration(SlottedType):
+	__slots__ = ('uri', 'persistent')
+	_fields = __slots__
 
-	def __eq__(self, other):
-		return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
-
-	def __ne__(self, other):
-		return not (self == other)
-
-class DiskConfiguration(object):
 	def __init__(self, d=None):
 		self.uri = None
 		self.persistent = None
@@ -214,19 +300,10 @@ class DiskConfiguration(object):
 			if 'persistent' in d:
 				self.persistent = d['persistent']
 
-	def __str__(self): 
-		return str(self.__dict__)
-
-	def __repr__(self): 
-		return repr(self.__dict__)
+class NetworkConfiguration(SlottedType):
+	__slots__ = ('network', 'mac', 'ip')
+	_fields = __slots__
 
-	def __eq__(self, other):
-		return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
-
-	def __ne__(self, other):
-		return not (self == other)
-
-class NetworkConfiguration(object):
 	def __init__(self, d=None):
 		self.network = None
 		self.mac = None
@@ -239,19 +316,10 @@ class NetworkConfiguration(object):
 			if 'ip' in d:
 				self.ip = d['ip']
 
-	def __str__(self): 
-		return str(self.__dict__)
+class Instance(SlottedType):
+	__slots__ = ('id', 'vmId', 'hostId', 'decayed', 'state', 'userId', 'name', 'cores', 'memory', 'disks', 'nics', 'hints', 'groupName')
+	_fields = __slots__
 
-	def __repr__(self): 
-		return repr(self.__dict__)
-
-	def __eq__(self, other):
-		return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
-
-	def __ne__(self, other):
-		return not (self == other)
-
-class Instance(object):
 	def __init__(self, d=None):
 		self.id = None
 		self.vmId = None
@@ -295,18 +363,6 @@ class Instance(object):
 			if 'groupName' in d:
 				self.groupName = d['groupName']
 
-	def __str__(self): 
-		return str(self.__dict__)
-
-	def __repr__(self): 
-		return repr(self.__dict__)
-
-	def __eq__(self, other):
-		return isinstance(other, self.__class__) and self.__dict__ == other.__dict__
-
-	def __ne__(self, other):
-		return not (self == other)
-
 class Key(object):
 	def __init__(self, d=None):
 		self.userId = None
@@ -482,3 +538,35 @@ class Address(object):
 
 	def __ne__(self, other):
 		return not (self == other)
+
+# the equality and pickling paths read all fields at once
+for _cls in [Host, Network, User, DiskConfiguration, NetworkConfiguration, Instance]:
+	_cls._getter = operator.attrgetter(*_cls._fields)
+
+if __name__ == '__main__':
+	# micro-benchmark: memory per Instance and pickling throughput
+	import cPickle
+	import sys
+	import time
+
+	count = 20000
+	instances = []
+	for i in range(count):
+		instances.append(Instance(d={'id':i, 'vmId':1000+i, 'hostId':i % 100, 'decayed':False, 'state':InstanceState.Running, 'userId':1, 'name':'vm%d' % i, 'cores':1, 'memory':1024, 'disks':[DiskConfiguration(d={'uri':'image.qcow2', 'persistent':False})], 'nics':[NetworkConfiguration(d={'network':1, 'mac':'52:54:00:00:00:01', 'ip':None})], 'hints':{}}))
+
+	instance = instances[0]
+	print "Instance object: %d bytes (a dict-backed object would add a %d byte __dict__)" % (sys.getsizeof(instance), sys.getsizeof(instance.toDict()))
+
+	for protocol in [0, cPickle.HIGHEST_PROTOCOL]:
+		start = time.time()
+		data = cPickle.dumps(instances, protocol)
+		dumped = time.time()
+		copies = cPickle.loads(data)
+		loaded = time.time()
+		assert copies == instances
+		print "protocol %d: %d bytes, dumps %.0f/s, loads %.0f/s" % (protocol, len(data), count/(dumped-start), count/(loaded-dumped))
+
+	start = time.time()
+	for instance in instances:
+		instance.clone()
+	print "clone: %.0f/s" % (count/(time.time()-start))
@@ -25,7 +25,7 @@ import os
 import signal
 #import struct
 import sys
-#import threading
+import threading
 import time
 import traceback
 import types
@@ -279,9 +279,95 @@ def scrubString(s, allowed="ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz
 			ns = ns + c
 	return ns
 
+class RetryPolicy(object):
+	"""Describes when a failed RPC may be attempted again. Only calls
+	   that are safe to repeat are retried, and only for transport
+	   failures, not for exceptions raised by the remote service.
+	   Calls an overloaded server refused without running them are
+	   retried whatever they are."""
+
+	idempotentRPCs = ['getHosts', 'getNetworks', 'getUsers', 'getInstances', 'getHostsSince', 'getInstancesSince', 'getImages', 'getReservation', 'getVmInfo', 'listVms', 'getHostInfo', 'liveCheck', 'getHostCapacity', 'getEvacuations']
+
+	def __init__(self, retries=2, delay=0.5, backoff=2.0, rpcs=None):
+		self.retries = retries
+		self.delay = delay
+		self.backoff = backoff
+		if rpcs is None:
+			rpcs = self.idempotentRPCs
+		self.rpcs = rpcs
+
+	def shouldRetry(self, name, exception, attempt):
+		if attempt >= self.retries:
+			return False
+		if isinstance(exception, TashiException):
+			return exception.errno == Errors.Overloaded
+		if name not in self.rpcs:
+			return False
+		return True
+
+	def getDelay(self, attempt):
+		return self.delay * (self.backoff ** attempt)
+
+class StateMirror(object):
+	"""Keeps a copy of the cluster manager's instances or hosts by id,
+	   fetching only what changed since the last refresh. kind is
+	   "Instances" or "Hosts". Cluster managers without the *Since
+	   RPCs are asked for everything every time."""
+
+	def __init__(self, kind):
+		self.kind = kind
+		self.generation = None
+		self.objects = {}
+		self.incremental = True
+
+	def request(self):
+		"""Returns the (name, args) of the next call, for batch()"""
+		if self.incremental:
+			return ('get%sSince' % (self.kind), (self.generation,))
+		return ('get%s' % (self.kind), ())
+
+	def update(self, result):
+		"""Applies the result of the call from request(), and returns the
+		   objects by id. The dict is changed in place by later updates."""
+		if isinstance(result, AttributeError) and self.incremental:
+			# the cluster manager predates the *Since RPCs
+			self.incremental = False
+			raise result
+		if isinstance(result, Exception):
+			raise result
+
+		if not self.incremental:
+			self.objects = dict([(o.id, o) for o in result])
+			return self.objects
+
+		(generation, objects, removed) = result
+		if removed is None:
+			self.objects = {}
+		for o in objects:
+			self.objects[o.id] = o
+		for _id in removed or []:
+			self.objects.pop(_id, None)
+		self.generation = generation
+		return self.objects
+
+	def refresh(self, client):
+		"""Brings the copy up to date and returns the objects by id"""
+		wasIncremental = self.incremental
+		(name, args) = self.request()
+		try:
+			result = getattr(client, name)(*args)
+		except Exception, e:
+			result = e
+		try:
+			return self.update(result)
+		except AttributeError:
+			if wasIncremental and not self.incremental:
+				return self.refresh(client)
+			raise
+
 class Connection:
 
-	def __init__(self, host, port, authAndEncrypt=False, credentials=None):
+	def __init__(self, host, port, authAndEncrypt=False, credentials=None, timeout=10.0, retryPolicy=None):
 		self.host = host
 		self.port = port
 		self.credentials = credentials
@@ -291,6 +377,11 @@ class Connection:
 		self.username = None
 		if credentials is not None:
 			self.username = credentials[0]
+		# seconds to wait for a reply, None to wait forever
+		self.timeout = timeout
+		# per RPC overrides of self.timeout
+		self.timeouts = {}
+		self.retryPolicy = retryPolicy
 
 	def __connect(self):
 		# create new connection
@@ -312,72 +403,150 @@ class Connection:
 			if self.credentials != (username, password):
 				self.credentials = (username, password)
 
-			client = rpycservices.client(self.host, self.port, username=username, password=password)
+			client = rpycservices.client(self.host, self.port, username=username, password=password, timeout=self.timeout)
 		else:
-			client = rpycservices.client(self.host, self.port)
+			client = rpycservices.client(self.host, self.port, timeout=self.timeout)
 
 		self.connection = client
 
-
-	def __do(self, name, *args, **kwargs):
+	def __attempt(self, name, timeout, args):
 		if self.connection is None:
 			self.__connect()
 
-		threadname = "%s:%s" % (self.host, self.port)
-		# XXXstroucki: Use 10 second timeout, ok?
-		# XXXstroucki: does this fn touch the network?
-		t = TimeoutThread(getattr, (self.connection, name, None))
-		threading.Thread(name=threadname, target=t.run).start()
+		remotefn = getattr(self.connection, name)
+		if not callable(remotefn):
+			raise TashiException({'msg':'%s not callable' % name})
 
 		try:
-			remotefn = t.wait(timeout=10)
-		except TimeoutException:
+			return self.connection.call(name, timeout, *args)
+		finally:
+			# remote exceptions leave the connection usable,
+			# transport failures and timeouts close it
+			if not self.isConnected():
+				self.connection = None
+
+	def callWithTimeout(self, name, timeout, *args):
+		"""Makes the RPC call name, waiting at most timeout seconds
+		   for each attempt"""
+		attempt = 0
+		while True:
+			try:
+				return self.__attempt(name, timeout, args)
+			except Exception, e:
+				if self.retryPolicy is None or not self.retryPolicy.shouldRetry(name, e, attempt):
+					raise
+				time.sleep(self.retryPolicy.getDelay(attempt))
+				attempt += 1
+
+	def callAsync(self, name, *args):
+		"""Starts the RPC call name and returns an RPCFuture for its
+		   result, see rpycservices.waitAll and asCompleted"""
+		timeout = self.timeouts.get(name, self.timeout)
+		try:
+			if self.connection is None:
+				self.__connect()
+			future = self.connection.callAsync(name, timeout, *args)
+		except Exception, e:
+			if not self.isConnected():
+				self.connection = None
+			future = rpycservices.RPCFuture(name)
+			future.setException(e)
+			return future
+		future.addCallback(self.__asyncDone)
+		return future
+
+	def __asyncDone(self, future):
+		if not self.isConnected():
 			self.connection = None
-			raise
 
+	def setTimeout(self, name, timeout):
+		"""Sets the timeout used for all calls of the RPC name"""
+		self.timeouts[name] = timeout
+
+	def batch(self, calls):
+		"""Makes a list of (name, args) RPCs in one round trip. Returns
+		   a list with the result of each call, or the exception it
+		   raised. Servers that predate batching are sent the calls
+		   one at a time."""
+		calls = [(name, tuple(args)) for (name, args) in calls]
 		try:
-			if callable(remotefn):
-				# XXXstroucki: Use 10 second timeout, ok?
-				t = TimeoutThread(remotefn, args, kwargs)
-				threading.Thread(name=threadname, target=t.run).start()
-				returns = t.wait(timeout=10.0)
+			return self.__do('batch', calls)
+		except AttributeError:
+			results = []
+			for (name, args) in calls:
+				try:
+					results.append(self.__do(name, *args))
+				except Exception, e:
+					results.append(e)
+			return results
 
-			else:
-				raise TashiException({'msg':'%s not callable' % name})
+	def __do(self, name, *args):
+		return self.callWithTimeout(name, self.timeouts.get(name, self.timeout), *args)
 
+	def isConnected(self):
+		"""Returns True if an underlying rpyc connection exists and has not been closed"""
+		if self.connection is None:
+			return False
+		try:
+			return not self.connection.conn.closed
 		except:
-			self.connection = None
-			raise
-
-		# if we get a remote exception, raise it locally
-		if (type(returns) is Exception) or \
-		  (type(returns) is TashiException):
-			raise returns
+			return False
 
-		return returns
+	def close(self):
+		"""Drops the underlying rpyc connection, if any"""
+		connection = self.connection
+		self.connection = None
+		if connection is None:
+			return
+		try:
+			connection.conn.close()
+		except:
+			pass
 
 	def __getattr__(self, name):
 		return functools.partial(self.__do, name)
 
 
+# RPCs that may legitimately run for longer than clusterManagerTimeout
+longRPCs = ['copyImage', 'createVm', 'createVms', 'destroyVms', 'shutdownVms', 'evacuateHost']
+
 def createClient(config):
 	cfgHost = config.get('Client', 'clusterManagerHost')
 	cfgPort = config.get('Client', 'clusterManagerPort')
-	#XXXstroucki nothing uses timeout right now
-	#cfgTimeout = config.get('Client', 'clusterManagerTimeout')
+	# config may be a plain ConfigParser, without soft defaults
+	try:
+		cfgTimeout = config.get('Client', 'clusterManagerTimeout')
+	except ConfigParser.Error:
+		cfgTimeout = None
+	try:
+		cfgLongTimeout = config.get('Client', 'clusterManagerLongTimeout')
+	except ConfigParser.Error:
+		cfgLongTimeout = None
+	try:
+		cfgRetries = config.get('Client', 'clusterManagerRetries')
+	except ConfigParser.Error:
+		cfgRetries = None
 	host = os.getenv('TASHI_CM_HOST', cfgHost)
 	port = os.getenv('TASHI_CM_PORT', cfgPort)
-	#XXXstroucki nothing uses timeout right now
-	#timeout = float(os.getenv('TASHI_CM_TIMEOUT', cfgTimeout)) * 1000.0
+	timeout = float(os.getenv('TASHI_CM_TIMEOUT', cfgTimeout or 10.0))
+	longTimeout = max(timeout, float(cfgLongTimeout or 300.0))
+	retries = int(os.getenv('TASHI_CM_RETRIES', cfgRetries or 0))
+
+	retryPolicy = None
+	if retries > 0:
+		retryPolicy = RetryPolicy(retries=retries)
 
 	authAndEncrypt = boolean(config.get('Security', 'authAndEncrypt'))
 	if authAndEncrypt:
 		username = config.get('AccessClusterManager', 'username')
 		password = config.get('AccessClusterManager', 'password')
-		client = Connection(host, port, authAndEncrypt, (username, password))
+		client = Connection(host, port, authAndEncrypt, (username, password), timeout=timeout, retryPolicy=retryPolicy)
 
 	else:
-		client = Connection(host, port)
+		client = Connection(host, port, timeout=timeout, retryPolicy=retryPolicy)
+
+	for name in longRPCs:
+		client.setTimeout(name, longTimeout)
 
 	return client
 